@@ -0,0 +1,196 @@
+from photogrammetry.models.keypoint import KeyPoint
+from photogrammetry.models.keypoint_set import KeypointSet, keypoint_coords, cluster_centers_as_keypoints
+import numpy as np
+from typing import Optional, Union
+
+
+def centroid_linkage(coords: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Full centroid linkage with the city block distance, merging until one cluster remains.
+
+    Every merge is the closest pair of clusters, ties going to the pair whose newer cluster is older, the same order
+    `HierarchicalClustering` merges in. Each cluster keeps its nearest neighbour, and only clusters whose neighbour
+    was just merged are rescanned, so the merges take O(n^2) time and O(n) memory.
+    :return: (n - 1, 4) SciPy layout linkage matrix [cluster 1, cluster 2, distance, num keypoints], where row i
+        creates cluster n + i, and the (2n - 1, 2) center of every cluster.
+    """
+    coords = np.asarray(coords).reshape(-1, 2)
+    num_keypoints = len(coords)
+    num_nodes = max(2 * num_keypoints - 1, 0)
+    z = np.zeros((max(num_keypoints - 1, 0), 4), dtype=np.float64)
+    centers = np.zeros((num_nodes, 2), dtype=np.float64)
+    centers[:num_keypoints] = coords
+    sizes = np.zeros(num_nodes, dtype=np.int64)
+    sizes[:num_keypoints] = 1
+    if num_keypoints < 2:
+        return z, centers
+
+    # Active clusters live in slots, ordered by cluster id. Merged clusters get an infinite center until the slots
+    # are compacted, so they are never anyone's nearest neighbour.
+    slot_ids = np.arange(num_nodes)
+    slot_rows = np.full(num_nodes, np.inf)
+    slot_cols = np.full(num_nodes, np.inf)
+    slot_rows[:num_keypoints] = coords[:, 0]
+    slot_cols[:num_keypoints] = coords[:, 1]
+    nn_ids = np.full(num_nodes, -1, dtype=np.int64)
+    nn_dists = np.full(num_nodes, np.inf)
+    slots_of_ids = np.arange(num_nodes)
+    num_slots = num_keypoints
+
+    def update_nearest(slots: np.ndarray) -> None:
+        distances = np.abs(slot_rows[np.newaxis, :num_slots] - slot_rows[slots, np.newaxis])
+        distances += np.abs(slot_cols[np.newaxis, :num_slots] - slot_cols[slots, np.newaxis])
+        distances[np.arange(len(slots)), slots] = np.inf
+        # argmin takes the smallest id among equal distances.
+        nearest = np.argmin(distances, axis=1)
+        nn_ids[slots] = slot_ids[nearest]
+        nn_dists[slots] = distances[np.arange(len(slots)), nearest]
+
+    for start in range(0, num_keypoints, 1024):
+        update_nearest(np.arange(start, min(start + 1024, num_keypoints)))
+
+    for merge_idx in range(len(z)):
+        new_id = num_keypoints + merge_idx
+        min_dist = nn_dists[:num_slots].min()
+        candidates = np.flatnonzero(nn_dists[:num_slots] == min_dist)
+        newer = np.maximum(slot_ids[candidates], nn_ids[candidates])
+        older = np.minimum(slot_ids[candidates], nn_ids[candidates])
+        best = np.lexsort((older, newer))[0]
+        cluster_id_1, cluster_id_2 = int(older[best]), int(newer[best])
+
+        z[merge_idx] = [cluster_id_1, cluster_id_2, min_dist, sizes[cluster_id_1] + sizes[cluster_id_2]]
+        sizes[new_id] = sizes[cluster_id_1] + sizes[cluster_id_2]
+        centers[new_id] = np.divide(
+            (centers[cluster_id_1] * sizes[cluster_id_1]) + (centers[cluster_id_2] * sizes[cluster_id_2]), sizes[new_id]
+        )
+        merged_slots = slots_of_ids[[cluster_id_1, cluster_id_2]]
+        slot_rows[merged_slots] = np.inf
+        slot_cols[merged_slots] = np.inf
+        nn_dists[merged_slots] = np.inf
+        if merge_idx == len(z) - 1:
+            break
+
+        num_active = len(z) - merge_idx
+        if num_slots == num_nodes or num_slots > 2 * num_active:
+            is_active = np.isfinite(slot_rows[:num_slots])
+            for slot_array in (slot_ids, slot_rows, slot_cols, nn_ids, nn_dists):
+                slot_array[:num_active - 1] = slot_array[:num_slots][is_active]
+            num_slots = num_active - 1
+            slots_of_ids[slot_ids[:num_slots]] = np.arange(num_slots)
+        new_slot = num_slots
+        num_slots += 1
+        slot_ids[new_slot] = new_id
+        slots_of_ids[new_id] = new_slot
+        slot_rows[new_slot], slot_cols[new_slot] = centers[new_id]
+
+        # The new cluster is the newest, so it only replaces a neighbour that is strictly closer.
+        new_distances = np.abs(slot_rows[:num_slots] - slot_rows[new_slot]) + np.abs(slot_cols[:num_slots] - slot_cols[new_slot])
+        is_closer = new_distances < nn_dists[:num_slots]
+        is_closer[new_slot] = False
+        nn_ids[:num_slots][is_closer] = new_id
+        nn_dists[:num_slots][is_closer] = new_distances[is_closer]
+        lost_neighbour = (nn_ids[:num_slots] == cluster_id_1) | (nn_ids[:num_slots] == cluster_id_2)
+        lost_neighbour &= np.isfinite(slot_rows[:num_slots])
+        lost_neighbour[new_slot] = True
+        update_nearest(np.flatnonzero(lost_neighbour))
+    return z, centers
+
+
+class Dendrogram:
+    """
+    The full centroid linkage merge tree of a set of keypoints, built once and cut at any distance or cluster count.
+
+    `cut(distance)` matches `HierarchicalClustering(keypoints, distance).run_clustering()`: merges are applied in order
+    until the first one further apart than `distance`.
+    """
+    def __init__(self, keypoints: Union[list[KeyPoint], KeypointSet], z: Optional[np.ndarray] = None) -> None:
+        """
+        :param z: A linkage matrix from a previous `centroid_linkage` of the same keypoints, e.g. from `load`.
+        """
+        self._keypoints = keypoints
+        self.num_keypoints = len(keypoints)
+        coords = keypoint_coords(keypoints)
+        if z is None:
+            # 5k keypoints ~ 1.2 seconds, 10k ~ 4 seconds.
+            self.z, self.centers = centroid_linkage(coords)
+        else:
+            self.z = np.asarray(z, dtype=np.float64).reshape(-1, 4)
+            self.centers = self._replay_centers(coords)
+        self._build_lookups()
+
+    def _replay_centers(self, coords: np.ndarray) -> np.ndarray:
+        centers = np.zeros((self.num_keypoints + len(self.z), 2), dtype=np.float64)
+        centers[:self.num_keypoints] = coords
+        for merge_idx, (cluster_id_1, cluster_id_2, _, num_items) in enumerate(self.z):
+            cluster_id_1, cluster_id_2 = int(cluster_id_1), int(cluster_id_2)
+            size_1 = self._num_items(cluster_id_1)
+            size_2 = self._num_items(cluster_id_2)
+            centers[self.num_keypoints + merge_idx] = np.divide(
+                (centers[cluster_id_1] * size_1) + (centers[cluster_id_2] * size_2), num_items
+            )
+        return centers
+
+    def _num_items(self, cluster_id: int) -> int:
+        return 1 if cluster_id < self.num_keypoints else int(self.z[cluster_id - self.num_keypoints, 3])
+
+    def _build_lookups(self) -> None:
+        num_nodes = self.num_keypoints + len(self.z)
+        merged_ids = self.z[:, :2].astype(np.int64)
+        # The root is its own parent.
+        parents = np.arange(num_nodes)
+        parents[merged_ids[:, 0]] = np.arange(self.num_keypoints, num_nodes)
+        parents[merged_ids[:, 1]] = np.arange(self.num_keypoints, num_nodes)
+        # Binary lifting: ancestors[j][node] is the 2^j-th ancestor. Ancestor ids only grow towards the root.
+        self._ancestors = [parents]
+        for _ in range(max(int(num_nodes).bit_length() - 1, 0)):
+            self._ancestors.append(self._ancestors[-1][self._ancestors[-1]])
+        # Like HierarchicalClustering, a cluster's reference keypoint is the first keypoint of its first cluster.
+        self._first_keypoints = np.arange(num_nodes)
+        for merge_idx, cluster_id_1 in enumerate(merged_ids[:, 0]):
+            self._first_keypoints[self.num_keypoints + merge_idx] = self._first_keypoints[cluster_id_1]
+        # The heights aren't monotonic under centroid linkage, cuts stop at the first merge above the distance.
+        self._running_max_dists = np.maximum.accumulate(self.z[:, 2]) if len(self.z) else np.zeros(0)
+
+    def num_merges_within(self, distance: float) -> int:
+        """
+        Number of merges applied before the first merge further apart than `distance`.
+        """
+        return int(np.searchsorted(self._running_max_dists, distance, side='right'))
+
+    def labels(self, num_merges: int) -> np.ndarray:
+        """
+        The cluster id of each keypoint after the first `num_merges` merges.
+        """
+        cluster_limit = self.num_keypoints + num_merges
+        labels = np.arange(self.num_keypoints)
+        for ancestors in reversed(self._ancestors):
+            jumped = ancestors[labels]
+            labels = np.where(jumped < cluster_limit, jumped, labels)
+        return labels
+
+    def cut(self, distance: Optional[float] = None, n_clusters: Optional[int] = None) -> Union[list[KeyPoint], KeypointSet]:
+        """
+        Clustered keypoints at a merge distance or a number of clusters, of the same type as the keypoints.
+        """
+        if (distance is None) == (n_clusters is None):
+            raise ValueError("Cut at either a distance or a number of clusters")
+        if distance is not None:
+            num_merges = self.num_merges_within(distance)
+        else:
+            num_merges = min(max(self.num_keypoints - n_clusters, 0), len(self.z))
+        cluster_ids = np.unique(self.labels(num_merges))
+        self.cluster_sizes = np.array([self._num_items(cluster_id) for cluster_id in cluster_ids], dtype=np.int64)
+        return cluster_centers_as_keypoints(self._keypoints, self._first_keypoints[cluster_ids], self.centers[cluster_ids])
+
+    def save(self, file_path) -> None:
+        np.save(file_path, self.z)
+
+    @classmethod
+    def load(cls, file_path, keypoints: Union[list[KeyPoint], KeypointSet]):
+        """
+        Loads the linkage matrix saved for these same keypoints.
+        """
+        z = np.load(file_path)
+        if len(z) != max(len(keypoints) - 1, 0):
+            raise ValueError(f"The saved dendrogram has {len(z)} merges, not one fewer than the {len(keypoints)} keypoints")
+        return cls(keypoints, z)
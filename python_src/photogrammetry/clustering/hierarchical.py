@@ -1,43 +1,93 @@
 from photogrammetry.models.keypoint import KeyPoint
+from photogrammetry.models.keypoint_set import (
+    KeypointSet, keypoint_coords, take_keypoints, concatenate_keypoints, cluster_centers_as_keypoints
+)
+from photogrammetry.clustering.dendrogram import Dendrogram
+from photogrammetry.clustering.linkage import linkage_matrix, normalize_metric, pairwise_distances, point_distances
+from photogrammetry.clustering.single_linkage import connected_component_labels
 import numpy as np
 from dataclasses import dataclass
-from typing import Optional
+from typing import Optional, Union
 import multiprocessing
+from multiprocessing.pool import Pool
+from time import perf_counter
+import heapq
+from collections import defaultdict
 from abc import ABC, abstractmethod
 
 
+@dataclass
+class ChunkTaskStats:
+    chunk_idx: int
+    num_keypoints: int
+    num_clusters: int
+    seconds: float
+
+
 @dataclass
 class _HierarchicalCluster:
     num_items: int
     center: np.ndarray
-    keypoints: list[KeyPoint]
+    # Indexes into the keypoints being clustered.
+    keypoint_idxs: list[int]
 
 
 class HierarchicalClustering:
-    def __init__(self, keypoints: list[KeyPoint], max_merge_distance: int = 25) -> None:
+    """
+    Centroid linkage clustering, merging until no two clusters are within `max_merge_distance` by `metric`
+    (cityblock, euclidean or chebyshev). See `LinkageClustering` for other linkages.
+
+    Candidate merges are kept in a heap and entries of clusters that have since been merged are skipped when popped.
+    Clusters further apart than max_merge_distance can never merge, so a new cluster is only compared against the
+    clusters in the neighbouring cells of a grid of max_merge_distance sized cells. None of the metrics is shorter
+    than the chebyshev distance, so no closer cluster can be outside those cells.
+    """
+    def __init__(
+        self, keypoints: Union[list[KeyPoint], KeypointSet], max_merge_distance: int = 25, metric: str = "cityblock",
+        weights: Optional[np.ndarray] = None
+    ) -> None:
+        """
+        :param weights: Number of keypoints each keypoint stands for, e.g. the `cluster_sizes` of already clustered
+            keypoints, so merged centers are weighted as if the original keypoints were clustered. 1 by default.
+        """
         # TODO the max merge distance should be scaled via a percentage of the image size..
         self.max_merge_distance = max_merge_distance
+        self.metric = normalize_metric(metric)
         # Maps ID, to cluster object
         self.cluster_map: dict[int, _HierarchicalCluster] = {}
         self.num_clusters_acc = 0
         self.active_clusters = set()    # Cluster ids
         self.num_keypoints = len(keypoints)
         self.z = np.zeros((max(self.num_keypoints * 2 - 1, 0), 4), dtype=np.int32)    # TODO is 32 sufficient?
-        self.sorted_cluster_distances = []
-        self._initialize_clusters(keypoints)
-
-    def _initialize_clusters(self, keypoints: list[KeyPoint]) -> None:
-        for keypoint in keypoints:
-            self._add_new_cluster(_HierarchicalCluster(1, keypoint.coord, [keypoint]), delay_sort=True)
-        self.sorted_cluster_distances.sort(key=lambda x: x[0])
-
-    def _cluster_distance(self, cluster_id_1: int, cluster_id_2: int) -> int:
-        # TODO implement different types of distances
-        # This is the city block distance.
-        return sum(np.abs(
-            self.cluster_map[cluster_id_1].center -
-            self.cluster_map[cluster_id_2].center
-        ))
+        # Number of keypoints in each clustered keypoint, set by run_clustering.
+        self.cluster_sizes = np.zeros(0, dtype=np.int64)
+        # (distance, insertion order, cluster id 1, cluster id 2), so equal distances pop in the order they were added.
+        self._merge_heap: list[tuple] = []
+        self._num_pairs_acc = 0
+        self._grid_cell_size = max(max_merge_distance, 1)
+        # Maps grid cell, to the ids of the active clusters centered in it
+        self._grid: dict[tuple[int, int], set[int]] = defaultdict(set)
+        self._cluster_cells: dict[int, tuple[int, int]] = {}
+        self._keypoints = keypoints
+        weights = np.ones(self.num_keypoints, dtype=np.int64) if weights is None else np.asarray(weights, dtype=np.int64)
+        if len(weights) != self.num_keypoints:
+            raise ValueError(f"Expected {self.num_keypoints} weights but got {len(weights)}")
+        self._initialize_clusters(keypoint_coords(keypoints), weights.tolist())
+
+    def _initialize_clusters(self, coords: np.ndarray, weights: list[int]) -> None:
+        for idx, (coord, weight) in enumerate(zip(coords, weights)):
+            self._add_new_cluster(_HierarchicalCluster(weight, coord, [idx]), delay_heapify=True)
+        heapq.heapify(self._merge_heap)
+
+    def _grid_cell(self, center: np.ndarray) -> tuple[int, int]:
+        return int(center[0] // self._grid_cell_size), int(center[1] // self._grid_cell_size)
+
+    def _neighbour_clusters(self, cell: tuple[int, int]) -> list[int]:
+        neighbours = []
+        for d_row in (-1, 0, 1):
+            for d_col in (-1, 0, 1):
+                neighbours.extend(self._grid.get((cell[0] + d_row, cell[1] + d_col), ()))
+        return sorted(neighbours)
 
     def _compute_new_center(self, cluster_id_1: int, cluster_id_2: int) -> np.ndarray:
         cluster1 = self.cluster_map[cluster_id_1]
@@ -48,7 +98,7 @@ class HierarchicalClustering:
     def _merge_clusters(self, cluster_id_1: int, cluster_id_2: int, distance):
         self._remove_clusters([cluster_id_1, cluster_id_2])
         num_observations = self.cluster_map[cluster_id_1].num_items + self.cluster_map[cluster_id_2].num_items
-        combined_keypoints = self.cluster_map[cluster_id_1].keypoints + self.cluster_map[cluster_id_2].keypoints
+        combined_keypoints = self.cluster_map[cluster_id_1].keypoint_idxs + self.cluster_map[cluster_id_2].keypoint_idxs
         cluster_id = self._add_new_cluster(_HierarchicalCluster(
             num_observations,
             self._compute_new_center(cluster_id_1, cluster_id_2),
@@ -57,50 +107,46 @@ class HierarchicalClustering:
         self.z[cluster_id] = [cluster_id_1, cluster_id_2, distance, num_observations]
         return cluster_id
 
-    def _add_new_cluster(self, cluster: _HierarchicalCluster, delay_sort=False) -> int:
+    def _add_new_cluster(self, cluster: _HierarchicalCluster, delay_heapify=False) -> int:
         cluster_id = self.num_clusters_acc
         self.num_clusters_acc += 1
         self.cluster_map[cluster_id] = cluster
 
-        # TODO is there some way that we can only store a few minimum distances?
-        # It does not make sense to store just one. But, how many are required?
-        # min_dist = math.inf
-        # c1 = -1
-        # c2 = -1
-        for cluster1 in self.active_clusters:
-            dist = self._cluster_distance(cluster1, cluster_id)
-            if dist > self.max_merge_distance:
-                continue
-            self.sorted_cluster_distances.append((dist, cluster1, cluster_id))
-        # TODO this is horrible that we're sorting every time (especially when we're only adding a single element at once.)
-        # Perhaps we should offload sorting or allow it to be disabled.
-        if not delay_sort:
-            self.sorted_cluster_distances.sort(key=lambda x: x[0])
+        cell = self._grid_cell(cluster.center)
+        neighbour_ids = self._neighbour_clusters(cell)
+        if neighbour_ids:
+            neighbour_centers = np.array([self.cluster_map[neighbour_id].center for neighbour_id in neighbour_ids])
+            distances = point_distances(neighbour_centers, cluster.center, self.metric).tolist()
+            for neighbour_id, dist in zip(neighbour_ids, distances):
+                if dist > self.max_merge_distance:
+                    continue
+                pair = (dist, self._num_pairs_acc, neighbour_id, cluster_id)
+                self._num_pairs_acc += 1
+                if delay_heapify:
+                    self._merge_heap.append(pair)
+                else:
+                    heapq.heappush(self._merge_heap, pair)
 
         self.active_clusters.add(cluster_id)
+        self._grid[cell].add(cluster_id)
+        self._cluster_cells[cluster_id] = cell
         return cluster_id
 
     def _remove_clusters(self, cluster_ids: list[int]):
-        # TODO This could technically be slower than just checking if a given cluster distance includes
-        # non-existent cluster_ids when popping it. It could be better to mix the two techniques. 
+        # Their entries stay in the heap and are skipped when popped.
         for cluster_id in cluster_ids:
             self.active_clusters.discard(cluster_id)
-
-        # Start at end of sorted_cluster_distances and pop elements to front.
-        for i in reversed(range(len(self.sorted_cluster_distances))):
-            _, c1, c2 = self.sorted_cluster_distances[i]
-            if c1 in cluster_ids or c2 in cluster_ids:
-                self.sorted_cluster_distances.pop(i)
+            self._grid[self._cluster_cells.pop(cluster_id)].discard(cluster_id)
 
     # TODO rename to pop?
     def _min_dist_clusters(self) -> Optional[tuple[int, int, int]]:
-        # TODO add guard for if there are no clusters remaining
-        # TODO this could sort every time it returns? That would be faster than each time it adds a cluster maybe...
-        if len(self.sorted_cluster_distances) == 0:
-            return None
-        return self.sorted_cluster_distances.pop(0)
+        while self._merge_heap:
+            dist, _, cluster_id_1, cluster_id_2 = heapq.heappop(self._merge_heap)
+            if cluster_id_1 in self.active_clusters and cluster_id_2 in self.active_clusters:
+                return dist, cluster_id_1, cluster_id_2
+        return None
 
-    def run_clustering(self) -> list:
+    def run_clustering(self) -> Union[list[KeyPoint], KeypointSet]:
         # First, merge all clusters.
         while len(self.active_clusters) > 1:
             # While there are still clusters to be merged, 
@@ -116,50 +162,121 @@ class HierarchicalClustering:
             # TODO should make merge_clusters take a tuple or perhaps a dataclass
             self._merge_clusters(min_dist_cluster1, min_dist_cluster2, min_dist)
 
-        clustered_keypoints = []
         # Since we are short circuting the loop, we can just take all active clusters and call it good.
         # print(self.active_clusters)
-        for cluster_id in self.active_clusters:
+        ref_idxs = []
+        centers = []
+        cluster_sizes = []
+        for cluster_id in sorted(self.active_clusters):
             cluster = self.cluster_map[cluster_id]
-            if cluster.num_items == 0:
-                clustered_keypoints.append(cluster.keypoints[0])
-                continue
-            ref_keypoint = cluster.keypoints[0]
-            clustered_keypoints.append(
-                KeyPoint(   # TODO replace with KeyPoint.from_reference when done.
-                    image_id=ref_keypoint._image_id,
-                    coord=np.round(cluster.center).astype(np.int32),
-                    gaussian_pairs=ref_keypoint._gaussian_pairs,
-                    image_db=ref_keypoint._image_db
-                )
-            )
-        return clustered_keypoints
+            ref_idxs.append(cluster.keypoint_idxs[0])
+            centers.append(cluster.center)
+            cluster_sizes.append(cluster.num_items)
+        self.cluster_sizes = np.array(cluster_sizes, dtype=np.int64)
+        return cluster_centers_as_keypoints(self._keypoints, ref_idxs, centers)
 
 class BaseChunkedHierarchicalClustering(ABC):
     def __init__(
-        self, img_dim: tuple[int, int], keypoints: list[KeyPoint], chunks_dim: tuple[int, int] = (4, 4),
-        max_merge_dist: int = 25, edge_merge_dist: Optional[int] = None
+        self, img_dim: tuple[int, int], keypoints: Union[list[KeyPoint], KeypointSet], chunks_dim: tuple[int, int] = (4, 4),
+        max_merge_dist: int = 25, edge_merge_dist: Optional[int] = None, metric: str = "cityblock"
     ) -> None:
         self.chunks_dim = chunks_dim
+        self.img_dim = img_dim
         self.max_merge_distance = max_merge_dist
+        self.metric = normalize_metric(metric)
+        # Clusters within this distance of each other across a chunk seam are merged after clustering the chunks.
+        self.edge_merge_distance = max_merge_dist if edge_merge_dist is None else edge_merge_dist
+        self.cluster_sizes = np.zeros(0, dtype=np.int64)
         self.height_chunk_off = img_dim[0] // chunks_dim[0]
         self.width_chunk_off = img_dim[1] // chunks_dim[1]
+        self._keypoints = keypoints
         self._init_keypoint_chunks(keypoints)
     
     @abstractmethod
     def _init_keypoint_chunks(self, keypoints):
         raise NotImplementedError()
 
-    def _keypoint_to_chunk_idx(self, keypoint):
-        h_chunk = min(keypoint.coord[0] // self.height_chunk_off, self.chunks_dim[0] - 1)
-        w_chunk = min(keypoint.coord[1] // self.width_chunk_off, self.chunks_dim[1] - 1)
-        return h_chunk, w_chunk
+    def _keypoint_chunk_idxs(self, keypoints) -> tuple[np.ndarray, np.ndarray]:
+        coords = keypoint_coords(keypoints)
+        h_chunks = np.minimum(coords[:, 0] // self.height_chunk_off, self.chunks_dim[0] - 1)
+        w_chunks = np.minimum(coords[:, 1] // self.width_chunk_off, self.chunks_dim[1] - 1)
+        return h_chunks, w_chunks
+
+    def _split_into_chunks(self, keypoints) -> list:
+        """
+        Splits the keypoints into row-major ordered chunks, keeping the input type.
+        """
+        h_chunks, w_chunks = self._keypoint_chunk_idxs(keypoints)
+        flat_chunk_idxs = h_chunks * self.chunks_dim[1] + w_chunks
+        return [
+            take_keypoints(keypoints, np.flatnonzero(flat_chunk_idxs == chunk_idx))
+            for chunk_idx in range(self.chunks_dim[0] * self.chunks_dim[1])
+        ]
 
-    def _cluster_chunk(self, keypoints: list) -> list:
+    def _chunk_rects(self) -> list[tuple[int, int, int, int]]:
+        """
+        (row start, row end, col start, col end) of each chunk, in the row-major order of `_split_into_chunks`.
+        """
+        rects = []
+        for chunk_h in range(self.chunks_dim[0]):
+            row_end = self.img_dim[0] if chunk_h == self.chunks_dim[0] - 1 else (chunk_h + 1) * self.height_chunk_off
+            for chunk_w in range(self.chunks_dim[1]):
+                col_end = self.img_dim[1] if chunk_w == self.chunks_dim[1] - 1 else (chunk_w + 1) * self.width_chunk_off
+                rects.append((chunk_h * self.height_chunk_off, row_end, chunk_w * self.width_chunk_off, col_end))
+        return rects
+
+    def _cluster_chunk(self, keypoints):
+        """
+        :return: The clustered keypoints and the number of keypoints in each cluster.
+        """
         if len(keypoints) == 0:
-            return []
-        hc = HierarchicalClustering(keypoints, self.max_merge_distance)
-        return hc.run_clustering()
+            return keypoints, np.zeros(0, dtype=np.int64)
+        hc = HierarchicalClustering(keypoints, self.max_merge_distance, self.metric)
+        return hc.run_clustering(), hc.cluster_sizes
+
+    def _near_seam(self, coords: np.ndarray, rect: tuple[int, int, int, int]) -> np.ndarray:
+        """
+        Whether each coord in `rect` could be within edge_merge_distance of a coord in a neighbouring rect.
+        The image border isn't a seam.
+        """
+        row_start, row_end, col_start, col_end = rect
+        # A coord on the other side of a seam is at least one pixel past it.
+        max_gap = self.edge_merge_distance - 1
+        near_seam = np.zeros(len(coords), dtype=bool)
+        if row_start > 0:
+            near_seam |= coords[:, 0] - row_start <= max_gap
+        if row_end < self.img_dim[0]:
+            near_seam |= row_end - 1 - coords[:, 0] <= max_gap
+        if col_start > 0:
+            near_seam |= coords[:, 1] - col_start <= max_gap
+        if col_end < self.img_dim[1]:
+            near_seam |= col_end - 1 - coords[:, 1] <= max_gap
+        return near_seam
+
+    def _stitch_chunks(self, chunk_outputs: list, rects: list[tuple[int, int, int, int]]):
+        """
+        Joins the clustered chunks, re-clustering the clusters near the seams with the same centroid linkage as the
+        chunks, weighted by their sizes and up to edge_merge_distance. Without this, a cluster split by a seam comes
+        out as one keypoint per chunk. Merging the closest centers first, rather than every pair within reach,
+        keeps a chain of clusters along a seam from merging into one cluster wider than the chunks could produce.
+        :param chunk_outputs: `_cluster_chunk` output of the chunk in each of `rects`.
+        """
+        clustered_keypoints = concatenate_keypoints([keypoints for keypoints, _ in chunk_outputs], self._keypoints)
+        cluster_sizes = np.concatenate([np.zeros(0, dtype=np.int64)] + [sizes for _, sizes in chunk_outputs])
+        if len(clustered_keypoints) == 0:
+            self.cluster_sizes = cluster_sizes
+            return clustered_keypoints
+        near_seam = np.concatenate([
+            self._near_seam(keypoint_coords(keypoints), rect) for (keypoints, _), rect in zip(chunk_outputs, rects)
+        ])
+        seam_idxs = np.flatnonzero(near_seam)
+        other_idxs = np.flatnonzero(~near_seam)
+        seam_hc = HierarchicalClustering(
+            take_keypoints(clustered_keypoints, seam_idxs), self.edge_merge_distance, self.metric, cluster_sizes[seam_idxs]
+        )
+        seam_clusters = seam_hc.run_clustering()
+        self.cluster_sizes = np.concatenate([cluster_sizes[other_idxs], seam_hc.cluster_sizes])
+        return concatenate_keypoints([take_keypoints(clustered_keypoints, other_idxs), seam_clusters], self._keypoints)
 
     @abstractmethod
     def run_clustering(self):
@@ -168,38 +285,229 @@ class BaseChunkedHierarchicalClustering(ABC):
 
 class ChunkedHierarchicalClustering(BaseChunkedHierarchicalClustering):    
     def _init_keypoint_chunks(self, keypoints):
-        keypoints_by_chunk = [[[] for _ in range(self.chunks_dim[1])] for _ in range(self.chunks_dim[0])]
-        for keypoint in keypoints:
-            h_chunk, w_chunk = self._keypoint_to_chunk_idx(keypoint)
-            keypoints_by_chunk[h_chunk][w_chunk].append(keypoint)
-        self.chunked_keypoints = keypoints_by_chunk
-
-    def run_clustering(self) -> list:
-        clustered_keypoints_acc = []
+        chunks = self._split_into_chunks(keypoints)
+        self.chunked_keypoints = [
+            chunks[chunk_h * self.chunks_dim[1]:(chunk_h + 1) * self.chunks_dim[1]] for chunk_h in range(self.chunks_dim[0])
+        ]
+
+    def run_clustering(self):
+        chunk_outputs = []
         for chunk_h in range(self.chunks_dim[0]):
             for chunk_w in range(self.chunks_dim[1]):
-                clustered_keypoints_acc.extend(
+                chunk_outputs.append(
                     self._cluster_chunk(self.chunked_keypoints[chunk_h][chunk_w])
                 )
-        return clustered_keypoints_acc
+        return self._stitch_chunks(chunk_outputs, self._chunk_rects())
 
 class ChunkedHierarchicalClusteringMultithreaded(BaseChunkedHierarchicalClustering):
-    def __init__(self, img_dim: tuple[int, int], keypoints: list[KeyPoint], chunks_dim: tuple[int, int] = (4, 4), max_merge_dist: int = 25, edge_merge_dist: Optional[int] = None, chunks_per_thread: Optional[int] = None) -> None:
+    def __init__(self, img_dim: tuple[int, int], keypoints: Union[list[KeyPoint], KeypointSet], chunks_dim: tuple[int, int] = (4, 4), max_merge_dist: int = 25, edge_merge_dist: Optional[int] = None, chunks_per_thread: Optional[int] = None, metric: str = "cityblock") -> None:
         self.chunks_per_thread = chunks_per_thread or 2
-        super().__init__(img_dim, keypoints, chunks_dim, max_merge_dist, edge_merge_dist)
+        super().__init__(img_dim, keypoints, chunks_dim, max_merge_dist, edge_merge_dist, metric)
     
     def _init_keypoint_chunks(self, keypoints):
-        self.chunked_keypoints = [[] for _ in range(self.chunks_dim[0] * self.chunks_dim[1])]
-        for keypoint in keypoints:
-            h_chunk, w_chunk = self._keypoint_to_chunk_idx(keypoint)
-            self.chunked_keypoints[h_chunk * self.chunks_dim[1] + w_chunk].append(keypoint)
-
-    def run_clustering(self) -> list:
-        clustered_keypoints_acc = []
-        
+        self.chunked_keypoints = self._split_into_chunks(keypoints)
+
+    def run_clustering(self):
         # TODO set size of pool manually?
-        pool = multiprocessing.Pool()
-        outputs = pool.map(self._cluster_chunk, [chunk for chunk in self.chunked_keypoints], chunksize=self.chunks_per_thread)
-        for output in outputs:
-            clustered_keypoints_acc.extend(output)
-        return clustered_keypoints_acc
+        # NOTE the bound method pickles self, so a KeypointSet is much cheaper to send to the workers than a list of KeyPoints.
+        with multiprocessing.Pool() as pool:
+            outputs = pool.map(self._cluster_chunk, [chunk for chunk in self.chunked_keypoints], chunksize=self.chunks_per_thread)
+        return self._stitch_chunks(outputs, self._chunk_rects())
+
+
+def _cluster_chunk_task(args):
+    """
+    Pool worker for `AdaptiveChunkedHierarchicalClustering`, module level so only the chunk is pickled, not the clustering.
+    """
+    chunk_idx, keypoints, max_merge_distance, metric = args
+    start = perf_counter()
+    hc = HierarchicalClustering(keypoints, max_merge_distance, metric)
+    clustered_keypoints = hc.run_clustering()
+    return chunk_idx, clustered_keypoints, hc.cluster_sizes, perf_counter() - start
+
+
+class AdaptiveChunkedHierarchicalClustering(BaseChunkedHierarchicalClustering):
+    """
+    Like `ChunkedHierarchicalClusteringMultithreaded`, but the chunks come from a k-d split of the keypoints instead
+    of a fixed grid, so each holds about the same number of keypoints however they're spread over the image.
+    Chunks are clustered largest first and collected as they finish, then stitched across the seams.
+    """
+    def __init__(
+        self, img_dim: tuple[int, int], keypoints: Union[list[KeyPoint], KeypointSet], max_chunk_keypoints: Optional[int] = None,
+        max_merge_dist: int = 25, edge_merge_dist: Optional[int] = None, processes: Optional[int] = None,
+        tasks_per_process: int = 4, pool: Optional[Pool] = None, metric: str = "cityblock"
+    ) -> None:
+        """
+        :param max_chunk_keypoints: Chunks with more keypoints are split. By default, sized for `tasks_per_process`
+            chunks per process.
+        :param pool: Reused instead of starting a pool per run.
+        """
+        self.processes = processes or multiprocessing.cpu_count()
+        self.max_chunk_keypoints = max_chunk_keypoints or max(1, -(-len(keypoints) // (self.processes * tasks_per_process)))
+        self.pool = pool
+        self.task_stats: list[ChunkTaskStats] = []
+        super().__init__(img_dim, keypoints, (1, 1), max_merge_dist, edge_merge_dist, metric)
+
+    def _init_keypoint_chunks(self, keypoints):
+        self.chunk_rects = []
+        chunk_idxs = []
+        self._split_rect((0, self.img_dim[0], 0, self.img_dim[1]), np.arange(len(keypoints)), keypoint_coords(keypoints), chunk_idxs)
+        self.chunked_keypoints = [take_keypoints(keypoints, idxs) for idxs in chunk_idxs]
+
+    def _split_rect(self, rect: tuple[int, int, int, int], idxs: np.ndarray, coords: np.ndarray, chunk_idxs: list) -> None:
+        """
+        Splits the longer side of `rect` at the median keypoint until each part has at most max_chunk_keypoints.
+        """
+        row_start, row_end, col_start, col_end = rect
+        axis = 0 if row_end - row_start >= col_end - col_start else 1
+        if len(idxs) > self.max_chunk_keypoints:
+            split = int(np.median(coords[idxs, axis]))
+            is_before = coords[idxs, axis] < split
+            # A split that leaves one side empty (many keypoints on the median line) can't balance anything.
+            if is_before.any() and not is_before.all():
+                before, after = list(rect), list(rect)
+                before[2 * axis + 1] = split
+                after[2 * axis] = split
+                self._split_rect(tuple(before), idxs[is_before], coords, chunk_idxs)
+                self._split_rect(tuple(after), idxs[~is_before], coords, chunk_idxs)
+                return
+        self.chunk_rects.append(rect)
+        chunk_idxs.append(idxs)
+
+    def chunk_size_histogram(self, bins=10) -> tuple[np.ndarray, np.ndarray]:
+        """
+        np.histogram of the number of keypoints per chunk.
+        """
+        return np.histogram([len(chunk) for chunk in self.chunked_keypoints], bins=bins)
+
+    def _run_tasks(self, pool: Pool) -> list:
+        # Largest first, so a big chunk doesn't start last while the other workers are idle.
+        task_order = sorted(range(len(self.chunked_keypoints)), key=lambda chunk_idx: -len(self.chunked_keypoints[chunk_idx]))
+        tasks = [
+            (chunk_idx, self.chunked_keypoints[chunk_idx], self.max_merge_distance, self.metric) for chunk_idx in task_order
+        ]
+        outputs = [None] * len(tasks)
+        self.task_stats = []
+        for chunk_idx, clustered_keypoints, cluster_sizes, seconds in pool.imap_unordered(_cluster_chunk_task, tasks):
+            outputs[chunk_idx] = (clustered_keypoints, cluster_sizes)
+            self.task_stats.append(ChunkTaskStats(chunk_idx, len(self.chunked_keypoints[chunk_idx]), len(clustered_keypoints), seconds))
+        return outputs
+
+    def run_clustering(self):
+        if self.pool is not None:
+            outputs = self._run_tasks(self.pool)
+        else:
+            with multiprocessing.Pool(self.processes) as pool:
+                outputs = self._run_tasks(pool)
+        return self._stitch_chunks(outputs, self.chunk_rects)
+
+
+class ChunkedLinkageClustering(BaseChunkedHierarchicalClustering):
+    """
+    `LinkageClustering` on a grid of chunks, so each distance matrix is a chunk's rather than the whole image's.
+
+    Under every linkage, a cluster can only merge across a seam if one of its keypoints is within max_merge_distance
+    of the seam (for ward, the ward height is never shorter than the centroid distance). The chunk clusters with such
+    a keypoint are dissolved and clustered again, which is exact for single linkage. Dissolved clusters are grouped by
+    the seams they can merge across, so each re-clustering only spans a few neighbouring chunks.
+    """
+    def __init__(
+        self, img_dim: tuple[int, int], keypoints: Union[list[KeyPoint], KeypointSet], chunks_dim: tuple[int, int] = (4, 4),
+        max_merge_dist: int = 25, method: str = "average", metric: str = "euclidean"
+    ) -> None:
+        self.method = method
+        super().__init__(img_dim, keypoints, chunks_dim, max_merge_dist, metric=metric)
+
+    def _init_keypoint_chunks(self, keypoints):
+        h_chunks, w_chunks = self._keypoint_chunk_idxs(keypoints)
+        flat_chunk_idxs = h_chunks * self.chunks_dim[1] + w_chunks
+        self.chunk_keypoint_idxs = [
+            np.flatnonzero(flat_chunk_idxs == chunk_idx) for chunk_idx in range(self.chunks_dim[0] * self.chunks_dim[1])
+        ]
+
+    def _cluster_labels(self, idxs: np.ndarray, coords: np.ndarray) -> np.ndarray:
+        """
+        Clusters the keypoints `idxs`, labelling each with the smallest keypoint index in its cluster.
+        """
+        if len(idxs) == 0:
+            return idxs
+        dendrogram = Dendrogram(take_keypoints(self._keypoints, idxs), linkage_matrix(coords[idxs], self.method, self.metric))
+        _, inverse = np.unique(dendrogram.labels(dendrogram.num_merges_within(self.max_merge_distance)), return_inverse=True)
+        first_idxs = np.full(inverse.max() + 1, len(coords), dtype=np.int64)
+        np.minimum.at(first_idxs, inverse, idxs)
+        return first_idxs[inverse]
+
+    def _seam_groups(self, coords: np.ndarray, labels: np.ndarray, near_seam: np.ndarray) -> np.ndarray:
+        """
+        Labels each chunk cluster (by its label) with the smallest label of the clusters it can merge with across seams.
+        Two clusters in neighbouring chunks are joined if any of their near seam keypoints are within
+        max_merge_distance of each other, which every linkage needs before it can merge them.
+        """
+        rects = self._chunk_rects()
+        idxs1 = [np.empty(0, dtype=np.int64)]
+        idxs2 = [np.empty(0, dtype=np.int64)]
+        for chunk_h in range(self.chunks_dim[0]):
+            for chunk_w in range(self.chunks_dim[1]):
+                chunk_idx = chunk_h * self.chunks_dim[1] + chunk_w
+                # Each neighbouring pair once, including diagonal ones.
+                for d_h, d_w in ((0, 1), (1, -1), (1, 0), (1, 1)):
+                    if not (0 <= chunk_h + d_h < self.chunks_dim[0] and 0 <= chunk_w + d_w < self.chunks_dim[1]):
+                        continue
+                    neighbour_idx = chunk_idx + d_h * self.chunks_dim[1] + d_w
+                    band_idxs1 = self._band_idxs(coords, near_seam, chunk_idx, rects[neighbour_idx])
+                    band_idxs2 = self._band_idxs(coords, near_seam, neighbour_idx, rects[chunk_idx])
+                    if len(band_idxs1) == 0 or len(band_idxs2) == 0:
+                        continue
+                    distances = pairwise_distances(coords[np.r_[band_idxs1, band_idxs2]], self.metric)
+                    pairs1, pairs2 = np.nonzero(distances[:len(band_idxs1), len(band_idxs1):] <= self.max_merge_distance)
+                    idxs1.append(labels[band_idxs1[pairs1]])
+                    idxs2.append(labels[band_idxs2[pairs2]])
+        return connected_component_labels(len(coords), np.concatenate(idxs1), np.concatenate(idxs2))
+
+    def _band_idxs(self, coords: np.ndarray, near_seam: np.ndarray, chunk_idx: int, rect: tuple[int, int, int, int]) -> np.ndarray:
+        """
+        Near seam keypoints of the chunk that are within max_merge_distance (Chebyshev, the shortest metric) of `rect`.
+        """
+        idxs = self.chunk_keypoint_idxs[chunk_idx]
+        idxs = idxs[near_seam[idxs]]
+        row_start, row_end, col_start, col_end = rect
+        row_gaps = np.maximum(np.maximum(row_start - coords[idxs, 0], coords[idxs, 0] - (row_end - 1)), 0)
+        col_gaps = np.maximum(np.maximum(col_start - coords[idxs, 1], coords[idxs, 1] - (col_end - 1)), 0)
+        return idxs[np.maximum(row_gaps, col_gaps) <= self.max_merge_distance]
+
+    def _neighbourhood_size_bound(self) -> int:
+        """
+        Most keypoints in any 2x2 block of chunks, which a seam group shouldn't need to exceed.
+        """
+        chunk_sizes = np.array([len(idxs) for idxs in self.chunk_keypoint_idxs]).reshape(self.chunks_dim)
+        block_sizes = np.pad(chunk_sizes, ((0, 1), (0, 1)))
+        block_sizes = block_sizes[:-1, :-1] + block_sizes[1:, :-1] + block_sizes[:-1, 1:] + block_sizes[1:, 1:]
+        return int(block_sizes.max())
+
+    def run_clustering(self):
+        coords = keypoint_coords(self._keypoints)
+        labels = np.zeros(len(coords), dtype=np.int64)
+        near_seam = np.zeros(len(coords), dtype=bool)
+        for rect, idxs in zip(self._chunk_rects(), self.chunk_keypoint_idxs):
+            labels[idxs] = self._cluster_labels(idxs, coords)
+            near_seam[idxs] = self._near_seam(coords[idxs], rect)
+        dissolved_idxs = np.flatnonzero(np.isin(labels, labels[near_seam]))
+        groups = self._seam_groups(coords, labels, near_seam)[labels[dissolved_idxs]]
+        _, group_inverse, group_sizes = np.unique(groups, return_inverse=True, return_counts=True)
+        if len(group_sizes) > 0 and group_sizes.max() > self._neighbourhood_size_bound():
+            raise ValueError(
+                f"Clusters chain across seams into a group of {group_sizes.max()} keypoints, more than any 2x2 block of "
+                f"chunks holds ({self._neighbourhood_size_bound()}). Use fewer chunks or a smaller max_merge_dist"
+            )
+        order = np.argsort(group_inverse, kind='stable')
+        for group_idxs in np.split(dissolved_idxs[order], np.cumsum(group_sizes)[:-1]):
+            # A group of one chunk cluster would come out unchanged.
+            if len(np.unique(labels[group_idxs])) > 1:
+                labels[group_idxs] = self._cluster_labels(group_idxs, coords)
+
+        ref_idxs, inverse = np.unique(labels, return_inverse=True)
+        self.cluster_sizes = np.bincount(inverse, minlength=len(ref_idxs)).astype(np.int64)
+        centers = np.column_stack([
+            np.bincount(inverse, weights=coords[:, axis], minlength=len(ref_idxs)) for axis in range(2)
+        ]) / np.maximum(self.cluster_sizes, 1)[:, np.newaxis]
+        return cluster_centers_as_keypoints(self._keypoints, ref_idxs, centers)
@@ -0,0 +1,168 @@
+from photogrammetry.models.keypoint import KeyPoint
+from photogrammetry.models.keypoint_set import KeypointSet, keypoint_coords
+from photogrammetry.clustering.dendrogram import Dendrogram, centroid_linkage
+import numpy as np
+from typing import Union
+
+LINKAGE_METHODS = ("single", "complete", "average", "centroid", "ward")
+DISTANCE_METRICS = ("euclidean", "cityblock", "chebyshev")
+_METRIC_ALIASES = {"manhattan": "cityblock"}
+# Rows of the distance matrix computed at once.
+_DISTANCE_BLOCK_ROWS = 1024
+
+
+def normalize_metric(metric: str) -> str:
+    metric = _METRIC_ALIASES.get(metric, metric)
+    if metric not in DISTANCE_METRICS:
+        raise ValueError(f"Unknown metric {metric}, expected one of {DISTANCE_METRICS + tuple(_METRIC_ALIASES)}")
+    return metric
+
+
+def point_distances(coords: np.ndarray, point: np.ndarray, metric: str = "cityblock") -> np.ndarray:
+    """
+    Distances from each of the (N, 2) coords to `point`.
+    """
+    differences = np.abs(np.asarray(coords) - point)
+    if metric == "cityblock":
+        return differences.sum(axis=1)
+    if metric == "euclidean":
+        return np.sqrt((differences * differences).sum(axis=1))
+    if metric == "chebyshev":
+        return differences.max(axis=1)
+    raise ValueError(f"Unknown metric {metric}")
+
+
+def pairwise_distances(coords: np.ndarray, metric: str = "euclidean") -> np.ndarray:
+    """
+    (N, N) float64 distances between all coords.
+    """
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    distances = np.empty((len(coords), len(coords)), dtype=np.float64)
+    for start in range(0, len(coords), _DISTANCE_BLOCK_ROWS):
+        differences = np.abs(coords[start:start + _DISTANCE_BLOCK_ROWS, np.newaxis] - coords[np.newaxis])
+        if metric == "cityblock":
+            distances[start:start + _DISTANCE_BLOCK_ROWS] = differences.sum(axis=2)
+        elif metric == "euclidean":
+            distances[start:start + _DISTANCE_BLOCK_ROWS] = np.sqrt((differences * differences).sum(axis=2))
+        elif metric == "chebyshev":
+            distances[start:start + _DISTANCE_BLOCK_ROWS] = differences.max(axis=2)
+        else:
+            raise ValueError(f"Unknown metric {metric}")
+    return distances
+
+
+def lance_williams_linkage(coords: np.ndarray, method: str = "average", metric: str = "euclidean") -> np.ndarray:
+    """
+    Agglomerative clustering of all coords into one cluster, updating the distance matrix in place with the
+    Lance-Williams formula for `method` instead of recomputing distances from the merged clusters.
+
+    Centroid and ward linkage are only defined for the Euclidean metric, and run on squared distances.
+    Takes O(N^2) memory for the distance matrix, so it's meant for chunks of up to ~10k keypoints,
+    see `ChunkedLinkageClustering` for whole images.
+    :return: (N - 1, 4) SciPy layout linkage matrix [cluster 1, cluster 2, distance, num keypoints], where row i
+        creates cluster N + i.
+    """
+    if method not in LINKAGE_METHODS:
+        raise ValueError(f"Unknown linkage {method}, expected one of {LINKAGE_METHODS}")
+    metric = normalize_metric(metric)
+    is_squared = method in ("centroid", "ward")
+    if is_squared and metric != "euclidean":
+        raise ValueError(f"{method} linkage needs the euclidean metric, not {metric}")
+    num_keypoints = len(coords)
+    z = np.zeros((max(num_keypoints - 1, 0), 4), dtype=np.float64)
+    if num_keypoints < 2:
+        return z
+
+    distances = pairwise_distances(coords, metric)
+    if is_squared:
+        distances *= distances
+    np.fill_diagonal(distances, np.inf)
+    # Each slot holds one active cluster, a merged cluster takes the slot of the smaller of its two.
+    slot_ids = np.arange(num_keypoints)
+    sizes = np.ones(num_keypoints, dtype=np.float64)
+    is_active = np.ones(num_keypoints, dtype=bool)
+    nn_slots = np.argmin(distances, axis=1)
+    nn_dists = distances[np.arange(num_keypoints), nn_slots]
+
+    for merge_idx in range(len(z)):
+        slot_1 = int(np.argmin(nn_dists))
+        slot_2 = int(nn_slots[slot_1])
+        slot_1, slot_2 = min(slot_1, slot_2), max(slot_1, slot_2)
+        merge_dist = distances[slot_1, slot_2]
+        size_1, size_2 = sizes[slot_1], sizes[slot_2]
+        dists_1, dists_2 = distances[slot_1], distances[slot_2]
+
+        if method == "single":
+            new_dists = np.minimum(dists_1, dists_2)
+        elif method == "complete":
+            new_dists = np.maximum(dists_1, dists_2)
+        elif method == "average":
+            new_dists = (size_1 * dists_1 + size_2 * dists_2) / (size_1 + size_2)
+        elif method == "centroid":
+            new_dists = (size_1 * dists_1 + size_2 * dists_2) / (size_1 + size_2) - size_1 * size_2 * merge_dist / (size_1 + size_2) ** 2
+        else:
+            new_dists = ((size_1 + sizes) * dists_1 + (size_2 + sizes) * dists_2 - sizes * merge_dist) / (size_1 + size_2 + sizes)
+        is_active[slot_2] = False
+        new_dists[~is_active] = np.inf
+        new_dists[slot_1] = np.inf
+
+        cluster_ids = sorted((slot_ids[slot_1], slot_ids[slot_2]))
+        z[merge_idx] = [cluster_ids[0], cluster_ids[1], np.sqrt(merge_dist) if is_squared else merge_dist, size_1 + size_2]
+        slot_ids[slot_1] = num_keypoints + merge_idx
+        sizes[slot_1] = size_1 + size_2
+        distances[slot_1] = new_dists
+        distances[:, slot_1] = new_dists
+        # The column of slot_2 is left stale, rescans mask inactive slots instead of writing a strided column.
+        distances[slot_2] = np.inf
+        nn_dists[slot_2] = np.inf
+
+        # Distances to the merged cluster can grow (complete, ward), so clusters that had either as their
+        # nearest neighbour are rescanned, others only need checking against the merged cluster.
+        lost_neighbour = is_active & ((nn_slots == slot_1) | (nn_slots == slot_2))
+        lost_neighbour[slot_1] = True
+        is_closer = new_dists < nn_dists
+        nn_slots[is_closer] = slot_1
+        nn_dists[is_closer] = new_dists[is_closer]
+        rescan_slots = np.flatnonzero(lost_neighbour)
+        rescan_dists = np.where(is_active, distances[rescan_slots], np.inf)
+        nn_slots[rescan_slots] = np.argmin(rescan_dists, axis=1)
+        nn_dists[rescan_slots] = rescan_dists[np.arange(len(rescan_slots)), nn_slots[rescan_slots]]
+    return z
+
+
+def linkage_matrix(coords: np.ndarray, method: str = "centroid", metric: str = "cityblock") -> np.ndarray:
+    """
+    SciPy layout linkage matrix of `coords`. Centroid linkage with the city block distance, what
+    `HierarchicalClustering` uses, isn't a Lance-Williams update so it takes the `centroid_linkage` path. Other
+    centroid and ward linkages need the euclidean metric, see `lance_williams_linkage`.
+    """
+    metric = normalize_metric(metric)
+    if method == "centroid" and metric == "cityblock":
+        return centroid_linkage(coords)[0]
+    return lance_williams_linkage(coords, method, metric)
+
+
+class LinkageClustering:
+    """
+    Clusters keypoints with a choice of linkage and metric, stopping at the first merge further apart than
+    `max_merge_distance`. For ward linkage the distance is SciPy's ward height rather than a pixel distance.
+    Builds one distance matrix of all the keypoints, use `ChunkedLinkageClustering` for a whole image's keypoints.
+    """
+    def __init__(
+        self, keypoints: Union[list[KeyPoint], KeypointSet], max_merge_distance: int = 25, method: str = "average",
+        metric: str = "euclidean"
+    ) -> None:
+        self.max_merge_distance = max_merge_distance
+        self.method = method
+        self.metric = normalize_metric(metric)
+        self._keypoints = keypoints
+        self.cluster_sizes = np.zeros(0, dtype=np.int64)
+        self.dendrogram = None
+
+    def run_clustering(self) -> Union[list[KeyPoint], KeypointSet]:
+        if self.dendrogram is None:
+            z = linkage_matrix(keypoint_coords(self._keypoints), self.method, self.metric)
+            self.dendrogram = Dendrogram(self._keypoints, z)
+        clustered_keypoints = self.dendrogram.cut(self.max_merge_distance)
+        self.cluster_sizes = self.dendrogram.cluster_sizes
+        return clustered_keypoints
@@ -0,0 +1,147 @@
+from photogrammetry.models.keypoint import KeyPoint
+from photogrammetry.models.keypoint_set import KeypointSet, keypoint_coords, cluster_centers_as_keypoints
+from photogrammetry.utils.arrays import expand_ranges
+import numpy as np
+from typing import Union
+
+# Bounds the candidate pair arrays generated at once.
+MAX_PAIRS_PER_BATCH = 1 << 22
+
+
+def _cross_cell_offsets(max_distance: int, cell_size: int) -> list[tuple[int, int]]:
+    """
+    (row, col) cell offsets whose cells may hold points within max_distance, one of each +/- pair.
+    """
+    max_offset = max_distance // cell_size + 1
+    offsets = []
+    for d_row in range(0, max_offset + 1):
+        for d_col in range(-max_offset, max_offset + 1):
+            if d_row == 0 and d_col <= 0:
+                continue
+            # Smallest city block distance between points of the two cells.
+            row_gap = max(d_row * cell_size - (cell_size - 1), 0)
+            col_gap = max(abs(d_col) * cell_size - (cell_size - 1), 0)
+            if row_gap + col_gap <= max_distance:
+                offsets.append((d_row, d_col))
+    return offsets
+
+
+def single_linkage_labels(coords: np.ndarray, max_distance: int) -> np.ndarray:
+    """
+    Labels each coord with the smallest index of its cluster, where coords within `max_distance` (city block)
+    of each other are in the same cluster, transitively.
+
+    Coords are bucketed into a hash grid of max_distance // 2 + 1 sized cells. No two integer coords of a cell can be
+    further apart than max_distance, so each cell is already connected and only needs joining to its neighbours.
+    Two cells are joined if any pair of their points is close enough, which is checked for the few cell offsets that
+    can have such a pair, and the union-find then runs over cells rather than points.
+    """
+    coords = np.asarray(coords, dtype=np.int64).reshape(-1, 2)
+    if len(coords) == 0:
+        return np.empty(0, dtype=np.int64)
+    cell_size = max(int(max_distance), 0) // 2 + 1
+    offsets = _cross_cell_offsets(max_distance, cell_size)
+    max_offset = max_distance // cell_size + 1
+    cells = coords // cell_size
+    cells -= cells.min(axis=0) - max_offset  # Leaves an empty border so neighbour keys never wrap.
+    num_cols = cells[:, 1].max() + max_offset + 1
+    cell_keys = cells[:, 0] * num_cols + cells[:, 1]
+    # Working in cell order makes each cell's points a contiguous range.
+    order = np.argsort(cell_keys, kind='stable')
+    sorted_keys = cell_keys[order]
+    is_cell_start = np.r_[True, sorted_keys[1:] != sorted_keys[:-1]]
+    point_cells = np.cumsum(is_cell_start) - 1
+    cell_starts = np.flatnonzero(is_cell_start)
+    cell_counts = np.diff(np.r_[cell_starts, len(coords)])
+    cell_keys = sorted_keys[cell_starts]
+    rows = coords[order, 0].astype(np.int32)
+    cols = coords[order, 1].astype(np.int32)
+
+    cell_idxs1 = [np.empty(0, dtype=np.int64)]
+    cell_idxs2 = [np.empty(0, dtype=np.int64)]
+    for d_row, d_col in offsets:
+        neighbour_keys = cell_keys + d_row * num_cols + d_col
+        neighbour_cells = np.minimum(np.searchsorted(cell_keys, neighbour_keys), len(cell_keys) - 1)
+        has_neighbour = cell_keys[neighbour_cells] == neighbour_keys
+        positions = np.flatnonzero(has_neighbour[point_cells])
+        if len(positions) == 0:
+            continue
+        starts = cell_starts[neighbour_cells[point_cells[positions]]]
+        counts = cell_counts[neighbour_cells[point_cells[positions]]]
+        # Expanding the pairs of a few points at a time keeps dense clusters from allocating every pair at once.
+        cumulative_counts = np.cumsum(counts)
+        batch_ends = np.searchsorted(
+            cumulative_counts, np.arange(1, cumulative_counts[-1] // MAX_PAIRS_PER_BATCH + 1) * MAX_PAIRS_PER_BATCH
+        )
+        for start, end in zip(np.r_[0, batch_ends], np.r_[batch_ends, len(positions)]):
+            pair_positions1 = np.repeat(positions[start:end], counts[start:end])
+            pair_positions2 = expand_ranges(starts[start:end], counts[start:end])
+            distances = np.abs(rows[pair_positions1] - rows[pair_positions2]) + np.abs(cols[pair_positions1] - cols[pair_positions2])
+            # Pairs are in cell order, so each joined cell appears as one run.
+            joined_cells = point_cells[pair_positions1[distances <= max_distance]]
+            joined_cells = joined_cells[np.r_[True, joined_cells[1:] != joined_cells[:-1]]] if len(joined_cells) else joined_cells
+            cell_idxs1.append(joined_cells)
+            cell_idxs2.append(neighbour_cells[joined_cells])
+
+    cell_labels = connected_component_labels(len(cell_keys), np.concatenate(cell_idxs1), np.concatenate(cell_idxs2))
+    labels = np.empty(len(coords), dtype=np.int64)
+    labels[order] = cell_labels[point_cells]
+    roots = np.full(len(cell_keys), len(coords), dtype=np.int64)
+    np.minimum.at(roots, labels, np.arange(len(coords)))
+    return roots[labels]
+
+
+def connected_component_labels(num_items: int, idxs1: np.ndarray, idxs2: np.ndarray) -> np.ndarray:
+    """
+    Labels each item with the smallest item index of its connected component, given the edges (idxs1[i], idxs2[i]).
+
+    Vectorized union-find: every edge hooks the larger of its two roots onto the smaller, then pointer jumping
+    flattens the trees, until no edge joins two different roots.
+    """
+    labels = np.arange(num_items)
+    while len(idxs1) > 0:
+        labels1 = labels[idxs1]
+        labels2 = labels[idxs2]
+        is_unjoined = labels1 != labels2
+        if not is_unjoined.any():
+            break
+        idxs1 = idxs1[is_unjoined]
+        idxs2 = idxs2[is_unjoined]
+        labels1 = labels1[is_unjoined]
+        labels2 = labels2[is_unjoined]
+        np.minimum.at(labels, np.maximum(labels1, labels2), np.minimum(labels1, labels2))
+        while True:
+            jumped = labels[labels]
+            if np.array_equal(jumped, labels):
+                break
+            labels = jumped
+    return labels
+
+
+class SingleLinkageClustering:
+    """
+    Merges every pair of keypoints within `max_merge_distance` (city block), transitively, and replaces each cluster
+    with a keypoint at its centroid. Keypoint coords are assumed to be integers.
+
+    Unlike `HierarchicalClustering` the merge order doesn't matter, so chains of close keypoints become one cluster
+    even when its extent exceeds max_merge_distance. Meant for de-duplicating raw FAST responses.
+    """
+    def __init__(self, keypoints: Union[list[KeyPoint], KeypointSet], max_merge_distance: int = 25) -> None:
+        self.max_merge_distance = max_merge_distance
+        self.num_keypoints = len(keypoints)
+        self._keypoints = keypoints
+        # Per keypoint, the index of its cluster, clusters ordered by their first keypoint.
+        self.labels = np.zeros(self.num_keypoints, dtype=np.int64)
+        self.cluster_sizes = np.zeros(0, dtype=np.int64)
+
+    def run_clustering(self) -> Union[list[KeyPoint], KeypointSet]:
+        # 105k raw FAST points in 4000x3000 ~ 0.3 seconds.
+        coords = keypoint_coords(self._keypoints)
+        roots = single_linkage_labels(coords, self.max_merge_distance)
+        # Each root is the smallest index in its cluster, so it also serves as the reference keypoint.
+        ref_idxs, self.labels = np.unique(roots, return_inverse=True)
+        self.cluster_sizes = np.bincount(self.labels, minlength=len(ref_idxs))
+        centers = np.column_stack([
+            np.bincount(self.labels, weights=coords[:, axis], minlength=len(ref_idxs)) for axis in range(2)
+        ]) / np.maximum(self.cluster_sizes, 1)[:, np.newaxis]
+        return cluster_centers_as_keypoints(self._keypoints, ref_idxs, centers)
@@ -0,0 +1,171 @@
+import numpy as np
+from typing import Optional
+
+# Keypoints per batch, bounds the (N, num_pairs, 2) index arrays to a few tens of MB.
+DESCRIPTOR_BATCH_SIZE = 4096
+# Radius of the circular patch the intensity centroid is computed over. Matches ORB.
+ORIENTATION_PATCH_RADIUS = 15
+# Steered BRIEF rotates the pattern in steps of 2pi / NUM_ANGLE_BINS (12 degrees).
+NUM_ANGLE_BINS = 30
+
+# Maps (pattern bytes, num_bins) to the pattern rotated into each angle bin, see `steered_pair_tables`.
+_steered_pair_tables_cache = {}
+
+
+def _circular_patch_offsets(radius: int) -> tuple[np.ndarray, np.ndarray]:
+    du, dv = np.mgrid[-radius:radius + 1, -radius:radius + 1]
+    in_circle = du ** 2 + dv ** 2 <= radius ** 2
+    return du[in_circle], dv[in_circle]
+
+
+def intensity_centroid_orientations(bw_image: np.ndarray, coords: np.ndarray, patch_radius: int = ORIENTATION_PATCH_RADIUS) -> np.ndarray:
+    """
+    Orientation of each keypoint by intensity centroid, arctan2(m01, m10), over a circular patch.
+    Angles are in radians measured from the height axis towards the width axis, which is the rotation
+    `steered_pair_tables` applies. Patch pixels outside of the image repeat the border.
+    https://iopscience.iop.org/article/10.1088/1742-6596/1693/1/012068/pdf
+    """
+    coords = np.asarray(coords, dtype=np.int64).reshape(-1, 2)
+    height, width = bw_image.shape
+    du, dv = _circular_patch_offsets(patch_radius)
+    orientations = np.zeros(len(coords), dtype=np.float64)
+    for start in range(0, len(coords), DESCRIPTOR_BATCH_SIZE):
+        batch = coords[start:start + DESCRIPTOR_BATCH_SIZE]
+        patches = bw_image[
+            np.clip(batch[:, 0:1] + du, 0, height - 1),
+            np.clip(batch[:, 1:2] + dv, 0, width - 1)
+        ].astype(np.float64)
+        # m10 = sum(du * I), m01 = sum(dv * I)
+        orientations[start:start + len(batch)] = np.arctan2(patches @ dv, patches @ du)
+    return orientations
+
+
+def steered_pair_tables(gaussian_pairs: np.ndarray, num_bins: int = NUM_ANGLE_BINS) -> np.ndarray:
+    """
+    Returns the (num_bins, num_pairs, 2, 2) pattern rotated to each angle bin, bin i is 2pi * i / num_bins.
+    Tables are cached per pattern so that no trigonometry runs at description time.
+    """
+    key = (gaussian_pairs.tobytes(), gaussian_pairs.shape, num_bins)
+    if key not in _steered_pair_tables_cache:
+        angles = 2 * np.pi * np.arange(num_bins) / num_bins
+        cos = np.cos(angles)[:, np.newaxis, np.newaxis]
+        sin = np.sin(angles)[:, np.newaxis, np.newaxis]
+        du = gaussian_pairs[np.newaxis, ..., 0]
+        dv = gaussian_pairs[np.newaxis, ..., 1]
+        tables = np.stack([du * cos - dv * sin, du * sin + dv * cos], axis=-1)
+        _steered_pair_tables_cache[key] = np.rint(tables).astype(np.int64)
+    return _steered_pair_tables_cache[key]
+
+
+def angle_bins(orientations: np.ndarray, num_bins: int = NUM_ANGLE_BINS) -> np.ndarray:
+    return np.rint(np.asarray(orientations) * num_bins / (2 * np.pi)).astype(np.int64) % num_bins
+
+
+def compute_brief_descriptors(
+    bw_image: np.ndarray, coords: np.ndarray, gaussian_pairs: np.ndarray, pattern_bins: Optional[np.ndarray] = None
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Computes the BRIEF descriptor of every keypoint at once.
+
+    :param coords: (N, 2) (height, width) keypoint coords.
+    :param gaussian_pairs: (num_pairs, 2, 2) pair offsets shared by every keypoint. When `pattern_bins` is given,
+        a (num_bins, num_pairs, 2, 2) table of patterns, e.g. from `steered_pair_tables`.
+    :param pattern_bins: (N,) index of the pattern in `gaussian_pairs` to use for each keypoint.
+    :return: (N, num_pairs // 8) uint8 descriptors, bit packed in little bit order so that bit `idx` of the packed row
+        is pair `idx` (the same layout as `KeyPoint.descriptor`'s int), and a (N, num_pairs) mask of the pairs that
+        fell inside the image. Pairs outside of the image are left as 0 bits.
+    """
+    coords = np.asarray(coords, dtype=np.int64).reshape(-1, 2)
+    gaussian_pairs = np.asarray(gaussian_pairs, dtype=np.int64)
+    num_pairs = gaussian_pairs.shape[-3]
+    height, width = bw_image.shape
+    descriptors = np.zeros((len(coords), (num_pairs + 7) // 8), dtype=np.uint8)
+    valid = np.zeros((len(coords), num_pairs), dtype=bool)
+
+    for start in range(0, len(coords), DESCRIPTOR_BATCH_SIZE):
+        end = min(start + DESCRIPTOR_BATCH_SIZE, len(coords))
+        pairs = gaussian_pairs[pattern_bins[start:end]] if pattern_bins is not None else gaussian_pairs[np.newaxis]
+        # (batch, num_pairs, 2) absolute positions of the first and second point of each pair.
+        points_1 = coords[start:end, np.newaxis, :] + pairs[..., 0, :]
+        points_2 = coords[start:end, np.newaxis, :] + pairs[..., 1, :]
+        in_bounds = (
+            (points_1[..., 0] >= 0) & (points_1[..., 0] < height) & (points_1[..., 1] >= 0) & (points_1[..., 1] < width) &
+            (points_2[..., 0] >= 0) & (points_2[..., 0] < height) & (points_2[..., 1] >= 0) & (points_2[..., 1] < width)
+        )
+        # Clip so out of bounds pairs can still be gathered, they are masked out below.
+        p1 = bw_image[np.clip(points_1[..., 0], 0, height - 1), np.clip(points_1[..., 1], 0, width - 1)]
+        p2 = bw_image[np.clip(points_2[..., 0], 0, height - 1), np.clip(points_2[..., 1], 0, width - 1)]
+        descriptors[start:end] = np.packbits((p1 < p2) & in_bounds, axis=1, bitorder='little')
+        valid[start:end] = in_bounds
+    return descriptors, valid
+
+
+def descriptor_to_int(descriptor: np.ndarray) -> int:
+    """
+    Converts one packed descriptor row back into the int format used by `KeyPoint.descriptor`.
+    """
+    return int.from_bytes(descriptor.tobytes(), 'little')
+
+
+def compute_steered_brief_descriptors(
+    bw_image: np.ndarray, coords: np.ndarray, orientations: np.ndarray, gaussian_pairs: np.ndarray, num_bins: int = NUM_ANGLE_BINS
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Rotation-steered BRIEF. Each keypoint's pattern is the precomputed table for its orientation's angle bin.
+    """
+    tables = steered_pair_tables(gaussian_pairs, num_bins)
+    return compute_brief_descriptors(bw_image, coords, tables, angle_bins(orientations, num_bins))
+
+
+def compute_keypoint_descriptors(
+    keypoints: list, steered: bool = False, num_bins: int = NUM_ANGLE_BINS, num_pairs: int = 256
+) -> np.ndarray:
+    """
+    Batch computes the descriptors of a list of `KeyPoint`s and stores them on the keypoints,
+    grouping them by image so each grayscale image is fetched once.
+    Returns the (N, num_pairs // 8) packed descriptors in the same order as `keypoints`.
+    :param steered: Compute and store each keypoint's orientation, then rotate the pattern by it.
+    :param num_pairs: Only sizes the result when `keypoints` is empty, otherwise taken from the keypoints' pattern.
+    """
+    if len(keypoints) == 0:
+        return np.empty((0, (num_pairs + 7) // 8), dtype=np.uint8)
+    packed = np.zeros((len(keypoints), (len(keypoints[0]._gaussian_pairs) + 7) // 8), dtype=np.uint8)
+    keypoint_idxs_by_image = {}
+    for idx, keypoint in enumerate(keypoints):
+        keypoint_idxs_by_image.setdefault(keypoint._image_id, []).append(idx)
+    for image_id, idxs in keypoint_idxs_by_image.items():
+        ref_keypoint = keypoints[idxs[0]]
+        bw_image = ref_keypoint._image_db.get_bw_image(image_id)
+        coords = np.array([keypoints[idx].coord for idx in idxs])
+        if steered:
+            orientations = intensity_centroid_orientations(bw_image, coords)
+            for idx, orientation in zip(idxs, orientations):
+                keypoints[idx]._orientation = float(orientation)
+            descriptors, _ = compute_steered_brief_descriptors(bw_image, coords, orientations, ref_keypoint._gaussian_pairs, num_bins)
+        else:
+            descriptors, _ = compute_brief_descriptors(bw_image, coords, ref_keypoint._gaussian_pairs)
+        packed[idxs] = descriptors
+        for idx, descriptor in zip(idxs, descriptors):
+            keypoints[idx]._descriptor = descriptor_to_int(descriptor)
+    return packed
+
+
+def compute_keypoint_set_descriptors(
+    keypoint_set, image_db, gaussian_pairs: np.ndarray, pattern_id: Optional[str] = None, steered: bool = False, num_bins: int = NUM_ANGLE_BINS
+):
+    """
+    `KeypointSet` version of `compute_keypoint_descriptors`. Returns a new set with descriptors (and orientations if steered).
+    :param pattern_id: Id of `gaussian_pairs`, e.g. `FASTKeypointDetector.pattern_id`, recorded on the returned set.
+    """
+    descriptors = np.zeros((len(keypoint_set), (len(gaussian_pairs) + 7) // 8), dtype=np.uint8)
+    orientations = keypoint_set.orientations.copy()
+    for image_id in np.unique(keypoint_set.image_ids):
+        in_image = keypoint_set.image_ids == image_id
+        bw_image = image_db.get_bw_image(int(image_id))
+        coords = keypoint_set.coords[in_image]
+        if steered:
+            orientations[in_image] = intensity_centroid_orientations(bw_image, coords)
+            descriptors[in_image], _ = compute_steered_brief_descriptors(bw_image, coords, orientations[in_image], gaussian_pairs, num_bins)
+        else:
+            descriptors[in_image], _ = compute_brief_descriptors(bw_image, coords, gaussian_pairs)
+    return keypoint_set.with_descriptors(descriptors, pattern_id, orientations)
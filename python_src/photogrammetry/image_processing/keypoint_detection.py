@@ -1,8 +1,13 @@
 import numpy as np
 import time
 from photogrammetry.models.keypoint import KeyPoint, generate_gaussian_pairs
-from photogrammetry.storage.image_db import ImageDB
+from photogrammetry.models.keypoint_set import KeypointSet
+from photogrammetry.storage.image_db import ImageDB, open_bw_image_file
+from photogrammetry.storage.pattern_registry import DescriptorPatternRegistry, descriptor_pattern_id
 import multiprocessing
+from multiprocessing import shared_memory
+from multiprocessing.pool import ThreadPool
+from typing import Iterator, Optional
 """
 https://homepages.inf.ed.ac.uk/rbf/CVonline/LOCAL_COPIES/AV1011/AV1FeaturefromAcceleratedSegmentTest.pdf
 """
@@ -32,11 +37,155 @@ MINI_BRESENHAM_CIRCLE_3 = BRESENHAM_CIRCLE_3[[0, 4, 8, 12]]
 BRESENHAM_CIRCLE_3_TP = BRESENHAM_CIRCLE_3.transpose((1, 0))
 MINI_BRESENHAM_CIRCLE_3_TP = MINI_BRESENHAM_CIRCLE_3.transpose((1, 0))
 
+DETECTION_ENGINES = ("row", "vectorized")
+# Minimum number of contiguous ring points that must be outside of the threshold for a corner.
+MIN_ARC_LENGTH = 12
+
+
+def _build_arc_lut(arc_length: int = MIN_ARC_LENGTH) -> np.ndarray:
+    """
+    Lookup table from a 16 bit ring mask (bit i set when ring point i is outside of the threshold)
+    to whether the mask contains a circular run of at least `arc_length` set bits.
+    """
+    masks = np.arange(1 << 16, dtype=np.uint32)
+    doubled = masks | (masks << 16)
+    # Bit i survives only if bits i..i+arc_length-1 (wrapping around the ring) are all set.
+    acc = np.full_like(masks, 0xFFFF)
+    for shift in range(arc_length):
+        acc &= (doubled >> shift) & 0xFFFF
+    return acc != 0
+
+
+ARC_LUT = _build_arc_lut()
+
+
+def detect_segment_test_points(bw_img: np.ndarray, threshold) -> np.ndarray:
+    """
+    Vectorized version of `FASTKeypointDetector._process_row` run over every row of the image.
+    Returns the keypoints as a (N, 2) array of (height, width) coords in row-major order, excluding the 3 pixel border.
+
+    The quick test is run on shifted views of the whole image. Only the survivors have their full ring
+    fetched, packed into a 16 bit mask and checked against `ARC_LUT`.
+    """
+    height, width = bw_img.shape
+    if height <= 6 or width <= 6:
+        return np.empty((0, 2), dtype=np.int64)
+    center = bw_img[3:height-3, 3:width-3]
+    lower = center - threshold
+    upper = center + threshold
+
+    quick_num_inside_thresh = np.zeros(center.shape, dtype=np.uint8)
+    for du, dv in MINI_BRESENHAM_CIRCLE_3:
+        ring = bw_img[3+du:height-3+du, 3+dv:width-3+dv]
+        quick_num_inside_thresh += (ring > lower) & (ring < upper)
+    cand_u, cand_v = np.nonzero(quick_num_inside_thresh <= 1)
+    cand_u += 3
+    cand_v += 3
+
+    cand_lower = bw_img[cand_u, cand_v] - threshold
+    cand_upper = cand_lower + 2 * threshold
+    ring_mask = np.zeros(cand_u.shape, dtype=np.uint32)
+    for idx, (du, dv) in enumerate(BRESENHAM_CIRCLE_3):
+        ring = bw_img[cand_u + du, cand_v + dv]
+        outside = (ring <= cand_lower) | (ring >= cand_upper)
+        ring_mask |= outside.astype(np.uint32) << idx
+    is_keypoint = ARC_LUT[ring_mask]
+    return np.stack([cand_u[is_keypoint], cand_v[is_keypoint]], axis=1).astype(np.int64)
+
+
+def fast_corner_scores(bw_img: np.ndarray, coords: np.ndarray, threshold) -> np.ndarray:
+    """
+    FAST corner response for each (height, width) coord. This is the sum of absolute differences between the
+    ring and the center intensity, less the threshold, over the ring points that are outside of the threshold.
+    """
+    scores = np.zeros(len(coords), dtype=np.int32)
+    if len(coords) == 0:
+        return scores
+    u = coords[:, 0]
+    v = coords[:, 1]
+    center = bw_img[u, v].astype(np.int32)
+    for du, dv in BRESENHAM_CIRCLE_3:
+        diff = np.abs(bw_img[u + du, v + dv] - center) - threshold
+        scores += np.maximum(diff, 0)
+    return scores
+
+
+def non_maximum_suppression(coords: np.ndarray, scores: np.ndarray, image_dim: tuple[int, int], radius: int = 1) -> np.ndarray:
+    """
+    Returns a mask of the coords which have the highest score in their (2 * radius + 1)^2 window.
+    Ties are kept by the point that comes first in row-major order so plateaus are not dropped entirely.
+    """
+    keep = np.ones(len(coords), dtype=bool)
+    if len(coords) == 0 or radius <= 0:
+        return keep
+    height, width = image_dim
+    # Pad by radius so neighbour lookups never leave the array. -1 marks "not a candidate" as scores are >= 0.
+    score_img = np.full((height + 2 * radius, width + 2 * radius), -1, dtype=np.int32)
+    u = coords[:, 0] + radius
+    v = coords[:, 1] + radius
+    score_img[u, v] = scores
+    for du in range(-radius, radius + 1):
+        for dv in range(-radius, radius + 1):
+            if du == 0 and dv == 0:
+                continue
+            neighbour = score_img[u + du, v + dv]
+            if du < 0 or (du == 0 and dv < 0):
+                keep &= neighbour < scores
+            else:
+                keep &= neighbour <= scores
+    return keep
+
+
+def score_and_suppress(bw_img: np.ndarray, coords: np.ndarray, threshold, nms_radius: Optional[int] = None) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Scores the detected coords and, if `nms_radius` is set, drops those which are not the local maximum.
+    """
+    scores = fast_corner_scores(bw_img, coords, threshold)
+    if not nms_radius:
+        return coords, scores
+    is_max = non_maximum_suppression(coords, scores, bw_img.shape, nms_radius)
+    return coords[is_max], scores[is_max]
+
+
+def _detect_level(args: tuple[np.ndarray, int, Optional[int]]) -> tuple[np.ndarray, np.ndarray]:
+    bw_img, threshold, nms_radius = args
+    return score_and_suppress(bw_img, detect_segment_test_points(bw_img, threshold), threshold, nms_radius)
+
+
+def detect_points_in_bands(
+    bw_img: np.ndarray, threshold, band_height: int = 512, nms_radius: Optional[int] = None
+) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+    """
+    Runs the vectorized segment test over horizontal bands of `bw_img`, yielding (coords, scores) for each band.
+    Coords are in full image (height, width) coordinates and the union of the bands matches a full-image run.
+
+    `bw_img` may be a memory-mapped array (see `open_bw_image_file`), in which case only
+    `band_height` rows plus a halo of 3 (+ nms_radius) rows on each side are read in at once.
+    """
+    height, _ = bw_img.shape
+    # 3 rows for the Bresenham circle. NMS also needs the candidates within nms_radius of the band.
+    halo = 3 + (nms_radius or 0)
+    for row_start in range(3, height - 3, band_height):
+        row_end = min(row_start + band_height, height - 3)
+        read_start = max(row_start - halo, 0)
+        band = np.asarray(bw_img[read_start:min(row_end + halo, height)], dtype=np.int16)
+        coords, scores = score_and_suppress(band, detect_segment_test_points(band, threshold), threshold, nms_radius)
+        coords[:, 0] += read_start
+        # Drop the halo rows, they belong to the neighbouring bands.
+        in_band = (coords[:, 0] >= row_start) & (coords[:, 0] < row_end)
+        yield coords[in_band], scores[in_band]
+
 
 class FASTKeypointDetector:
-    def __init__(self, threshold, image_db: ImageDB) -> None:
+    def __init__(
+        self, threshold, image_db: ImageDB, descriptor_stdev=50, pattern_seed: int = 0,
+        pattern_registry: Optional[DescriptorPatternRegistry] = None
+    ) -> None:
         """
         :param threshold: The distance between the test point's intensity for it to be considered a notable point.
+        :param descriptor_stdev, pattern_seed: Select the BRIEF pattern. The same values always give the same pattern.
+        :param pattern_registry: Load the pattern from (and store it in) a registry on disk, so descriptors stay
+            comparable across runs even if the generator changes.
         """
         self.threshold = threshold
         self._image_db = image_db
@@ -47,12 +196,19 @@ class FASTKeypointDetector:
         self._bounds = np.empty(0)
 
         self._time_acc = 0
-        # TODO stdev as param.
-        self._gaussian_pairs = generate_gaussian_pairs(stdev=50)
+        if pattern_registry is None:
+            self.pattern_id = descriptor_pattern_id(descriptor_stdev, seed=pattern_seed)
+            self._gaussian_pairs = generate_gaussian_pairs(stdev=descriptor_stdev, seed=pattern_seed)
+        else:
+            self.pattern_id, self._gaussian_pairs = pattern_registry.get_pattern(descriptor_stdev, seed=pattern_seed)
 
-    def _config_caches(self, image_id):
+    def _config_caches(self, image_id, with_bounds=True):
         self._time_acc = 0
         self._bw_img = self._image_db.get_bw_image(image_id)
+        if not with_bounds:
+            # The vectorized engine computes bounds on the fly, so skip the (H, W, 2) array.
+            self._bounds = np.empty(0)
+            return
         # Convert into array like [[[lower, upper], [lower, upper], ...],[],...]
         # Packing bounds like this seems to have reduced from 5.7 seconds to 5.45
         # Caching bounds in general also saves reduces from 6 to 2.7 seconds
@@ -144,44 +300,199 @@ class FASTKeypointDetector:
             keypoints.extend(self._process_row(x))
         return keypoints
 
-    def detect_points(self, image_id: int):
-        # TODO we are excluding the 3 pixel border because it requires extra thought. Determine if this is OK
-        # contents like [(height, width), (height2, width2)]
+    def _detect_rows(self):
         raw_keypoints = []
-        now = time.time()
-
-        self._config_caches(image_id)
-
-
         # TODO implement two different classes for multiprocessing & not
         # Multiprocessing method. 1920x1080 ~ 1.81 seconds, 33886 keypoints. ~1.5 after refactor? ~0.67 after first Bres re-work + chunk size modification.
         # 15pt star ~ 0.152 seconds, 128 keypoints
-        pool = multiprocessing.Pool()
         num_rows_per_process = 50
-        outputs = pool.map(self._process_row, range(3, self.img_height-3), chunksize=num_rows_per_process)
+        with multiprocessing.Pool() as pool:
+            outputs = pool.map(self._process_row, range(3, self.img_height-3), chunksize=num_rows_per_process)
         for output in outputs:
             raw_keypoints.extend(output)
-        
+
         # Regular method. 1920x1080 ~ 15.9 seconds, 33886 keypoints. ~6 after threshold refactor. ~2.54 after first Bresenham re-work
         # 15pt star ~ 1.158 seconds, 128 keypoints
         # for u in range(3, self.img_height-3):
         #     raw_keypoints.extend(self._process_row(u))
+        return raw_keypoints
+
+    def _detect_raw_keypoints(self, image_id: int, engine: str) -> np.ndarray:
+        if engine == "row":
+            self._config_caches(image_id)
+            raw_keypoints = self._detect_rows()
+        else:
+            # 1920x1080 ~ 0.03 seconds.
+            self._config_caches(image_id, with_bounds=False)
+            raw_keypoints = detect_segment_test_points(self._bw_img, self.threshold)
+        return np.array(raw_keypoints, dtype=np.int64).reshape(-1, 2)
+
+    def _detect_scored_points(self, image_id: int, engine: str, nms_radius: Optional[int]) -> tuple[np.ndarray, np.ndarray]:
+        # TODO we are excluding the 3 pixel border because it requires extra thought. Determine if this is OK
+        # contents like [(height, width), (height2, width2)]
+        if engine not in DETECTION_ENGINES:
+            raise ValueError(f"Unknown detection engine {engine}, expected one of {DETECTION_ENGINES}")
+        now = time.time()
+
+        raw_keypoints = self._detect_raw_keypoints(image_id, engine)
+        # 1920x1080 3x3 NMS ~ 0.01 seconds
+        raw_keypoints, scores = score_and_suppress(self._bw_img, raw_keypoints, self.threshold, nms_radius)
         print(time.time() - now)
-        print("time_acc clocked", self._time_acc, "seconds")
+        if engine == "row":
+            print("time_acc clocked", self._time_acc, "seconds")
+        return raw_keypoints, scores
+
+    def detect_points(self, image_id: int, engine: str = "row", nms_radius: Optional[int] = None):
+        """
+        :param engine: "row" runs `_process_row` for every row over a process pool.
+            "vectorized" runs the same segment test over the whole image at once, see `detect_segment_test_points`.
+        :param nms_radius: When set, only keypoints with the highest corner score in their
+            (2 * nms_radius + 1)^2 window are returned. 1 gives the usual 3x3 suppression.
+        """
+        raw_keypoints, scores = self._detect_scored_points(image_id, engine, nms_radius)
+        keypoints = []
+        for keypoint, score in zip(raw_keypoints, scores):
+            keypoints.append(KeyPoint(image_id, keypoint, self._gaussian_pairs, self._image_db, score=int(score)))
+        return keypoints
+
+    def detect_keypoint_set(self, image_id: int, engine: str = "vectorized", nms_radius: Optional[int] = None) -> KeypointSet:
+        """
+        Same as `detect_points`, but returns a `KeypointSet` instead of creating a `KeyPoint` per detection.
+        """
+        raw_keypoints, scores = self._detect_scored_points(image_id, engine, nms_radius)
+        return KeypointSet(raw_keypoints, image_id, scores=scores)
+
+    def iter_points_tiled(
+        self, image_id: int, bw_image_file, band_height: int = 512, nms_radius: Optional[int] = None
+    ) -> Iterator[list[KeyPoint]]:
+        """
+        Streams keypoints band by band from a grayscale file written by `write_bw_image_file`, see
+        `detect_points_in_bands`. The file is memory-mapped, so only a band and its halo are in memory at once, and
+        the image doesn't need to be in the ImageDB, `image_id` only tags the keypoints.
+        """
+        bw_img = open_bw_image_file(bw_image_file)
+        for coords, scores in detect_points_in_bands(bw_img, self.threshold, band_height, nms_radius):
+            yield [
+                KeyPoint(image_id, coord, self._gaussian_pairs, self._image_db, score=int(score))
+                for coord, score in zip(coords, scores)
+            ]
+
+    def detect_points_pyramid(
+        self, image_id: int, num_levels: int = 3, scale_factor: float = 2.0, levels: Optional[list[int]] = None,
+        nms_radius: Optional[int] = None, parallel: bool = True
+    ) -> list[KeyPoint]:
+        """
+        Detects keypoints on each level of the image pyramid cached in the ImageDB (see `ImageDB.get_bw_pyramid`).
+        Level i is downsampled by `scale_factor ** i`, so the radius 3 circle covers a proportionally larger area.
+
+        Returned keypoints are in native resolution coords and tagged with the `level` and `scale` they were found at.
+        :param levels: Subset of the levels to run on, e.g. `[num_levels - 1]` for a coarse preview. All levels by default.
+        :param parallel: Detect on the levels concurrently in threads. NumPy releases the GIL for the heavy array ops.
+        """
+        pyramid = self._image_db.get_bw_pyramid(image_id, num_levels, scale_factor)
+        if levels is None:
+            levels = list(range(num_levels))
+        tasks = [(pyramid[level], self.threshold, nms_radius) for level in levels]
+        if parallel and len(tasks) > 1:
+            with ThreadPool(len(tasks)) as pool:
+                outputs = pool.map(_detect_level, tasks)
+        else:
+            outputs = [_detect_level(task) for task in tasks]
+
         keypoints = []
-        for keypoint in raw_keypoints:
-            keypoints.append(KeyPoint(image_id, keypoint, self._gaussian_pairs, self._image_db))
-            # keypoints.append(KeyPoint(keypoint, self._direction(keypoint[0], keypoint[1]), self._brief_descriptor(keypoint[0], keypoint[1])))
+        for level, (coords, scores) in zip(levels, outputs):
+            level_height, level_width = pyramid[level].shape
+            # Map pixel centers back to the native image.
+            ratio = np.array([self.img_height / level_height, self.img_width / level_width])
+            native_coords = np.rint((coords + 0.5) * ratio - 0.5).astype(np.int64)
+            native_coords = np.minimum(native_coords, [self.img_height - 1, self.img_width - 1])
+            for coord, score in zip(native_coords, scores):
+                keypoints.append(KeyPoint(
+                    image_id, coord, self._gaussian_pairs, self._image_db, score=int(score),
+                    level=level, scale=scale_factor ** level
+                ))
         return keypoints
 
-    def _moment(self, u, v, p, q):
-        # Let u, v be the height and width.
-        # https://iopscience.iop.org/article/10.1088/1742-6596/1693/1/012068/pdf
-        acc = 0
-
-        for x, y in BRESENHAM_CIRCLE_3:
-            acc += (x ** p) * (y ** q) * self._bw_img[x + u, y + v]     # TODO determine if x, y or y, x. Not sure if it matters
-        return acc
-    
-    def _direction(self, u, v):
-        return np.arctan2(self._moment(u, v, 0, 1), self._moment(u, v, 1, 0))
+
+# Set in each worker of a `SharedMemoryFASTKeypointDetector` pool by `_attach_shared_image`.
+_worker_shm = None
+_worker_bw_img = None
+
+
+def _attach_shared_image(shm_name: str, image_dim: tuple[int, int]):
+    global _worker_shm, _worker_bw_img
+    _worker_shm = shared_memory.SharedMemory(name=shm_name)
+    _worker_bw_img = np.ndarray(image_dim, dtype=np.int16, buffer=_worker_shm.buf)
+
+
+def _detect_shared_rows(task: tuple[int, int, int]) -> np.ndarray:
+    row_start, row_end, threshold = task
+    # Include the 3 pixel halo above and below so the band's border is exactly the rows we were given.
+    band = _worker_bw_img[row_start-3:row_end+3]
+    keypoints = detect_segment_test_points(band, threshold)
+    keypoints[:, 0] += row_start - 3
+    return keypoints
+
+
+class SharedMemoryFASTKeypointDetector(FASTKeypointDetector):
+    """
+    Runs the vectorized segment test over one long-lived pool of workers.
+
+    Every image in the ImageDB shares the same dimensions, so a single shared memory block is allocated up front.
+    Each image is copied into it once and workers are only sent (row_start, row_end, threshold) tasks,
+    instead of pickling the detector and its image caches for every task.
+
+    The pool and shared memory must be released with `close`, or by using the detector as a context manager.
+    """
+    def __init__(self, threshold, image_db: ImageDB, processes: Optional[int] = None, rows_per_task: int = 64, **kwargs) -> None:
+        super().__init__(threshold, image_db, **kwargs)
+        self.rows_per_task = rows_per_task
+        self._shm = shared_memory.SharedMemory(create=True, size=self.img_height * self.img_width * np.dtype(np.int16).itemsize)
+        self._shm_bw_img = np.ndarray((self.img_height, self.img_width), dtype=np.int16, buffer=self._shm.buf)
+        self._pool = multiprocessing.Pool(
+            processes, initializer=_attach_shared_image, initargs=(self._shm.name, (self.img_height, self.img_width))
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        if self._pool is None:
+            return
+        self._pool.close()
+        self._pool.join()
+        self._pool = None
+        self._bw_img = np.empty(0)
+        self._shm_bw_img = None
+        self._shm.close()
+        self._shm.unlink()
+
+    def _config_caches(self, image_id, with_bounds=False):
+        self._time_acc = 0
+        np.copyto(self._shm_bw_img, self._image_db.get_bw_image(image_id))
+        self._bw_img = self._shm_bw_img
+        self._bounds = np.empty(0)
+
+    def _detect_raw_keypoints(self, image_id: int, engine: str) -> np.ndarray:
+        if engine != "vectorized":
+            raise ValueError(f"{type(self).__name__} only supports the vectorized engine")
+        if self._pool is None:
+            raise ValueError("The detector's worker pool has already been closed")
+        self._config_caches(image_id)
+        tasks = [
+            (row_start, min(row_start + self.rows_per_task, self.img_height - 3), self.threshold)
+            for row_start in range(3, self.img_height - 3, self.rows_per_task)
+        ]
+        outputs = self._pool.map(_detect_shared_rows, tasks)
+        if len(outputs) == 0:
+            return np.empty((0, 2), dtype=np.int64)
+        return np.concatenate(outputs)
+
+    def detect_points(self, image_id: int, engine: str = "vectorized", nms_radius: Optional[int] = None):
+        return super().detect_points(image_id, engine, nms_radius)
+
+    def detect_keypoint_set(self, image_id: int, engine: str = "vectorized", nms_radius: Optional[int] = None) -> KeypointSet:
+        return super().detect_keypoint_set(image_id, engine, nms_radius)
@@ -1,38 +1,186 @@
 # TODO move out of image_processing
 
 from photogrammetry.image_processing.keypoint_detection import KeyPoint
-import math
+from photogrammetry.models.keypoint_set import KeypointSet, keypoint_coords
+from photogrammetry.utils.arrays import expand_ranges, group_ranks
+from photogrammetry.utils.hamming import hamming_distance_matrix, paired_hamming_distances
 import numpy as np
+from typing import Optional, Union
 
-def match_keypoints(keypoints1: list[KeyPoint], keypoints2: list[KeyPoint], hamming_threshold: int):
-    key1_to_key2_dist = np.zeros((len(keypoints1), len(keypoints2), 2), dtype=np.int64)
-    for idx1 in range(len(keypoints1)):
-        des1 = keypoints1[idx1].descriptor
-        for idx2 in range(len(keypoints2)):
-            dist = hamming_distance(des1, keypoints2[idx2].descriptor)
-            key1_to_key2_dist[idx1, idx2] = [idx2, dist]
-
-    # key1_to_min_dist = {}
-    # # TODO very crude implementation. need some sort of fallback
-    # for idx1 in range(len(keypoints1)):
-    #     min_dist = math.inf
-    #     min_dist_idx = -1
-    #     for idx2 in range(len(keypoints2)):
-    #         dist = key1_key2_to_dist[idx1, idx2]
-    #         if dist < min_dist:
-    #             min_dist = dist
-    #             min_dist_idx = idx2
-    #     key1_to_min_dist[idx1] = {min_dist_idx: min_dist}
-    # print(key1_to_key2_dist[0])
-    # key1_to_key2_dist = key1_to_key2_dist[key1_to_key2_dist[:, ]]
-    for idx1 in range(len(keypoints1)):
-        # Sort by the distances
-        row = key1_to_key2_dist[idx1]
-        key1_to_key2_dist[idx1] = row[row[:, 1].argsort()]  # sorted(key1_to_key2_dist[idx1], key=lambda x: x[1])
-    # print(key1_to_key2_dist[0])
-    return key1_to_key2_dist
-
-    # return key1_to_min_dist
+
+# Roughly bounds the memory of each block of the distance matrix and its temporaries.
+MATCH_BLOCK_BYTES = 64 * 1024 * 1024
+
+
+def _packed_descriptors(keypoints: Union[list[KeyPoint], KeypointSet]) -> np.ndarray:
+    if isinstance(keypoints, KeypointSet):
+        if keypoints.descriptors is None:
+            raise ValueError("The KeypointSet has no descriptors, see compute_keypoint_set_descriptors")
+        return keypoints.descriptors
+    if len(keypoints) == 0:
+        return np.empty((0, 32), dtype=np.uint8)
+    num_bytes = (len(keypoints[0]._gaussian_pairs) + 7) // 8
+    return np.array([
+        np.frombuffer(keypoint.descriptor.to_bytes(num_bytes, 'little'), dtype=np.uint8) for keypoint in keypoints
+    ]).reshape(-1, num_bytes)
+
+
+def match_descriptors_top_k(
+    descriptors1: np.ndarray, descriptors2: np.ndarray, k: int = 2, block_size: Optional[int] = None
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    For every descriptor in `descriptors1`, finds the `k` closest descriptors in `descriptors2`.
+
+    The distance matrix is computed `block_size` query rows at a time (by default sized from MATCH_BLOCK_BYTES)
+    and only the k best of each row are kept, using argpartition instead of sorting whole rows.
+    :return: (N, k) indices into `descriptors2` and (N, k) distances, ordered by distance then index.
+        k is clipped to len(descriptors2).
+    """
+    k = min(k, len(descriptors2))
+    indices = np.zeros((len(descriptors1), k), dtype=np.int64)
+    distances = np.zeros((len(descriptors1), k), dtype=np.int32)
+    if k == 0:
+        return indices, distances
+    if block_size is None:
+        # uint16 distances, plus the uint64 XOR and popcount temporaries.
+        block_size = max(1, MATCH_BLOCK_BYTES // (len(descriptors2) * 18))
+
+    for start in range(0, len(descriptors1), block_size):
+        block_distances = hamming_distance_matrix(descriptors1[start:start + block_size], descriptors2)
+        if k < block_distances.shape[1]:
+            top_k = np.argpartition(block_distances, k - 1, axis=1)[:, :k]
+        else:
+            top_k = np.broadcast_to(np.arange(k), block_distances.shape).copy()
+        top_k_distances = np.take_along_axis(block_distances, top_k, axis=1)
+        order = np.lexsort((top_k, top_k_distances), axis=1)
+        indices[start:start + len(top_k)] = np.take_along_axis(top_k, order, axis=1)
+        distances[start:start + len(top_k)] = np.take_along_axis(top_k_distances, order, axis=1)
+    return indices, distances
+
+
+def _raise_if_patterns_differ(keypoints1, keypoints2):
+    if isinstance(keypoints1, KeypointSet) and isinstance(keypoints2, KeypointSet) and keypoints1.pattern_id != keypoints2.pattern_id:
+        raise ValueError(f"Can't match descriptors from different patterns {keypoints1.pattern_id} and {keypoints2.pattern_id}")
+
+
+def match_keypoints(
+    keypoints1: Union[list[KeyPoint], KeypointSet], keypoints2: Union[list[KeyPoint], KeypointSet],
+    hamming_threshold: Optional[int] = None, k: Optional[int] = None
+):
+    """
+    Returns a (len(keypoints1), k, 2) array, where row i holds the [keypoint2 idx, hamming distance] of
+    the k closest keypoints2 to keypoints1[i], closest first. All of keypoints2 when k is None.
+    :param hamming_threshold: Not applied yet, the k closest are returned whatever their distance.
+    """
+    _raise_if_patterns_differ(keypoints1, keypoints2)
+    # 5k x 5k keypoints ~ 0.6 seconds for k=2.
+    indices, distances = match_descriptors_top_k(
+        _packed_descriptors(keypoints1), _packed_descriptors(keypoints2), len(keypoints2) if k is None else k
+    )
+    return np.stack([indices, distances.astype(np.int64)], axis=2)
+
+
+def predict_coords(coords: np.ndarray, offset=None, homography: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Expected (row, col) of each coord in the second image.
+    :param offset: (row, col) shift, e.g. the expected disparity of a stereo pair.
+    :param homography: 3x3 matrix mapping (x, y) = (col, row) in the first image to the second, as from cv2.findHomography.
+    """
+    predicted = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    if homography is not None:
+        points = np.column_stack([predicted[:, 1], predicted[:, 0], np.ones(len(predicted))]) @ np.asarray(homography).T
+        predicted = np.column_stack([points[:, 1] / points[:, 2], points[:, 0] / points[:, 2]])
+    if offset is not None:
+        predicted = predicted + np.asarray(offset, dtype=np.float64)
+    return predicted
+
+
+def window_candidate_pairs(predicted: np.ndarray, coords2: np.ndarray, search_radius: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    All (idx1, idx2) where coords2[idx2] is within `search_radius` (Chebyshev) of predicted[idx1].
+
+    coords2 is bucketed into a uniform grid of search_radius sized cells, so each window only visits the 3x3 cells
+    around its center instead of every point.
+    """
+    if len(predicted) == 0 or len(coords2) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    cell_size = max(int(np.ceil(search_radius)), 1)
+    cells2 = np.floor_divide(coords2, cell_size).astype(np.int64)
+    cells_min = cells2.min(axis=0)
+    cells2 -= cells_min
+    num_cells = cells2.max(axis=0) + 1
+    cell_keys2 = cells2[:, 0] * num_cells[1] + cells2[:, 1]
+    order2 = np.argsort(cell_keys2, kind='stable')
+    sorted_keys2 = cell_keys2[order2]
+
+    cells1 = np.floor(predicted / cell_size).astype(np.int64) - cells_min
+    idxs1 = []
+    idxs2 = []
+    for d_row in (-1, 0, 1):
+        for d_col in (-1, 0, 1):
+            rows = cells1[:, 0] + d_row
+            cols = cells1[:, 1] + d_col
+            in_grid = (rows >= 0) & (rows < num_cells[0]) & (cols >= 0) & (cols < num_cells[1])
+            keys = rows * num_cells[1] + cols
+            starts = np.searchsorted(sorted_keys2, keys, side='left')
+            counts = np.where(in_grid, np.searchsorted(sorted_keys2, keys, side='right') - starts, 0)
+            idxs1.append(np.repeat(np.arange(len(predicted)), counts))
+            idxs2.append(order2[expand_ranges(starts, counts)])
+    idxs1 = np.concatenate(idxs1)
+    idxs2 = np.concatenate(idxs2)
+    in_window = np.all(np.abs(coords2[idxs2] - predicted[idxs1]) <= search_radius, axis=1)
+    return idxs1[in_window], idxs2[in_window]
+
+
+def _best_per_group(group_idxs: np.ndarray, other_idxs: np.ndarray, distances: np.ndarray):
+    """
+    Orders pairs by group, distance, then the other index, and returns the order with each pair's rank in its group.
+    """
+    order = np.lexsort((other_idxs, distances, group_idxs))
+    return order, group_ranks(group_idxs[order])
+
+
+def match_keypoints_spatial(
+    keypoints1: Union[list[KeyPoint], KeypointSet], keypoints2: Union[list[KeyPoint], KeypointSet],
+    search_radius: int, ratio: Optional[float] = 0.8, mutual: bool = True, max_distance: Optional[int] = None,
+    offset=None, homography: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """
+    Matches each keypoint1 only against the keypoints2 within `search_radius` pixels of its predicted position,
+    for pairs where the motion between the images is bounded (video frames, rectified stereo).
+    See `predict_coords` for `offset` and `homography`, without either the window is centered on the same coord.
+
+    :param ratio: Lowe's ratio test, keep a match only if its distance is < ratio * the second best candidate's.
+        Matches with a single candidate pass. None disables the test.
+    :param mutual: Keep a match only if keypoint1 is also the closest candidate of keypoint2.
+    :param max_distance: Drop matches with a larger Hamming distance.
+    :return: (K, 3) array of [keypoint1 idx, keypoint2 idx, hamming distance], ordered by keypoint1 idx.
+    """
+    _raise_if_patterns_differ(keypoints1, keypoints2)
+    descriptors1 = _packed_descriptors(keypoints1)
+    descriptors2 = _packed_descriptors(keypoints2)
+    predicted = predict_coords(keypoint_coords(keypoints1), offset, homography)
+    idxs1, idxs2 = window_candidate_pairs(predicted, keypoint_coords(keypoints2), search_radius)
+    distances = paired_hamming_distances(descriptors1[idxs1], descriptors2[idxs2])
+
+    order, ranks = _best_per_group(idxs1, idxs2, distances)
+    idxs1, idxs2, distances = idxs1[order], idxs2[order], distances[order]
+    is_best = ranks == 0
+    keep = is_best.copy()
+    if ratio is not None:
+        # The second best of a group directly follows its best.
+        has_second = np.r_[ranks[1:] == 1, False]
+        second_distances = np.r_[distances[1:], 0]
+        keep &= ~has_second | (distances < ratio * second_distances)
+    if max_distance is not None:
+        keep &= distances <= max_distance
+    if mutual and len(idxs2) > 0:
+        reverse_order, reverse_ranks = _best_per_group(idxs2, idxs1, distances)
+        best_idx1_of_idx2 = np.full(len(descriptors2), -1, dtype=np.int64)
+        best_reverse = reverse_order[reverse_ranks == 0]
+        best_idx1_of_idx2[idxs2[best_reverse]] = idxs1[best_reverse]
+        keep &= best_idx1_of_idx2[idxs2] == idxs1
+    return np.column_stack([idxs1[keep], idxs2[keep], distances[keep]]).astype(np.int64)
 
 
 def hamming_distance(int1, int2) -> int:
@@ -1,7 +1,7 @@
 from math import sqrt, cos, sin
-from cv2 import Mat, remap, INTER_LINEAR
+from cv2 import Mat, remap, convertMaps, INTER_LINEAR, CV_16SC2
 import numpy as np
-from typing import Tuple
+from typing import Optional, Tuple, Union
 from photogrammetry.utils.files import create_dir_if_not_exists
 from os import path
 import time
@@ -24,6 +24,43 @@ def get_distortion_mat(image_dim: Tuple[int, int], distortion_coefficients: list
     np.save(file_path, dist_mat)
     return dist_mat
 
+def _solve_undistorted_radius(rd: np.ndarray, distortion_coefficients: list) -> np.ndarray:
+    """
+    Solves Ar^3 + Br^2 + Cr + D = 0 (see `generate_distortion_mat`) for every distorted radius at once, in closed form.
+    Picks the same root as `np.roots` did: the middle one of three real roots, otherwise the real one.
+    """
+    k1, k2, k3, k4, k5 = distortion_coefficients
+    rd = np.asarray(rd, dtype=np.float64)
+    denominator = rd * k5 - k2
+    if np.any(denominator == 0):
+        raise ValueError(f"The radius cubic is degenerate for the distortion coefficients {distortion_coefficients}")
+    b = (rd * k4 - k1) / denominator
+    c = (rd * k3 - 1) / denominator
+    d = rd / denominator
+
+    # Substituting r = t - b/3 gives the depressed cubic t^3 + pt + q = 0.
+    p = c - b * b / 3
+    q = 2 * b ** 3 / 27 - b * c / 3 + d
+    discriminant = (q / 2) ** 2 + (p / 3) ** 3
+    t = np.empty_like(rd)
+
+    # Cardano's formula for one real root.
+    one_real = discriminant >= 0
+    sqrt_discriminant = np.sqrt(discriminant[one_real])
+    t[one_real] = np.cbrt(-q[one_real] / 2 + sqrt_discriminant) + np.cbrt(-q[one_real] / 2 - sqrt_discriminant)
+
+    # The trigonometric method for three real roots, k = 1 is the middle one.
+    three_real = ~one_real
+    m = 2 * np.sqrt(-p[three_real] / 3)
+    phi = np.arccos(np.clip(3 * q[three_real] / (p[three_real] * m), -1, 1)) / 3
+    t[three_real] = m * np.cos(phi - 2 * np.pi / 3)
+
+    r = t - b / 3
+    # One Newton step polishes the cancellation error of the closed form.
+    value = ((r + b) * r + c) * r + d
+    slope = (3 * r + 2 * b) * r + c
+    return np.where(slope != 0, r - value / np.where(slope != 0, slope, 1), r)
+
 def generate_distortion_mat(image_dim: Tuple[int, int], distortion_coefficients: list):
     """
     Params:
@@ -78,6 +115,36 @@ def generate_distortion_mat(image_dim: Tuple[int, int], distortion_coefficients:
     height = image_dim[0]
     width = image_dim[1]
 
+    # Same layout and int truncation as `generate_distortion_mat_naive`, (x, y) are along height and width.
+    x0 = height / 2
+    y0 = width / 2
+    xs = np.trunc(np.arange(height) - x0).astype(np.int64)
+    ys = np.trunc(np.arange(width) - y0).astype(np.int64)
+    rd2 = xs[:, np.newaxis] ** 2 + ys[np.newaxis, :] ** 2
+
+    # Only the radii that occur are solved for. 2560x1440 ~ 0.35 seconds, 4000x3000 ~ 1.1 seconds.
+    rd2_present = np.zeros(rd2.max() + 1, dtype=bool)
+    rd2_present[rd2] = True
+    unique_rd2 = np.flatnonzero(rd2_present)
+    radii = np.zeros(len(rd2_present), dtype=np.float64)
+    radii[unique_rd2] = _solve_undistorted_radius(np.sqrt(unique_rd2), distortion_coefficients)
+    r = radii[rd2]
+
+    # 2.14, 2.15
+    theta = np.arctan2(xs[:, np.newaxis], ys[np.newaxis, :])
+    distortion_mat = np.empty((height, width, 2), np.uint16)
+    distortion_mat[..., 0] = (r * np.sin(theta) + x0).astype(np.int64)
+    distortion_mat[..., 1] = (r * np.cos(theta) + y0).astype(np.int64)
+    return distortion_mat
+
+def generate_distortion_mat_naive(image_dim: Tuple[int, int], distortion_coefficients: list):
+    """
+    Per pixel version of `generate_distortion_mat`, solving the cubic with `np.roots` for each unique rd^2.
+    1920x1080 ~ 23 seconds.
+    """
+    height = image_dim[0]
+    width = image_dim[1]
+
 
     # Let x direction be along width, and y direction be along height
     # (x0, y0) is image center
@@ -146,17 +213,145 @@ def generate_distortion_mat(image_dim: Tuple[int, int], distortion_coefficients:
     # NOTE that vectorize didn't offer much performance improvement sadly
     return distortion_mat
 
-def apply_distortion_mat(image: Mat, distortion_mat: Mat):
-    # Takes ~ 0.005 seconds for 1920x1080 with ints on M1.
-    # TODO Could save read this from cache instead.
-    transposed_dist_mat = distortion_mat.transpose((2, 0, 1))
-    map_y = transposed_dist_mat[0].astype(np.float32)
-    map_x = transposed_dist_mat[1].astype(np.float32)
+class RadialDistortionLUT:
+    """
+    The distortion as a 1-D table of undistorted radius r per distorted radius rd, sampled every
+    1 / samples_per_pixel pixels, instead of a full (H, W, 2) mat.
+
+    The distortion is radial, so the table holds all of it: `to_maps` expands it to remap maps, building one quadrant
+    and mirroring it. The center is ((H - 1) / 2, (W - 1) / 2), which makes the quadrants exact mirrors, and the maps
+    keep sub-pixel source coords rather than truncating them like `generate_distortion_mat`.
+    """
+    def __init__(self, image_dim: Tuple[int, int], distortion_coefficients: list, samples_per_pixel: int = 4, radii: Optional[np.ndarray] = None) -> None:
+        """
+        :param radii: A table from a previous LUT with the same parameters, e.g. from `load`.
+        """
+        self.image_dim = tuple(int(dim) for dim in image_dim)
+        self.distortion_coefficients = list(distortion_coefficients)
+        self.samples_per_pixel = samples_per_pixel
+        height, width = self.image_dim
+        self.center = ((height - 1) / 2, (width - 1) / 2)
+        # One sample past the corner so every pixel's rd is between two samples.
+        num_samples = int(np.ceil(np.hypot(*self.center) * samples_per_pixel)) + 2
+        if radii is None:
+            # 4000x3000 ~ 10k samples, ~ 0.001 seconds.
+            radii = _solve_undistorted_radius(np.arange(num_samples) / samples_per_pixel, self.distortion_coefficients)
+        self.radii = np.asarray(radii, dtype=np.float64)
+        if len(self.radii) != num_samples:
+            raise ValueError(f"Expected {num_samples} radii for {self.image_dim} at {samples_per_pixel} samples per pixel, got {len(self.radii)}")
+
+    def undistorted_radius(self, rd: np.ndarray) -> np.ndarray:
+        """
+        Linearly interpolates the table at each distorted radius.
+        """
+        rd = np.asarray(rd, dtype=np.float64)
+        return np.interp(rd * self.samples_per_pixel, np.arange(len(self.radii)), self.radii)
+
+    def to_maps(self, fixed_point: bool = False) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Expands the table into the two maps `cv2.remap` takes, see `apply_distortion_mat`.
+        :param fixed_point: Return OpenCV's fixed-point (CV_16SC2, CV_16UC1) maps from `convertMaps`, which are
+            half the size and remap faster, instead of float32 (map_x, map_y).
+        """
+        # 4000x3000 ~ 0.17 seconds, 1920x1080 ~ 0.03 seconds.
+        height, width = self.image_dim
+        center_row, center_col = self.center
+        quadrant_height = (height + 1) // 2
+        quadrant_width = (width + 1) // 2
+        xs = np.arange(quadrant_height) - center_row
+        ys = np.arange(quadrant_width) - center_col
+        rd = np.hypot(xs[:, np.newaxis], ys[np.newaxis, :])
+        # r / rd, which tends to 1 / f(0) = 1 at the center.
+        scales = np.divide(self.undistorted_radius(rd), rd, out=np.ones_like(rd), where=rd > 0)
+
+        map_x = np.empty((height, width), dtype=np.float32)
+        map_y = np.empty((height, width), dtype=np.float32)
+        map_y[:quadrant_height, :quadrant_width] = xs[:, np.newaxis] * scales + center_row
+        map_x[:quadrant_height, :quadrant_width] = ys[np.newaxis, :] * scales + center_col
+        # Mirroring a pixel through the center mirrors its source coord, c + s becomes (2c - (c + s)).
+        map_y[:quadrant_height, width - quadrant_width:] = map_y[:quadrant_height, quadrant_width - 1::-1]
+        map_x[:quadrant_height, width - quadrant_width:] = (width - 1) - map_x[:quadrant_height, quadrant_width - 1::-1]
+        map_y[height - quadrant_height:] = (height - 1) - map_y[quadrant_height - 1::-1]
+        map_x[height - quadrant_height:] = map_x[quadrant_height - 1::-1]
+        if fixed_point:
+            return convertMaps(map_x, map_y, CV_16SC2)
+        return map_x, map_y
+
+    def save(self, file_path) -> None:
+        np.savez(
+            file_path, image_dim=np.array(self.image_dim), distortion_coefficients=np.array(self.distortion_coefficients, dtype=np.float64),
+            samples_per_pixel=np.array(self.samples_per_pixel), radii=self.radii
+        )
+
+    @classmethod
+    def load(cls, file_path):
+        with np.load(file_path) as lut:
+            return cls(
+                tuple(lut["image_dim"]), [float(coefficient) for coefficient in lut["distortion_coefficients"]], int(lut["samples_per_pixel"]), lut["radii"]
+            )
+
+def _radial_scale(r: np.ndarray, distortion_coefficients: list) -> np.ndarray:
+    """
+    f(r) of `generate_distortion_mat`, the ratio of distorted to undistorted radius.
+    """
+    k1, k2, k3, k4, k5 = distortion_coefficients
+    return (1 + k1 * r + k2 * r ** 2) / (1 + k3 * r + k4 * r ** 2 + k5 * r ** 3)
+
+def undistort_points(coords: np.ndarray, image_dim: Tuple[int, int], distortion_coefficients: list) -> np.ndarray:
+    """
+    Where (height, width) coords of the raw image land in the de-warped image, without building a map.
+
+    The de-warped pixel at radius rd samples the raw image at the radius r solving rd = r * f(r), so raw points only
+    need the forward formula. Uses the ((H - 1) / 2, (W - 1) / 2) center of `RadialDistortionLUT`, so the points
+    line up with images de-warped by its maps or a `DistortionMapCache`.
+    :return: (N, 2) float64 sub-pixel coords.
+    """
+    center = np.array([(image_dim[0] - 1) / 2, (image_dim[1] - 1) / 2])
+    offsets = np.asarray(coords, dtype=np.float64).reshape(-1, 2) - center
+    r = np.hypot(offsets[:, 0], offsets[:, 1])
+    return offsets * _radial_scale(r, distortion_coefficients)[:, np.newaxis] + center
+
+def distort_points(coords: np.ndarray, image_dim: Tuple[int, int], distortion_coefficients: list) -> np.ndarray:
+    """
+    Inverse of `undistort_points`, where de-warped coords were in the raw image.
+    """
+    center = np.array([(image_dim[0] - 1) / 2, (image_dim[1] - 1) / 2])
+    offsets = np.asarray(coords, dtype=np.float64).reshape(-1, 2) - center
+    rd = np.hypot(offsets[:, 0], offsets[:, 1])
+    scales = np.divide(_solve_undistorted_radius(rd, distortion_coefficients), rd, out=np.ones_like(rd), where=rd > 0)
+    return offsets * scales[:, np.newaxis] + center
+
+def undistort_keypoints(keypoints, image_dim: Tuple[int, int], distortion_coefficients: list):
+    """
+    Attaches the `undistort_points` coords of detected keypoints, as `KeypointSet.undistorted_coords` or each
+    `KeyPoint.undistorted_coord`. The detection coords are unchanged, descriptors still sample the raw image.
+    :return: A new `KeypointSet`, or the same list of `KeyPoint`s.
+    """
+    if isinstance(keypoints, list):
+        undistorted_coords = undistort_points([keypoint.coord for keypoint in keypoints], image_dim, distortion_coefficients)
+        for keypoint, undistorted_coord in zip(keypoints, undistorted_coords):
+            keypoint._undistorted_coord = undistorted_coord
+        return keypoints
+    return keypoints.with_undistorted_coords(undistort_points(keypoints.coords, image_dim, distortion_coefficients))
+
+def apply_distortion_mat(image: Mat, distortion_mat: Union[Mat, tuple], dst: Optional[np.ndarray] = None, interpolation: int = INTER_LINEAR):
+    """
+    :param distortion_mat: Either the (H, W, 2) mat of `generate_distortion_mat`, or a pair of maps ready for `remap`
+        such as `RadialDistortionLUT.to_maps` or `DistortionMapCache.get_maps`.
+    :param dst: A preallocated output of the image's shape and dtype, reused across frames instead of allocating one.
+    :param interpolation: Must match the interpolation the maps were cached for.
+    """
+    if isinstance(distortion_mat, tuple):
+        map1, map2 = distortion_mat
+    else:
+        # Takes ~ 0.005 seconds for 1920x1080 with ints on M1.
+        transposed_dist_mat = distortion_mat.transpose((2, 0, 1))
+        map2 = transposed_dist_mat[0].astype(np.float32)
+        map1 = transposed_dist_mat[1].astype(np.float32)
 
     # Takes ~ 0.0035 seconds for 1920x1080 with ints on M1
-    # TODO Need to experiment with interpolation
     start = time.time()
-    new_img = remap(image, map_x, map_y, INTER_LINEAR)
+    new_img = remap(image, map1, map2, interpolation, dst=dst)
     print(f'Took {time.time() - start} to remap')
     return new_img
 
@@ -1,9 +1,14 @@
 import numpy as np
+from typing import Optional
 from photogrammetry.storage.image_db import ImageDB
+from photogrammetry.image_processing.descriptors import compute_brief_descriptors, compute_steered_brief_descriptors, descriptor_to_int
 
 
 class KeyPoint:
-    def __init__(self, image_id: int, coord: np.ndarray, gaussian_pairs, image_db: ImageDB) -> None:
+    def __init__(
+        self, image_id: int, coord: np.ndarray, gaussian_pairs, image_db: ImageDB, score: Optional[int] = None,
+        level: int = 0, scale: float = 1.0
+    ) -> None:
         # TODO remove "image" once the image store is created.
         # TODO determine how to pass guassian_pairs. Maybe in a constant parameter store.
         self._image_id = image_id
@@ -11,6 +16,15 @@ class KeyPoint:
         self._descriptor = None
         self._gaussian_pairs = gaussian_pairs
         self._image_db = image_db
+        # Corner response from the detector, None if the keypoint was not detected directly (e.g. a cluster center).
+        self._score = score
+        # Pyramid level the keypoint was detected at, and that level's downsampling factor. `coord` is always native.
+        self._level = level
+        self._scale = scale
+        # Intensity centroid angle in radians. When set, the descriptor is steered by it.
+        self._orientation = None
+        # Sub-pixel coord in the de-warped image, see `undistort_keypoints`.
+        self._undistorted_coord = None
     
     @classmethod
     def from_reference(cls, keypoint):
@@ -21,6 +35,26 @@ class KeyPoint:
     def coord(self):
         return self._coord
     
+    @property
+    def score(self):
+        return self._score
+
+    @property
+    def level(self):
+        return self._level
+
+    @property
+    def scale(self):
+        return self._scale
+
+    @property
+    def orientation(self):
+        return self._orientation
+
+    @property
+    def undistorted_coord(self):
+        return self._undistorted_coord
+
     @property
     def descriptor(self):
         # TODO rename to brief descriptor?
@@ -30,28 +64,20 @@ class KeyPoint:
         return self._descriptor
 
     def _brief_descriptor(self) -> int:
-        des = 0
-        u, v = self._coord
+        # Use `compute_keypoint_descriptors` when there are many keypoints, this fetches the image for each call.
         bw_image = self._image_db.get_bw_image(self._image_id)
-        img_height, img_width = self._image_db.dim
-        for idx, pair in enumerate(self._gaussian_pairs):
-            if (
-                (0 > pair[0][0] + u or pair[0][0] + u >= img_height) or
-                (0 > pair[1][0] + u or pair[1][0] + u >= img_height) or
-                (0 > pair[0][1] + v or pair[0][1] + v >= img_width) or
-                (0 > pair[1][1] + v or pair[1][1] + v >= img_width)
-            ):
-                # TODO determine how to handle pairs outside of the img.
-                continue
-            p1 = bw_image[pair[0][0] + u, pair[0][1] + v]
-            p2 = bw_image[pair[1][0] + u, pair[1][1] + v]
-            if p1 < p2:
-                des += (2**idx)
-        return des
+        if self._orientation is not None:
+            descriptors, _ = compute_steered_brief_descriptors(
+                bw_image, self._coord[np.newaxis], np.array([self._orientation]), self._gaussian_pairs
+            )
+            return descriptor_to_int(descriptors[0])
+        descriptors, _ = compute_brief_descriptors(bw_image, self._coord[np.newaxis], self._gaussian_pairs)
+        return descriptor_to_int(descriptors[0])
     
-def generate_gaussian_pairs(stdev, num_pairs=256):
+def generate_gaussian_pairs(stdev, num_pairs=256, seed: Optional[int] = None):
+    """
+    Pass a seed for a reproducible pattern, see `DescriptorPatternRegistry`.
+    """
     # TODO there are better algorithms for pair selection. See https://www.cs.ubc.ca/~lowe/525/papers/calonder_eccv10.pdf
-    pairs = np.zeros((num_pairs, 2, 2), dtype=np.int64)    # TODO does this really need to be 64?
-    for idx in range(num_pairs):
-        pairs[idx] = [np.rint(np.random.normal([0, 0], stdev)).astype(np.int64), np.rint(np.random.normal([0, 0], stdev)).astype(np.int64)]
-    return pairs
+    rng = np.random.default_rng(seed)
+    return np.rint(rng.normal(0, stdev, (num_pairs, 2, 2))).astype(np.int64)    # TODO does this really need to be 64?
@@ -0,0 +1,237 @@
+import numpy as np
+from typing import Optional, Union
+from photogrammetry.models.keypoint import KeyPoint
+from photogrammetry.storage.image_db import ImageDB
+from photogrammetry.image_processing.descriptors import descriptor_to_int
+
+
+class KeypointSet:
+    """
+    Struct-of-arrays alternative to `list[KeyPoint]`, one row per keypoint.
+
+    Unlike `KeyPoint`, rows don't reference the `ImageDB` or the gaussian pairs, so a set is a handful of
+    contiguous arrays that are cheap to store and to pickle to worker processes.
+    Missing scores and orientations are NaN. Descriptors are None until computed, see `compute_keypoint_set_descriptors`,
+    and `pattern_id` records which descriptor pattern produced them. Likewise `undistorted_coords` are None until
+    attached by `undistort_keypoints`.
+    """
+    def __init__(
+        self, coords: np.ndarray, image_ids: Union[np.ndarray, int], scores: Optional[np.ndarray] = None,
+        scales: Optional[np.ndarray] = None, levels: Optional[np.ndarray] = None, orientations: Optional[np.ndarray] = None,
+        descriptors: Optional[np.ndarray] = None, pattern_id: Optional[str] = None, undistorted_coords: Optional[np.ndarray] = None
+    ) -> None:
+        self.coords = np.asarray(coords, dtype=np.int32).reshape(-1, 2)
+        num_keypoints = len(self.coords)
+        self.image_ids = self._column(image_ids, num_keypoints, np.int32, 0)
+        self.scores = self._column(scores, num_keypoints, np.float32, np.nan)
+        self.scales = self._column(scales, num_keypoints, np.float32, 1)
+        # Stored rather than derived from `scales`, which only gives the level for a known pyramid scale factor.
+        self.levels = self._column(levels, num_keypoints, np.int32, 0)
+        self.orientations = self._column(orientations, num_keypoints, np.float32, np.nan)
+        self.descriptors = None if descriptors is None else np.asarray(descriptors, dtype=np.uint8)
+        if self.descriptors is not None and self.descriptors.ndim != 2:
+            self.descriptors = self.descriptors.reshape(num_keypoints, -1)
+        self.pattern_id = pattern_id
+        self.undistorted_coords = None
+        if undistorted_coords is not None:
+            self.undistorted_coords = np.asarray(undistorted_coords, dtype=np.float64).reshape(-1, 2)
+            if len(self.undistorted_coords) != num_keypoints:
+                raise ValueError(f"Expected {num_keypoints} undistorted coords but got {len(self.undistorted_coords)}")
+
+    @staticmethod
+    def _column(values, num_keypoints, dtype, default) -> np.ndarray:
+        if values is None:
+            values = default
+        values = np.asarray(values, dtype=dtype)
+        if values.ndim == 0:
+            return np.full(num_keypoints, values, dtype=dtype)
+        if len(values) != num_keypoints:
+            raise ValueError(f"Expected {num_keypoints} values but got {len(values)}")
+        return values
+
+    @classmethod
+    def empty(cls, descriptor_bytes: Optional[int] = None):
+        descriptors = None if descriptor_bytes is None else np.empty((0, descriptor_bytes), dtype=np.uint8)
+        return cls(np.empty((0, 2), dtype=np.int32), 0, descriptors=descriptors)
+
+    @classmethod
+    def from_keypoints(cls, keypoints: list[KeyPoint], pattern_id: Optional[str] = None):
+        if len(keypoints) == 0:
+            return cls.empty()
+        descriptors = None
+        undistorted_coords = None
+        if all(keypoint._undistorted_coord is not None for keypoint in keypoints):
+            undistorted_coords = np.array([keypoint._undistorted_coord for keypoint in keypoints])
+        if all(keypoint._descriptor is not None for keypoint in keypoints):
+            num_bytes = (len(keypoints[0]._gaussian_pairs) + 7) // 8
+            descriptors = np.array([
+                np.frombuffer(keypoint._descriptor.to_bytes(num_bytes, 'little'), dtype=np.uint8) for keypoint in keypoints
+            ])
+        return cls(
+            coords=np.array([keypoint.coord for keypoint in keypoints]),
+            image_ids=np.array([keypoint._image_id for keypoint in keypoints]),
+            scores=np.array([np.nan if keypoint.score is None else keypoint.score for keypoint in keypoints]),
+            scales=np.array([keypoint.scale for keypoint in keypoints]),
+            levels=np.array([keypoint.level for keypoint in keypoints]),
+            orientations=np.array([np.nan if keypoint.orientation is None else keypoint.orientation for keypoint in keypoints]),
+            descriptors=descriptors,
+            pattern_id=pattern_id,
+            undistorted_coords=undistorted_coords
+        )
+
+    def to_keypoints(self, image_db: ImageDB, gaussian_pairs: np.ndarray) -> list[KeyPoint]:
+        keypoints = []
+        for idx in range(len(self)):
+            keypoint = KeyPoint(
+                int(self.image_ids[idx]), self.coords[idx].astype(np.int64), gaussian_pairs, image_db,
+                score=None if np.isnan(self.scores[idx]) else int(self.scores[idx]),
+                level=int(self.levels[idx]), scale=float(self.scales[idx])
+            )
+            if not np.isnan(self.orientations[idx]):
+                keypoint._orientation = float(self.orientations[idx])
+            if self.descriptors is not None:
+                keypoint._descriptor = descriptor_to_int(self.descriptors[idx])
+            if self.undistorted_coords is not None:
+                keypoint._undistorted_coord = self.undistorted_coords[idx]
+            keypoints.append(keypoint)
+        return keypoints
+
+    @classmethod
+    def concatenate(cls, keypoint_sets: list):
+        keypoint_sets = list(keypoint_sets)
+        if len(keypoint_sets) == 0:
+            return cls.empty()
+        has_descriptors = [keypoint_set.descriptors is not None for keypoint_set in keypoint_sets]
+        if any(has_descriptors) and not all(has_descriptors):
+            raise ValueError("Can't concatenate keypoint sets where only some have descriptors")
+        has_undistorted_coords = [keypoint_set.undistorted_coords is not None for keypoint_set in keypoint_sets]
+        pattern_ids = {keypoint_set.pattern_id for keypoint_set in keypoint_sets if keypoint_set.descriptors is not None}
+        if len(pattern_ids) > 1:
+            raise ValueError(f"Can't concatenate descriptors from different patterns {pattern_ids}")
+        return cls(
+            coords=np.concatenate([keypoint_set.coords for keypoint_set in keypoint_sets]),
+            image_ids=np.concatenate([keypoint_set.image_ids for keypoint_set in keypoint_sets]),
+            scores=np.concatenate([keypoint_set.scores for keypoint_set in keypoint_sets]),
+            scales=np.concatenate([keypoint_set.scales for keypoint_set in keypoint_sets]),
+            levels=np.concatenate([keypoint_set.levels for keypoint_set in keypoint_sets]),
+            orientations=np.concatenate([keypoint_set.orientations for keypoint_set in keypoint_sets]),
+            descriptors=np.concatenate([keypoint_set.descriptors for keypoint_set in keypoint_sets]) if all(has_descriptors) else None,
+            pattern_id=pattern_ids.pop() if pattern_ids else None,
+            # Dropped unless every set has them, so a mix of corrected and raw coords can't pass as corrected.
+            undistorted_coords=np.concatenate([
+                keypoint_set.undistorted_coords for keypoint_set in keypoint_sets
+            ]) if all(has_undistorted_coords) else None
+        )
+
+    def __len__(self) -> int:
+        return len(self.coords)
+
+    def __getitem__(self, key):
+        """
+        Slices return views of the columns. Integers, index arrays and boolean masks return copies.
+        """
+        if isinstance(key, (int, np.integer)):
+            key = slice(key, key + 1 if key != -1 else None)
+        return KeypointSet(
+            self.coords[key], self.image_ids[key], self.scores[key], self.scales[key], self.levels[key], self.orientations[key],
+            None if self.descriptors is None else self.descriptors[key], self.pattern_id,
+            None if self.undistorted_coords is None else self.undistorted_coords[key]
+        )
+
+    def for_image(self, image_id: int):
+        """
+        The keypoints belonging to `image_id`. A view when the set is ordered by image, e.g. after `concatenate`.
+        """
+        if len(self) > 0 and np.all(self.image_ids[:-1] <= self.image_ids[1:]):
+            start, end = np.searchsorted(self.image_ids, [image_id, image_id + 1])
+            return self[start:end]
+        return self[self.image_ids == image_id]
+
+    def with_descriptors(self, descriptors: np.ndarray, pattern_id: Optional[str], orientations: Optional[np.ndarray] = None):
+        return KeypointSet(
+            self.coords, self.image_ids, self.scores, self.scales, self.levels,
+            self.orientations if orientations is None else orientations, descriptors, pattern_id, self.undistorted_coords
+        )
+
+    def with_undistorted_coords(self, undistorted_coords: np.ndarray):
+        return KeypointSet(
+            self.coords, self.image_ids, self.scores, self.scales, self.levels, self.orientations, self.descriptors,
+            self.pattern_id, undistorted_coords
+        )
+
+    def save(self, file_path) -> None:
+        columns = {
+            "coords": self.coords, "image_ids": self.image_ids, "scores": self.scores,
+            "scales": self.scales, "levels": self.levels, "orientations": self.orientations
+        }
+        if self.descriptors is not None:
+            columns["descriptors"] = self.descriptors
+        if self.pattern_id is not None:
+            columns["pattern_id"] = np.array(self.pattern_id)
+        if self.undistorted_coords is not None:
+            columns["undistorted_coords"] = self.undistorted_coords
+        np.savez(file_path, **columns)
+
+    @classmethod
+    def load(cls, file_path):
+        with np.load(file_path) as columns:
+            return cls(
+                columns["coords"], columns["image_ids"], columns["scores"], columns["scales"],
+                # Sets saved before levels were stored are all level 0.
+                columns["levels"] if "levels" in columns else None, columns["orientations"],
+                columns["descriptors"] if "descriptors" in columns else None,
+                str(columns["pattern_id"]) if "pattern_id" in columns else None,
+                columns["undistorted_coords"] if "undistorted_coords" in columns else None
+            )
+
+
+def keypoint_coords(keypoints: Union[KeypointSet, list[KeyPoint]]) -> np.ndarray:
+    """
+    (N, 2) coords of either a `KeypointSet` or a list of `KeyPoint`s.
+    """
+    if isinstance(keypoints, KeypointSet):
+        return keypoints.coords
+    if len(keypoints) == 0:
+        return np.empty((0, 2), dtype=np.int64)
+    return np.array([keypoint.coord for keypoint in keypoints])
+
+
+def take_keypoints(keypoints: Union[KeypointSet, list[KeyPoint]], idxs) -> Union[KeypointSet, list[KeyPoint]]:
+    if isinstance(keypoints, KeypointSet):
+        return keypoints[np.asarray(idxs, dtype=np.int64)]
+    return [keypoints[idx] for idx in idxs]
+
+
+def concatenate_keypoints(keypoint_groups: list, like: Union[KeypointSet, list[KeyPoint]]) -> Union[KeypointSet, list[KeyPoint]]:
+    """
+    Joins keypoint groups of the same type as `like`.
+    """
+    if isinstance(like, KeypointSet):
+        return KeypointSet.concatenate(keypoint_groups)
+    joined = []
+    for keypoint_group in keypoint_groups:
+        joined.extend(keypoint_group)
+    return joined
+
+
+def cluster_centers_as_keypoints(keypoints: Union[list[KeyPoint], KeypointSet], ref_idxs: list[int], centers) -> Union[list[KeyPoint], KeypointSet]:
+    """
+    Creates a keypoint at each cluster center, of the same type as the clustered `keypoints`.
+    Everything but the coord is taken from the cluster's reference keypoint, `keypoints[ref_idx]`.
+    """
+    centers = np.round(np.asarray(centers, dtype=np.float64).reshape(-1, 2)).astype(np.int32)
+    if isinstance(keypoints, KeypointSet):
+        ref_keypoints = keypoints[np.asarray(ref_idxs, dtype=np.int64)]
+        return KeypointSet(centers, ref_keypoints.image_ids, scales=ref_keypoints.scales, levels=ref_keypoints.levels)
+    clustered_keypoints = []
+    for ref_idx, center in zip(ref_idxs, centers):
+        ref_keypoint = keypoints[ref_idx]
+        clustered_keypoints.append(
+            KeyPoint(   # TODO replace with KeyPoint.from_reference when done.
+                image_id=ref_keypoint._image_id,
+                coord=center,
+                gaussian_pairs=ref_keypoint._gaussian_pairs,
+                image_db=ref_keypoint._image_db
+            )
+        )
+    return clustered_keypoints
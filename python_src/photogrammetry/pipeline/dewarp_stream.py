@@ -0,0 +1,97 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from cv2 import VideoCapture, imdecode, imencode, remap, INTER_LINEAR, IMREAD_COLOR, IMWRITE_JPEG_QUALITY
+from os import cpu_count, listdir, path
+from typing import Iterable, Iterator, Optional, Union
+import numpy as np
+from photogrammetry.storage.distortion_map_cache import DistortionMapCache
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+
+
+def directory_frames(dir_path: str, extensions: tuple = IMAGE_EXTENSIONS) -> Iterator[np.ndarray]:
+    """
+    Yields the still encoded bytes of each image in the directory, by file name, so decoding happens on the pool.
+    """
+    for filename in sorted(listdir(dir_path)):
+        if filename.lower().endswith(extensions):
+            yield np.fromfile(path.join(dir_path, filename), dtype=np.uint8)
+
+
+def video_frames(source: Union[str, int]) -> Iterator[np.ndarray]:
+    """
+    Yields decoded frames of a video file, or of a camera when `source` is a device index.
+    `VideoCapture` decodes on the reading thread, only the remap runs on the pool.
+    """
+    capture = VideoCapture(source)
+    if not capture.isOpened():
+        raise ValueError(f"Could not open the video source {source}")
+    try:
+        while True:
+            is_read, frame = capture.read()
+            if not is_read:
+                return
+            yield frame
+    finally:
+        capture.release()
+
+
+class DewarpStream:
+    """
+    De-warps a stream of frames on a thread pool, yielding them in order. cv2 releases the GIL while decoding,
+    remapping and encoding, so the threads run in parallel without pickling frames to processes.
+
+    Frames may be decoded (H, W, 3) arrays, or encoded JPEG/PNG bytes which are decoded on the pool. Each frame's
+    maps come from the `DistortionMapCache`, so a stream of same sized frames only pays for the remap, and output
+    frames are written into a ring of reused buffers.
+    """
+    def __init__(
+        self, distortion_coefficients: list, threads: Optional[int] = None, max_in_flight: Optional[int] = None,
+        map_cache: Optional[DistortionMapCache] = None, interpolation: int = INTER_LINEAR, jpeg_quality: Optional[int] = None
+    ) -> None:
+        """
+        :param max_in_flight: Frames submitted ahead of the one being yielded, by default 2 per thread.
+        :param jpeg_quality: When set, frames are yielded JPEG encoded (encoded on the pool), e.g. for streaming.
+        """
+        self.distortion_coefficients = distortion_coefficients
+        self.threads = threads or cpu_count()
+        self.max_in_flight = max_in_flight or 2 * self.threads
+        self.map_cache = map_cache or DistortionMapCache()
+        self.interpolation = interpolation
+        self.jpeg_quality = jpeg_quality
+        # One more buffer than frames in flight, so the frame being yielded is never written to.
+        self._buffers = [None] * (self.max_in_flight + 1)
+
+    def _dewarp_frame(self, frame: np.ndarray, buffer_idx: int) -> Union[np.ndarray, bytes]:
+        if isinstance(frame, bytes) or frame.ndim == 1:
+            frame = imdecode(np.frombuffer(frame, dtype=np.uint8), IMREAD_COLOR)
+            if frame is None:
+                raise ValueError("Could not decode a frame")
+        dst = self._buffers[buffer_idx]
+        if dst is None or dst.shape != frame.shape or dst.dtype != frame.dtype:
+            dst = self._buffers[buffer_idx] = np.empty_like(frame)
+        map1, map2 = self.map_cache.get_maps(frame.shape[:2], self.distortion_coefficients, self.interpolation)
+        # remap directly rather than `apply_distortion_mat`, which prints the time of every frame.
+        remap(frame, map1, map2, self.interpolation, dst=dst)
+        if self.jpeg_quality is None:
+            return dst
+        _, encoded = imencode(".jpg", dst, [IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+        return encoded.tobytes()
+
+    def run(self, frames: Iterable) -> Iterator[Union[np.ndarray, bytes]]:
+        """
+        Yields the de-warped frames in input order, each as soon as it and the frames before it are done.
+        A yielded array is only valid until the next frame is requested, its buffer is then reused, so copy frames
+        that need to be kept.
+        """
+        with ThreadPoolExecutor(self.threads) as executor:
+            futures = deque()
+            for frame_idx, frame in enumerate(frames):
+                futures.append(executor.submit(self._dewarp_frame, frame, frame_idx % len(self._buffers)))
+                # Only wait on the oldest frame once max_in_flight are queued, otherwise keep reading frames.
+                if len(futures) > self.max_in_flight:
+                    yield futures.popleft().result()
+                while futures and futures[0].done():
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
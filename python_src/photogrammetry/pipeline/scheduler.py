@@ -0,0 +1,179 @@
+from collections import defaultdict
+from dataclasses import dataclass, field
+from multiprocessing.pool import Pool
+from typing import Any, Callable, Hashable, Optional
+import multiprocessing
+import queue
+import time
+
+
+@dataclass(frozen=True)
+class TaskRef:
+    """
+    Stands in for the result of another task in a task's arguments.
+    """
+    key: Hashable
+
+
+@dataclass
+class PipelineTask:
+    key: Hashable
+    function: Callable
+    args: tuple
+    # Tasks of a group are admitted together, see `PipelineScheduler.max_groups_in_flight`.
+    group: int
+    keep: bool
+    dependencies: list = field(default_factory=list)
+
+
+@dataclass
+class TaskStats:
+    key: Hashable
+    group: int
+    seconds: float
+    # Seconds since the start of the run.
+    started: float
+    finished: float
+
+
+def _run_task(function: Callable, args: tuple) -> tuple[Any, float, float]:
+    """
+    Pool worker, times the task on the worker so queueing isn't counted.
+    """
+    start = time.perf_counter()
+    result = function(*args)
+    return result, start, time.perf_counter()
+
+
+def _task_refs(args) -> list:
+    return [arg for arg in args if isinstance(arg, TaskRef)]
+
+
+class PipelineScheduler:
+    """
+    Runs a DAG of tasks on one shared process pool. A task starts as soon as the tasks it references are done,
+    so independent images overlap, e.g. image 2 is processed while image 1 is matched.
+
+    Tasks are grouped, typically one group per image, and groups are admitted in order with at most
+    `max_groups_in_flight` unfinished at once. That bounds how many images (and their intermediate arrays)
+    are held at a time when running over many images. Results are dropped once every task that references them
+    has run, unless the task was added with keep=True.
+
+    Task functions and arguments are pickled to the workers, so they must be module level functions, and
+    results travel back through the parent process. Prefer passing arrays and `KeypointSet`s over `KeyPoint` lists.
+    """
+    def __init__(self, processes: Optional[int] = None, max_groups_in_flight: Optional[int] = None, pool: Optional[Pool] = None) -> None:
+        """
+        :param processes: Size of the worker pool, by default the number of CPUs. Required with `pool`, as its size.
+        :param max_groups_in_flight: By default 2 per process, so every process has a group queued behind the running one.
+        :param pool: An existing pool to run on, left open after running.
+        """
+        if pool is not None and processes is None:
+            raise ValueError("Pass the number of processes of the given pool")
+        self.processes = processes or multiprocessing.cpu_count()
+        self.max_groups_in_flight = max_groups_in_flight or 2 * self.processes
+        if self.max_groups_in_flight < 1:
+            raise ValueError(f"max_groups_in_flight must be at least 1, not {self.max_groups_in_flight}")
+        self._pool = pool
+        self._tasks = {}
+        self.task_stats = []
+
+    def add_task(self, key: Hashable, function: Callable, *args, group: int = 0, keep: bool = False) -> TaskRef:
+        """
+        Adds a task calling function(*args), where any `TaskRef` argument is replaced by that task's result.
+        Referenced tasks must already have been added, which keeps the graph acyclic, and be in the same or an
+        earlier group, so an admitted group never waits on one that can't be admitted.
+        :return: A reference to this task's result, for use in later tasks' arguments.
+        """
+        if key in self._tasks:
+            raise ValueError(f"A task with the key {key} was already added")
+        dependencies = []
+        for task_ref in _task_refs(args):
+            if task_ref.key not in self._tasks:
+                raise ValueError(f"Task {key} depends on {task_ref.key}, which hasn't been added")
+            if self._tasks[task_ref.key].group > group:
+                raise ValueError(f"Task {key} of group {group} depends on {task_ref.key} of the later group {self._tasks[task_ref.key].group}")
+            if task_ref.key not in dependencies:
+                dependencies.append(task_ref.key)
+        self._tasks[key] = PipelineTask(key, function, args, group, keep, dependencies)
+        return TaskRef(key)
+
+    def run(self) -> dict:
+        """
+        Runs every task. Raises the first exception raised by a task.
+        :return: The results of the tasks added with keep=True, by key.
+        """
+        if self._pool is not None:
+            return self._run_on_pool(self._pool)
+        with multiprocessing.Pool(self.processes) as pool:
+            return self._run_on_pool(pool)
+
+    def _run_on_pool(self, pool: Pool) -> dict:
+        self.task_stats = []
+        results = {}
+        kept_results = {}
+        num_waiting_on = {key: len(task.dependencies) for key, task in self._tasks.items()}
+        dependents = defaultdict(list)
+        for task in self._tasks.values():
+            for dependency in task.dependencies:
+                dependents[dependency].append(task.key)
+        num_unfinished_dependents = {key: len(dependents[key]) for key in self._tasks}
+        tasks_of_groups = defaultdict(list)
+        for task in self._tasks.values():
+            tasks_of_groups[task.group].append(task.key)
+        pending_groups = sorted(tasks_of_groups)
+        num_unfinished_in_group = {group: len(keys) for group, keys in tasks_of_groups.items()}
+        admitted_groups = set()
+        # Callbacks run on the pool's result thread, the results are handled here on the main thread.
+        finished = queue.Queue()
+        run_start = time.perf_counter()
+        num_running = 0
+
+        def submit(key) -> None:
+            nonlocal num_running
+            task = self._tasks[key]
+            args = tuple(results[arg.key] if isinstance(arg, TaskRef) else arg for arg in task.args)
+            pool.apply_async(
+                _run_task, (task.function, args),
+                callback=lambda output: finished.put((key, output, None)),
+                error_callback=lambda error: finished.put((key, None, error))
+            )
+            num_running += 1
+
+        def admit_groups() -> None:
+            while pending_groups and len(admitted_groups) < self.max_groups_in_flight:
+                group = pending_groups.pop(0)
+                admitted_groups.add(group)
+                for key in tasks_of_groups[group]:
+                    if num_waiting_on[key] == 0:
+                        submit(key)
+
+        admit_groups()
+        while num_running > 0:
+            key, output, error = finished.get()
+            num_running -= 1
+            if error is not None:
+                raise error
+            task = self._tasks[key]
+            result, started, ended = output
+            self.task_stats.append(TaskStats(key, task.group, ended - started, started - run_start, ended - run_start))
+            results[key] = result
+            if task.keep:
+                kept_results[key] = result
+
+            for dependency in task.dependencies:
+                num_unfinished_dependents[dependency] -= 1
+                if num_unfinished_dependents[dependency] == 0:
+                    del results[dependency]
+            if num_unfinished_dependents[key] == 0:
+                del results[key]
+            for dependent in dependents[key]:
+                num_waiting_on[dependent] -= 1
+                if num_waiting_on[dependent] == 0 and self._tasks[dependent].group in admitted_groups:
+                    submit(dependent)
+
+            num_unfinished_in_group[task.group] -= 1
+            if num_unfinished_in_group[task.group] == 0:
+                admitted_groups.remove(task.group)
+                admit_groups()
+        return kept_results
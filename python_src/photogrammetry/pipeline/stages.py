@@ -0,0 +1,170 @@
+from cv2 import imread, cvtColor, COLOR_BGR2GRAY
+from dataclasses import dataclass
+from photogrammetry.clustering.hierarchical import ChunkedHierarchicalClustering
+from photogrammetry.clustering.single_linkage import SingleLinkageClustering
+from photogrammetry.image_processing.descriptors import (
+    compute_brief_descriptors, compute_steered_brief_descriptors, intensity_centroid_orientations
+)
+from photogrammetry.image_processing.keypoint_detection import detect_segment_test_points, score_and_suppress
+from photogrammetry.image_processing.keypoint_matching import match_keypoints, match_keypoints_spatial
+from photogrammetry.image_processing.warping import apply_distortion_mat
+from photogrammetry.models.keypoint_set import KeypointSet
+from photogrammetry.pipeline.scheduler import PipelineScheduler
+from photogrammetry.storage.distortion_map_cache import DistortionMapCache
+import numpy as np
+from typing import Optional
+
+CLUSTERING_MODES = ("centroid", "single", "none")
+MATCH_PAIRS = ("consecutive", "all")
+# Per process, so each worker opens the maps once.
+_distortion_map_cache = None
+
+
+@dataclass
+class PipelineConfig:
+    detection_threshold: int = 50
+    nms_radius: Optional[int] = None
+    # Radial distortion coefficients, see `generate_distortion_mat`. None skips de-warping.
+    distortion_coefficients: Optional[list] = None
+    # "centroid" is the chunked `HierarchicalClustering`, "single" is `SingleLinkageClustering`.
+    clustering: str = "centroid"
+    max_merge_dist: int = 25
+    steered: bool = False
+    match_threshold: int = 75
+    ratio: Optional[float] = 0.8
+    # When set, matches are searched for within this many pixels, see `match_keypoints_spatial`.
+    search_radius: Optional[int] = None
+    # Which image pairs are matched, each image with the next or every pair.
+    match_pairs: str = "consecutive"
+
+
+# Stage functions, run one after the other on a pool worker by `extract_keypoints`, so only the small
+# `KeypointSet`s travel between processes.
+
+def load_image(file_path: str) -> np.ndarray:
+    image = imread(file_path)
+    if image is None:
+        raise ValueError(f"Could not read the image {file_path}")
+    return image
+
+
+def _get_distortion_map_cache() -> DistortionMapCache:
+    global _distortion_map_cache
+    if _distortion_map_cache is None:
+        _distortion_map_cache = DistortionMapCache()
+    return _distortion_map_cache
+
+
+def dewarp_image(image: np.ndarray, distortion_coefficients: list) -> np.ndarray:
+    """
+    Reads the maps from the worker's `DistortionMapCache`. The first worker to need maps of a dim generates and
+    stores them, later workers open the stored maps.
+    """
+    return apply_distortion_mat(image, _get_distortion_map_cache().get_maps(image.shape[:2], distortion_coefficients))
+
+
+def to_grayscale(image: np.ndarray) -> np.ndarray:
+    """
+    The same int16 grayscale image as `ImageDB.get_bw_image`.
+    """
+    return cvtColor(image, COLOR_BGR2GRAY).astype(np.int16)
+
+
+def detect_keypoints(bw_image: np.ndarray, image_id: int, threshold, nms_radius: Optional[int] = None) -> KeypointSet:
+    coords, scores = score_and_suppress(bw_image, detect_segment_test_points(bw_image, threshold), threshold, nms_radius)
+    return KeypointSet(coords, image_id, scores)
+
+
+def cluster_keypoints(keypoints: KeypointSet, image_dim: tuple[int, int], clustering: str, max_merge_dist: int) -> KeypointSet:
+    """
+    Clusters on the calling worker, the pool already runs one image per process.
+    """
+    if clustering == "none":
+        return keypoints
+    if clustering == "single":
+        return SingleLinkageClustering(keypoints, max_merge_dist).run_clustering()
+    if clustering == "centroid":
+        return ChunkedHierarchicalClustering(image_dim, keypoints, max_merge_dist=max_merge_dist).run_clustering()
+    raise ValueError(f"Unknown clustering {clustering}, expected one of {CLUSTERING_MODES}")
+
+
+def describe_keypoints(
+    bw_image: np.ndarray, keypoints: KeypointSet, gaussian_pairs: np.ndarray, pattern_id: Optional[str] = None, steered: bool = False
+) -> KeypointSet:
+    """
+    Single image `compute_keypoint_set_descriptors`, taking the grayscale image instead of an `ImageDB`.
+    """
+    if steered:
+        orientations = intensity_centroid_orientations(bw_image, keypoints.coords)
+        descriptors, _ = compute_steered_brief_descriptors(bw_image, keypoints.coords, orientations, gaussian_pairs)
+        return keypoints.with_descriptors(descriptors, pattern_id, orientations)
+    descriptors, _ = compute_brief_descriptors(bw_image, keypoints.coords, gaussian_pairs)
+    return keypoints.with_descriptors(descriptors, pattern_id)
+
+
+def extract_keypoints(
+    image_path: str, image_id: int, config: PipelineConfig, gaussian_pairs: np.ndarray, pattern_id: Optional[str] = None
+) -> KeypointSet:
+    """
+    load -> (dewarp) -> grayscale -> detect -> cluster -> describe of one image, as one task so that the image and
+    its grayscale never leave the worker. Clustering chunks come from the image's own dim.
+    """
+    image = load_image(image_path)
+    if config.distortion_coefficients is not None:
+        image = dewarp_image(image, config.distortion_coefficients)
+    bw_image = to_grayscale(image)
+    del image
+    keypoints = detect_keypoints(bw_image, image_id, config.detection_threshold, config.nms_radius)
+    keypoints = cluster_keypoints(keypoints, bw_image.shape, config.clustering, config.max_merge_dist)
+    return describe_keypoints(bw_image, keypoints, gaussian_pairs, pattern_id, config.steered)
+
+
+def match_keypoint_sets(
+    keypoints1: KeypointSet, keypoints2: KeypointSet, match_threshold: int, ratio: Optional[float] = 0.8,
+    search_radius: Optional[int] = None
+) -> np.ndarray:
+    """
+    :return: (K, 3) array of [keypoint1 idx, keypoint2 idx, hamming distance], as `match_keypoints_spatial`.
+    """
+    if search_radius is not None:
+        return match_keypoints_spatial(keypoints1, keypoints2, search_radius, ratio=ratio, max_distance=match_threshold)
+    closest = match_keypoints(keypoints1, keypoints2, k=2)
+    if closest.shape[1] == 0:
+        return np.zeros((0, 3), dtype=np.int64)
+    keep = closest[:, 0, 1] <= match_threshold
+    if ratio is not None and closest.shape[1] == 2:
+        keep &= closest[:, 0, 1] < ratio * closest[:, 1, 1]
+    idxs1 = np.flatnonzero(keep)
+    return np.column_stack([idxs1, closest[idxs1, 0, 0], closest[idxs1, 0, 1]]).astype(np.int64)
+
+
+def image_pairs(num_images: int, match_pairs: str) -> list[tuple[int, int]]:
+    if match_pairs == "consecutive":
+        return [(image_id, image_id + 1) for image_id in range(num_images - 1)]
+    if match_pairs == "all":
+        return [(image_id1, image_id2) for image_id2 in range(num_images) for image_id1 in range(image_id2)]
+    raise ValueError(f"Unknown match pairs {match_pairs}, expected one of {MATCH_PAIRS}")
+
+
+def build_image_pipeline(
+    scheduler: PipelineScheduler, image_paths: list[str], config: PipelineConfig, gaussian_pairs: np.ndarray,
+    pattern_id: Optional[str] = None
+) -> None:
+    """
+    Adds an `extract_keypoints` task for every image, and a match task for each image pair, to `scheduler`.
+    Image i is group i, and a pair's match belongs to its later image. Images may differ in size.
+
+    Keeps ("keypoints", image_id), the described keypoints, and ("match", image_id1, image_id2), the matches, in the run results.
+    """
+    described = []
+    for image_id, image_path in enumerate(image_paths):
+        described.append(scheduler.add_task(
+            ("keypoints", image_id), extract_keypoints, image_path, image_id, config, gaussian_pairs, pattern_id,
+            group=image_id, keep=True
+        ))
+
+    for image_id1, image_id2 in image_pairs(len(image_paths), config.match_pairs):
+        scheduler.add_task(
+            ("match", image_id1, image_id2), match_keypoint_sets, described[image_id1], described[image_id2],
+            config.match_threshold, config.ratio, config.search_radius, group=image_id2, keep=True
+        )
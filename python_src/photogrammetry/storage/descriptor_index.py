@@ -0,0 +1,172 @@
+import numpy as np
+from typing import Optional
+from photogrammetry.models.keypoint_set import KeypointSet
+from photogrammetry.utils.arrays import expand_ranges, group_ranks
+from photogrammetry.utils.hamming import paired_hamming_distances
+
+# Queries per batch, bounds the candidate (query, entry) pair arrays.
+QUERY_BATCH_SIZE = 1024
+
+
+class DescriptorIndex:
+    """
+    Multi-index hashing over packed binary descriptors, for matching one image against many.
+
+    Each descriptor is split into `num_substrings` substrings and each substring gets a table of entries sorted by
+    its value. A query looks up its own substrings, plus every value within `probe_radius` bit flips of them, and
+    only computes full Hamming distances for the entries found. By the pigeonhole principle every entry within
+    num_substrings * (probe_radius + 1) - 1 bits of the query is found (31 bits with the defaults), farther entries
+    may be missed. The cost of a query depends on the bucket sizes, not on the total number of entries.
+    https://www.cs.toronto.edu/~norouzi/research/papers/multi_index_hashing.pdf
+    """
+    def __init__(self, num_bytes: int = 32, num_substrings: int = 16, probe_radius: int = 1) -> None:
+        if num_bytes % num_substrings != 0 or num_bytes // num_substrings > 4:
+            raise ValueError(f"{num_bytes} descriptor bytes can't be split into {num_substrings} substrings of at most 4 bytes")
+        self.num_bytes = num_bytes
+        self.num_substrings = num_substrings
+        self.probe_radius = probe_radius
+        self.pattern_id = None
+        self._substring_bytes = num_bytes // num_substrings
+        self._descriptors = np.empty((0, num_bytes), dtype=np.uint8)
+        self._image_ids = np.empty(0, dtype=np.int32)
+        self._keypoint_idxs = np.empty(0, dtype=np.int32)
+        # Per substring, the substring values of all entries in sorted order, and the entry each belongs to.
+        self._sorted_keys = np.empty((num_substrings, 0), dtype=np.uint32)
+        self._sorted_entries = np.empty((num_substrings, 0), dtype=np.int32)
+        self._probe_masks = self._build_probe_masks()
+
+    def __len__(self) -> int:
+        return len(self._descriptors)
+
+    def _build_probe_masks(self) -> np.ndarray:
+        """
+        XOR masks with at most `probe_radius` bits set, 0 (the exact bucket) first.
+        """
+        num_bits = 8 * self._substring_bytes
+        masks = np.zeros(1, dtype=np.uint32)
+        for _ in range(self.probe_radius):
+            flipped = (masks[:, np.newaxis] ^ (np.uint32(1) << np.arange(num_bits, dtype=np.uint32))).ravel()
+            masks = np.unique(np.concatenate([masks, flipped]))
+        return masks
+
+    def _substring_keys(self, descriptors: np.ndarray) -> np.ndarray:
+        """
+        (N, num_substrings) substring values, reading each substring's bytes as a little endian integer.
+        """
+        substrings = descriptors.reshape(len(descriptors), self.num_substrings, self._substring_bytes).astype(np.uint32)
+        shifts = np.uint32(8) * np.arange(self._substring_bytes, dtype=np.uint32)
+        return np.bitwise_or.reduce(substrings << shifts, axis=2)
+
+    def add(self, image_id: int, descriptors: np.ndarray, pattern_id: Optional[str] = None) -> None:
+        """
+        Bulk inserts the descriptors of one image. Keypoint indexes continue after the entries already added for
+        `image_id`, so entry i of the first add is keypoint i, and adding an image in parts indexes it as if it was
+        added at once.
+        """
+        descriptors = np.ascontiguousarray(descriptors, dtype=np.uint8).reshape(-1, self.num_bytes)
+        if pattern_id is not None:
+            if self.pattern_id is not None and self.pattern_id != pattern_id:
+                raise ValueError(f"Can't add descriptors from pattern {pattern_id} to an index of {self.pattern_id}")
+            self.pattern_id = pattern_id
+        first_entry = len(self._descriptors)
+        first_keypoint_idx = np.count_nonzero(self._image_ids == image_id)
+        new_keys = self._substring_keys(descriptors)
+        sorted_keys = []
+        sorted_entries = []
+        # Merge the sorted new entries into each table, linear in the table size rather than re-sorting it.
+        for substring in range(self.num_substrings):
+            order = np.argsort(new_keys[:, substring], kind='stable')
+            keys = new_keys[order, substring]
+            positions = np.searchsorted(self._sorted_keys[substring], keys, side='right')
+            sorted_keys.append(np.insert(self._sorted_keys[substring], positions, keys))
+            sorted_entries.append(np.insert(self._sorted_entries[substring], positions, order.astype(np.int32) + first_entry))
+        self._sorted_keys = np.array(sorted_keys, dtype=np.uint32).reshape(self.num_substrings, -1)
+        self._sorted_entries = np.array(sorted_entries, dtype=np.int32).reshape(self.num_substrings, -1)
+        self._descriptors = np.concatenate([self._descriptors, descriptors])
+        self._image_ids = np.concatenate([self._image_ids, np.full(len(descriptors), image_id, dtype=np.int32)])
+        self._keypoint_idxs = np.concatenate([self._keypoint_idxs, np.arange(
+            first_keypoint_idx, first_keypoint_idx + len(descriptors), dtype=np.int32
+        )])
+
+    def add_keypoint_set(self, keypoint_set: KeypointSet) -> None:
+        if keypoint_set.descriptors is None:
+            raise ValueError("The KeypointSet has no descriptors, see compute_keypoint_set_descriptors")
+        for image_id in np.unique(keypoint_set.image_ids):
+            self.add(int(image_id), keypoint_set.for_image(image_id).descriptors, keypoint_set.pattern_id)
+
+    def _candidate_pairs(self, query_keys: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Unique (query, entry) pairs where the entry shares a probed bucket with the query in any substring.
+        """
+        num_queries = len(query_keys)
+        query_idxs = []
+        entry_idxs = []
+        for substring in range(self.num_substrings):
+            probes = (query_keys[:, substring, np.newaxis] ^ self._probe_masks).ravel()
+            starts = np.searchsorted(self._sorted_keys[substring], probes, side='left')
+            counts = np.searchsorted(self._sorted_keys[substring], probes, side='right') - starts
+            query_idxs.append(np.repeat(np.repeat(np.arange(num_queries), len(self._probe_masks)), counts))
+            entry_idxs.append(self._sorted_entries[substring][expand_ranges(starts, counts)])
+        pair_keys = np.unique(np.concatenate(query_idxs) * len(self) + np.concatenate(entry_idxs))
+        return pair_keys // len(self), pair_keys % len(self)
+
+    def query(
+        self, descriptors: np.ndarray, k: int = 2, exclude_image_id: Optional[int] = None, pattern_id: Optional[str] = None
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Finds the k nearest indexed descriptors of each query descriptor.
+        :param exclude_image_id: Ignore entries of this image, e.g. when the queried image has already been added.
+        :return: (Q, k) image ids, (Q, k) keypoint indexes within those images and (Q, k) Hamming distances,
+            closest first. Queries with fewer than k candidates are padded with -1.
+        """
+        if pattern_id is not None and self.pattern_id is not None and pattern_id != self.pattern_id:
+            raise ValueError(f"Can't query an index of {self.pattern_id} with descriptors from {pattern_id}")
+        descriptors = np.ascontiguousarray(descriptors, dtype=np.uint8).reshape(-1, self.num_bytes)
+        image_ids = np.full((len(descriptors), k), -1, dtype=np.int32)
+        keypoint_idxs = np.full((len(descriptors), k), -1, dtype=np.int32)
+        distances = np.full((len(descriptors), k), -1, dtype=np.int32)
+        if len(self) == 0:
+            return image_ids, keypoint_idxs, distances
+
+        for start in range(0, len(descriptors), QUERY_BATCH_SIZE):
+            batch = descriptors[start:start + QUERY_BATCH_SIZE]
+            query_idxs, entry_idxs = self._candidate_pairs(self._substring_keys(batch))
+            if exclude_image_id is not None:
+                is_other_image = self._image_ids[entry_idxs] != exclude_image_id
+                query_idxs = query_idxs[is_other_image]
+                entry_idxs = entry_idxs[is_other_image]
+            pair_distances = paired_hamming_distances(batch[query_idxs], self._descriptors[entry_idxs])
+            # Order by query, then distance, then entry and keep the first k of each query.
+            order = np.lexsort((entry_idxs, pair_distances, query_idxs))
+            query_idxs = query_idxs[order]
+            entry_idxs = entry_idxs[order]
+            pair_distances = pair_distances[order]
+            ranks = group_ranks(query_idxs)
+            in_top_k = ranks < k
+            rows = start + query_idxs[in_top_k]
+            cols = ranks[in_top_k]
+            image_ids[rows, cols] = self._image_ids[entry_idxs[in_top_k]]
+            keypoint_idxs[rows, cols] = self._keypoint_idxs[entry_idxs[in_top_k]]
+            distances[rows, cols] = pair_distances[in_top_k]
+        return image_ids, keypoint_idxs, distances
+
+    def save(self, file_path) -> None:
+        np.savez(
+            file_path, descriptors=self._descriptors, image_ids=self._image_ids, keypoint_idxs=self._keypoint_idxs,
+            sorted_keys=self._sorted_keys, sorted_entries=self._sorted_entries,
+            params=np.array([self.num_bytes, self.num_substrings, self.probe_radius]),
+            pattern_id=np.array("" if self.pattern_id is None else self.pattern_id)
+        )
+
+    @classmethod
+    def load(cls, file_path):
+        with np.load(file_path) as stored:
+            num_bytes, num_substrings, probe_radius = (int(param) for param in stored["params"])
+            index = cls(num_bytes, num_substrings, probe_radius)
+            index._descriptors = stored["descriptors"]
+            index._image_ids = stored["image_ids"]
+            index._keypoint_idxs = stored["keypoint_idxs"]
+            index._sorted_keys = stored["sorted_keys"]
+            index._sorted_entries = stored["sorted_entries"]
+            index.pattern_id = str(stored["pattern_id"]) or None
+        return index
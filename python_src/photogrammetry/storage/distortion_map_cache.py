@@ -0,0 +1,109 @@
+from collections import OrderedDict
+from cv2 import convertMaps, INTER_LINEAR, INTER_NEAREST, CV_16SC2
+from os import getpid, replace
+from pathlib import Path
+from threading import Lock, get_ident
+from typing import Optional
+import numpy as np
+from photogrammetry.image_processing.warping import RadialDistortionLUT
+
+
+class DistortionMapCache:
+    """
+    Stores de-warping maps on disk in the form `cv2.remap` takes them, keyed by (image dim, distortion coefficients,
+    interpolation), so applying a cached map is only the `remap` call. See `apply_distortion_mat`.
+
+    Maps are opened memory-mapped, and the last `max_entries` used are kept in an in-process LRU, so a stream of same
+    sized frames reads its maps from disk once. Safe to share between threads.
+    """
+    def __init__(self, data_dir="./data/distortion_maps", max_entries: int = 4, fixed_point: bool = True, samples_per_pixel: int = 4) -> None:
+        """
+        :param fixed_point: Store OpenCV's fixed-point maps, half the size of float32 maps and faster to remap,
+            at 1/32 pixel precision.
+        :param samples_per_pixel: See `RadialDistortionLUT`.
+        """
+        self.base_dir_path = Path(data_dir)
+        self.base_dir_path.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.fixed_point = fixed_point
+        self.samples_per_pixel = samples_per_pixel
+        self._maps = OrderedDict()
+        self._lock = Lock()
+        # One lock per key, so only one thread generates a key's maps while the others wait for them. A key's lock is
+        # dropped once no thread holds or waits on it, counted in _key_lock_users.
+        self._key_locks: dict[tuple, Lock] = {}
+        self._key_lock_users: dict[tuple, int] = {}
+
+    def get_maps(
+        self, image_dim: tuple[int, int], distortion_coefficients: list, interpolation: int = INTER_LINEAR, refresh_cache: bool = False
+    ) -> tuple[np.ndarray, Optional[np.ndarray]]:
+        """
+        Returns the (map1, map2) pair for `remap`, generating and storing it the first time it's requested.
+        map2 is None for fixed-point maps with INTER_NEAREST, which only need the integer coords.
+        """
+        key = (tuple(int(dim) for dim in image_dim), tuple(float(coefficient) for coefficient in distortion_coefficients), interpolation)
+        with self._lock:
+            if not refresh_cache and key in self._maps:
+                self._maps.move_to_end(key)
+                return self._maps[key]
+            key_lock = self._key_locks.setdefault(key, Lock())
+            self._key_lock_users[key] = self._key_lock_users.get(key, 0) + 1
+        try:
+            with key_lock:
+                return self._load_maps(key, refresh_cache)
+        finally:
+            with self._lock:
+                self._key_lock_users[key] -= 1
+                if self._key_lock_users[key] == 0:
+                    del self._key_lock_users[key]
+                    del self._key_locks[key]
+
+    def _load_maps(self, key: tuple, refresh_cache: bool) -> tuple[np.ndarray, Optional[np.ndarray]]:
+        """
+        Loads the key's maps into the LRU, generating them if they aren't on disk. Called holding the key's lock.
+        """
+        with self._lock:
+            # Loaded by another thread while this one waited for the key.
+            if not refresh_cache and key in self._maps:
+                self._maps.move_to_end(key)
+                return self._maps[key]
+        map_paths = self._map_paths(*key)
+        if refresh_cache or not map_paths[0].exists():
+            self._store_maps(map_paths, self._generate_maps(*key))
+        maps = (
+            np.load(map_paths[0], mmap_mode='r'),
+            np.load(map_paths[1], mmap_mode='r') if map_paths[1].exists() else None
+        )
+        with self._lock:
+            self._maps[key] = maps
+            self._maps.move_to_end(key)
+            while len(self._maps) > self.max_entries:
+                self._maps.popitem(last=False)
+        return maps
+
+    def _generate_maps(self, image_dim: tuple[int, int], distortion_coefficients: tuple, interpolation: int) -> tuple:
+        map_x, map_y = RadialDistortionLUT(image_dim, list(distortion_coefficients), self.samples_per_pixel).to_maps()
+        if not self.fixed_point:
+            return map_x, map_y
+        map1, map2 = convertMaps(map_x, map_y, CV_16SC2, nninterpolation=interpolation == INTER_NEAREST)
+        return map1, None if interpolation == INTER_NEAREST else map2
+
+    @staticmethod
+    def _store_maps(map_paths: tuple[Path, Path], maps: tuple) -> None:
+        # map1 is written last, its existence marks the pair as complete.
+        for map_path, map_array in reversed(list(zip(map_paths, maps))):
+            if map_array is None:
+                map_path.unlink(missing_ok=True)
+                continue
+            # Written aside and renamed, so other processes and threads never open a half written map.
+            tmp_path = map_path.with_name(f"{map_path.stem}.{getpid()}_{get_ident()}.tmp.npy")
+            np.save(tmp_path, map_array)
+            replace(tmp_path, map_path)
+
+    def _map_paths(self, image_dim: tuple[int, int], distortion_coefficients: tuple, interpolation: int) -> tuple[Path, Path]:
+        height, width = image_dim
+        name = (
+            f'dim_{width}x{height}_coeff_{"_".join([str(x) for x in distortion_coefficients])}_interp{interpolation}'
+            f'_{"fixed" if self.fixed_point else "float"}_spp{self.samples_per_pixel}'
+        )
+        return self.base_dir_path.joinpath(f"{name}_map1.npy"), self.base_dir_path.joinpath(f"{name}_map2.npy")
@@ -1,4 +1,4 @@
-from cv2 import Mat, cvtColor, COLOR_BGR2GRAY
+from cv2 import Mat, cvtColor, resize, COLOR_BGR2GRAY, INTER_AREA
 import numpy as np
 
 # TODO probably move to a different package.
@@ -36,6 +36,39 @@ class ImageDB:
             self._images[image_id]["bw_i16"] = cvtColor(self._images[image_id]["bgr_original"], COLOR_BGR2GRAY).astype(np.int16)
         return self._images[image_id]["bw_i16"]
 
+    def get_bw_pyramid(self, image_id: int, num_levels: int, scale_factor: float = 2.0) -> list[np.ndarray]:
+        """
+        Returns `num_levels` grayscale images, where level i is downsampled by `scale_factor ** i`.
+        Levels are built once and cached per scale factor, so asking for more levels later only builds the new ones.
+        """
+        self._raise_if_image_is_missing(image_id)
+        pyramids = self._images[image_id].setdefault("bw_i16_pyramids", {})
+        pyramid = pyramids.setdefault(scale_factor, [self.get_bw_image(image_id)])
+        while len(pyramid) < num_levels:
+            level = len(pyramid)
+            dsize = (
+                max(1, round(self._image_width / scale_factor ** level)),
+                max(1, round(self._image_height / scale_factor ** level))
+            )
+            # Downsample from the previous level, INTER_AREA averages so fine detail doesn't alias.
+            pyramid.append(resize(pyramid[-1], dsize, interpolation=INTER_AREA))
+        return pyramid[:num_levels]
+
     def _raise_if_image_is_missing(self, image_id: int):
         if image_id not in self._images:
             raise ValueError(f"The image with the ID {image_id} could not be found in the ImageDB")
+
+
+def write_bw_image_file(image: Mat, file_path) -> None:
+    """
+    Stores the grayscale version of a BGR image as a uint8 .npy file, to be opened with `open_bw_image_file`.
+    """
+    np.save(file_path, cvtColor(image, COLOR_BGR2GRAY))
+
+
+def open_bw_image_file(file_path) -> np.ndarray:
+    """
+    Memory-maps a grayscale image written by `write_bw_image_file`. Rows are only read from disk when sliced,
+    so images larger than memory can be processed band by band.
+    """
+    return np.load(file_path, mmap_mode='r')
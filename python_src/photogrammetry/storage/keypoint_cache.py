@@ -1,9 +1,10 @@
 from pathlib import Path
 import json
-from typing import Optional
+from typing import Optional, Union
 from dataclasses import dataclass
 from uuid import uuid4
 import pickle
+from photogrammetry.models.keypoint_set import KeypointSet
 
 
 @dataclass
@@ -11,15 +12,19 @@ class KeypointCacheInfo:
     img_hash: int
     is_clustered: bool
     fast_detection_threshold: Optional[int] = None
+    nms_radius: Optional[int] = None
+    # See `DescriptorPatternRegistry`. Only descriptors from the same pattern can be reused.
+    descriptor_pattern_id: Optional[str] = None
 
     def as_dict(self):
         return {
             "img_hash": self.img_hash,
             "is_clustered": self.is_clustered,
-            "fast_detection_threshold": self.fast_detection_threshold
+            "fast_detection_threshold": self.fast_detection_threshold,
+            "nms_radius": self.nms_radius,
+            "descriptor_pattern_id": self.descriptor_pattern_id
         }
 
-# TODO critical importance - need to store gaussian pairs.
 # TODO need to create tmp folder if not exists.
 
 
@@ -32,19 +37,26 @@ class KeypointCache:
         self._create_cache_dir_if_not_exists()
         self.index_content = self._create_or_get_index()
 
-    def get_keypoints_if_exist(self, cache_info: KeypointCacheInfo) -> Optional[list]:
+    def get_keypoints_if_exist(self, cache_info: KeypointCacheInfo) -> Optional[Union[list, KeypointSet]]:
         if uid := self._exists_in_cache(cache_info):
+            # KeypointSets are stored as .npz, lists of KeyPoints are pickled.
+            set_path = self.base_dir_path.joinpath(f"{uid}.npz")
+            if set_path.exists():
+                return KeypointSet.load(set_path)
             with open(self.base_dir_path.joinpath(f"{uid}.dat"), "rb") as f:
                 return pickle.load(f)
         return None
 
-    def store_keypoints_if_not_exist(self, keypoints: list, cache_info: KeypointCacheInfo):
+    def store_keypoints_if_not_exist(self, keypoints: Union[list, KeypointSet], cache_info: KeypointCacheInfo):
         if self._exists_in_cache(cache_info):
             return
         uid = str(uuid4())
         self.index_content[uid] = cache_info.as_dict()
-        with open(self.base_dir_path.joinpath(f"{uid}.dat"), 'wb') as f:
-            pickle.dump(keypoints, f)
+        if isinstance(keypoints, KeypointSet):
+            keypoints.save(self.base_dir_path.joinpath(f"{uid}.npz"))
+        else:
+            with open(self.base_dir_path.joinpath(f"{uid}.dat"), 'wb') as f:
+                pickle.dump(keypoints, f)
         self._write_index()
         return uid
 
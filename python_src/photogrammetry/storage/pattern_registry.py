@@ -0,0 +1,55 @@
+from pathlib import Path
+import numpy as np
+from photogrammetry.models.keypoint import generate_gaussian_pairs
+
+# Bump when the way patterns are generated changes, so old and new descriptors are never compared.
+PATTERN_VERSION = 1
+
+
+def descriptor_pattern_id(stdev, num_pairs: int = 256, seed: int = 0, version: int = PATTERN_VERSION) -> str:
+    # The shortest exact float repr, so that e.g. 50 and 50.0 name the same pattern.
+    stdev_str = repr(float(stdev)).removesuffix(".0")
+    return f"brief_stdev{stdev_str}_pairs{num_pairs}_seed{seed}_v{version}"
+
+
+def _generate_pattern(stdev, num_pairs: int, seed: int, version: int) -> np.ndarray:
+    if version == 1:
+        return generate_gaussian_pairs(stdev, num_pairs, seed=seed)
+    raise ValueError(f"Unknown descriptor pattern version {version}")
+
+
+class DescriptorPatternRegistry:
+    """
+    Stores BRIEF sampling patterns on disk, keyed by (stdev, num_pairs, seed, version).
+
+    Descriptors are only comparable when they were computed with the same pattern, so descriptors record the
+    pattern id and cached descriptors can be reused by any run or process that loads the pattern from here.
+    """
+    def __init__(self, data_dir="./data/tmp/descriptor_patterns") -> None:
+        self.base_dir_path = Path(data_dir)
+        self.base_dir_path.mkdir(parents=True, exist_ok=True)
+        # Maps pattern id to pattern, so each process only reads a pattern from disk once.
+        self._patterns = {}
+
+    def get_pattern(self, stdev, num_pairs: int = 256, seed: int = 0, version: int = PATTERN_VERSION) -> tuple[str, np.ndarray]:
+        """
+        Returns the pattern id and the (num_pairs, 2, 2) pattern, generating and storing it the first time it's requested.
+        """
+        pattern_id = descriptor_pattern_id(stdev, num_pairs, seed, version)
+        if pattern_id in self._patterns or self._pattern_path(pattern_id).exists():
+            return pattern_id, self.get_pattern_by_id(pattern_id)
+        pattern = _generate_pattern(stdev, num_pairs, seed, version)
+        np.save(self._pattern_path(pattern_id), pattern)
+        self._patterns[pattern_id] = pattern
+        return pattern_id, pattern
+
+    def get_pattern_by_id(self, pattern_id: str) -> np.ndarray:
+        if pattern_id not in self._patterns:
+            pattern_path = self._pattern_path(pattern_id)
+            if not pattern_path.exists():
+                raise ValueError(f"The descriptor pattern {pattern_id} could not be found in {self.base_dir_path}")
+            self._patterns[pattern_id] = np.load(pattern_path)
+        return self._patterns[pattern_id]
+
+    def _pattern_path(self, pattern_id: str) -> Path:
+        return self.base_dir_path.joinpath(f"{pattern_id}.npy")
@@ -0,0 +1,21 @@
+import numpy as np
+
+
+def expand_ranges(starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    """
+    Concatenation of `arange(start, start + count)` for each start and count.
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(starts, counts) + offsets
+
+
+def group_ranks(group_ids: np.ndarray) -> np.ndarray:
+    """
+    Position of each element within its run of equal, sorted, group ids.
+    """
+    if len(group_ids) == 0:
+        return np.empty(0, dtype=np.int64)
+    run_starts = np.flatnonzero(np.r_[True, group_ids[1:] != group_ids[:-1]])
+    run_lengths = np.diff(np.r_[run_starts, len(group_ids)])
+    return np.arange(len(group_ids)) - np.repeat(run_starts, run_lengths)
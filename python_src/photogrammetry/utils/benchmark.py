@@ -0,0 +1,250 @@
+from cv2 import imread, resize, remap, INTER_AREA, INTER_LINEAR
+from dataclasses import dataclass, field, asdict
+from datetime import datetime
+from os import cpu_count, path
+from pathlib import Path
+from socket import gethostname
+from typing import Callable, Optional
+from uuid import uuid4
+import json
+import platform
+import subprocess
+import time
+import numpy as np
+from photogrammetry.clustering.hierarchical import ChunkedHierarchicalClustering
+from photogrammetry.clustering.single_linkage import SingleLinkageClustering
+from photogrammetry.image_processing.descriptors import compute_brief_descriptors
+from photogrammetry.image_processing.keypoint_detection import detect_segment_test_points, score_and_suppress
+from photogrammetry.image_processing.keypoint_matching import match_descriptors_top_k
+from photogrammetry.image_processing.warping import RadialDistortionLUT, generate_distortion_mat
+from photogrammetry.models.keypoint import generate_gaussian_pairs
+from photogrammetry.models.keypoint_set import KeypointSet
+from photogrammetry.storage.image_db import ImageDB
+
+BENCHMARKS = (
+    "detect", "cluster_single", "cluster_centroid", "describe", "match", "distortion_mat", "distortion_lut", "remap"
+)
+# The inputs under data/, outputs such as *_clustered_keypoints.jpg are skipped.
+DEFAULT_IMAGES = (
+    "./data/feature_clustering_test/15pt_star.png",
+    "./data/feature_detection_test/straight_edge_1920x1080.jpg",
+    "./data/dewarp_test/straight_edge_2560x1440.jpg",
+    "./data/feature_matching_test/lego_space_1_from_left.jpg",
+)
+
+
+@dataclass
+class BenchmarkParams:
+    detection_threshold: int = 50
+    nms_radius: int = 1
+    max_merge_dist: int = 25
+    descriptor_stdev: int = 50
+    distortion_coefficients: list = field(default_factory=lambda: [3e-4, 1e-7, 0, 0, 0])
+
+
+@dataclass
+class BenchmarkResult:
+    benchmark: str
+    image: str
+    # "{width}x{height}" of the image after scaling.
+    resolution: str
+    # Fastest of the repeats, less noisy than the mean on a busy machine.
+    seconds: float
+    mean_seconds: float
+    repeats: int
+    # What the benchmark produced, e.g. the number of keypoints, to spot a speedup that changed the output.
+    num_items: Optional[int] = None
+
+
+def git_commit(repo_dir: str = ".") -> Optional[str]:
+    """
+    The short commit hash, with "-dirty" when there are uncommitted changes. None outside of a git repo.
+    """
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=repo_dir, capture_output=True, text=True, check=True
+        ).stdout.strip()
+        status = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"], cwd=repo_dir, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return f"{commit}-dirty" if status else commit
+
+
+def run_info(params: BenchmarkParams, comment: str = "") -> dict:
+    return {
+        "run_id": str(uuid4()),
+        "timestamp": datetime.now().isoformat(),
+        "hostname": gethostname(),   # Use to differentiate between PCs
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "cpu_count": cpu_count(),
+        "params": asdict(params),
+        "comment": comment,
+    }
+
+
+def time_call(function: Callable, repeats: int) -> tuple[float, float, object]:
+    """
+    :return: The fastest and the mean seconds of `repeats` calls, and the last call's result.
+    """
+    times = []
+    result = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return min(times), sum(times) / len(times), result
+
+
+def scaled_image(image: np.ndarray, scale: float) -> np.ndarray:
+    if scale == 1:
+        return image
+    height, width = image.shape[:2]
+    return resize(image, (max(1, round(width * scale)), max(1, round(height * scale))), interpolation=INTER_AREA)
+
+
+def _num_items(result) -> Optional[int]:
+    if isinstance(result, tuple):
+        result = result[0]
+    try:
+        return len(result)
+    except TypeError:
+        return None
+
+
+def run_image_benchmarks(
+    image: np.ndarray, image_name: str, params: BenchmarkParams, repeats: int = 3, benchmarks: tuple = BENCHMARKS
+) -> list[BenchmarkResult]:
+    """
+    Times each stage on one image. Later stages take the previous stage's output, e.g. matching uses the described
+    keypoints, so every benchmark sees the same inputs a real run would.
+    """
+    height, width = image.shape[:2]
+    resolution = f"{width}x{height}"
+    image_dim = (height, width)
+    image_db = ImageDB(height, width)
+    bw_image = image_db.get_bw_image(image_db.add_image(image))
+    gaussian_pairs = generate_gaussian_pairs(params.descriptor_stdev, seed=0)
+
+    # Inputs of the later benchmarks, computed untimed whether or not their own benchmark is run.
+    raw_coords = detect_segment_test_points(bw_image, params.detection_threshold)
+    coords, scores = score_and_suppress(bw_image, raw_coords, params.detection_threshold, params.nms_radius)
+    descriptors, _ = compute_brief_descriptors(bw_image, coords, gaussian_pairs)
+    distortion_maps = RadialDistortionLUT(image_dim, params.distortion_coefficients).to_maps(fixed_point=True)
+    remapped = np.empty_like(image)
+
+    stage_functions = {
+        "detect": lambda: score_and_suppress(
+            bw_image, detect_segment_test_points(bw_image, params.detection_threshold), params.detection_threshold, params.nms_radius
+        ),
+        # Single linkage de-duplicates the raw detections, centroid linkage the non-maximum suppressed ones.
+        "cluster_single": lambda: SingleLinkageClustering(KeypointSet(raw_coords, 0), params.max_merge_dist).run_clustering(),
+        "cluster_centroid": lambda: ChunkedHierarchicalClustering(
+            image_dim, KeypointSet(coords, 0, scores), max_merge_dist=params.max_merge_dist
+        ).run_clustering(),
+        "describe": lambda: compute_brief_descriptors(bw_image, coords, gaussian_pairs),
+        # Against itself, the top 2 as for a ratio test.
+        "match": lambda: match_descriptors_top_k(descriptors, descriptors, k=2),
+        "distortion_mat": lambda: generate_distortion_mat(image_dim, params.distortion_coefficients),
+        "distortion_lut": lambda: RadialDistortionLUT(image_dim, params.distortion_coefficients).to_maps(fixed_point=True),
+        "remap": lambda: remap(image, distortion_maps[0], distortion_maps[1], INTER_LINEAR, dst=remapped),
+    }
+    results = []
+    for benchmark in benchmarks:
+        if benchmark not in stage_functions:
+            raise ValueError(f"Unknown benchmark {benchmark}, expected one of {BENCHMARKS}")
+        seconds, mean_seconds, result = time_call(stage_functions[benchmark], repeats)
+        num_items = None if benchmark in ("distortion_mat", "distortion_lut", "remap") else _num_items(result)
+        results.append(BenchmarkResult(benchmark, image_name, resolution, seconds, mean_seconds, repeats, num_items))
+    return results
+
+
+def run_benchmarks(
+    image_paths: list[str], scales: list[float], params: BenchmarkParams, repeats: int = 3, benchmarks: tuple = BENCHMARKS,
+    on_result: Optional[Callable[[BenchmarkResult], None]] = None
+) -> list[BenchmarkResult]:
+    results = []
+    for image_path in image_paths:
+        image = imread(image_path)
+        if image is None:
+            raise ValueError(f"Could not read the image {image_path}")
+        for scale in scales:
+            for result in run_image_benchmarks(scaled_image(image, scale), path.basename(image_path), params, repeats, benchmarks):
+                results.append(result)
+                if on_result is not None:
+                    on_result(result)
+    return results
+
+
+class BenchmarkLog:
+    """
+    Append-only JSONL history of benchmark runs, one line per result with its run's info (host, commit, params).
+    Runs are only ever appended, so the history never has to be read to record a new run.
+    """
+    def __init__(self, log_path="./data/benchmarks/history.jsonl") -> None:
+        self.log_path = Path(log_path)
+        self.log_path.parent.mkdir(parents=True, exist_ok=True)
+
+    def append(self, info: dict, results: list[BenchmarkResult]) -> None:
+        with open(self.log_path, "a") as fp:
+            for result in results:
+                fp.write(json.dumps({**info, **asdict(result)}) + "\n")
+
+    def read(self) -> list[dict]:
+        if not self.log_path.exists():
+            return []
+        with open(self.log_path, "r") as fp:
+            return [json.loads(line) for line in fp if line.strip()]
+
+    def runs(self) -> dict[str, list[dict]]:
+        """
+        The records of each run by run id, in the order the runs were logged.
+        """
+        runs = {}
+        for record in self.read():
+            runs.setdefault(record["run_id"], []).append(record)
+        return runs
+
+
+@dataclass
+class BenchmarkComparison:
+    benchmark: str
+    image: str
+    resolution: str
+    baseline_seconds: float
+    candidate_seconds: float
+    # candidate / baseline, < 1 is faster.
+    ratio: float
+    status: str
+
+
+def _record_key(record: dict) -> tuple:
+    return record["benchmark"], record["image"], record["resolution"]
+
+
+def compare_runs(baseline: list[dict], candidate: list[dict], threshold: float = 0.1) -> list[BenchmarkComparison]:
+    """
+    Compares the benchmarks both runs have. Each is a "regression" when the candidate is more than `threshold`
+    slower than the baseline, an "improvement" when it's more than `threshold` faster, otherwise "unchanged".
+    Runs with different params are still compared, check the params of both runs.
+    """
+    baseline_records = {_record_key(record): record for record in baseline}
+    comparisons = []
+    for record in candidate:
+        baseline_record = baseline_records.get(_record_key(record))
+        if baseline_record is None:
+            continue
+        ratio = record["seconds"] / max(baseline_record["seconds"], 1e-12)
+        if ratio > 1 + threshold:
+            status = "regression"
+        elif ratio < 1 - threshold:
+            status = "improvement"
+        else:
+            status = "unchanged"
+        comparisons.append(BenchmarkComparison(
+            record["benchmark"], record["image"], record["resolution"], baseline_record["seconds"], record["seconds"], ratio, status
+        ))
+    return comparisons
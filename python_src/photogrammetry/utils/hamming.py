@@ -0,0 +1,42 @@
+import numpy as np
+
+# Number of set bits in each byte value, used when numpy has no `bitwise_count` (numpy < 2.0).
+POPCOUNT_TABLE = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+
+def _descriptor_words(descriptors: np.ndarray) -> np.ndarray:
+    """
+    Views packed uint8 descriptors as uint64 words when they can be popcounted directly, otherwise keeps the bytes.
+    """
+    descriptors = np.ascontiguousarray(descriptors, dtype=np.uint8)
+    if hasattr(np, "bitwise_count") and descriptors.shape[1] % 8 == 0:
+        return descriptors.view(np.uint64)
+    return descriptors
+
+
+def _popcount(words: np.ndarray) -> np.ndarray:
+    if words.dtype == np.uint64:
+        return np.bitwise_count(words)
+    return POPCOUNT_TABLE[words]
+
+
+def hamming_distance_matrix(descriptors1: np.ndarray, descriptors2: np.ndarray) -> np.ndarray:
+    """
+    (N, M) Hamming distances between two sets of packed uint8 descriptors.
+    Accumulates one word column at a time so no (N, M, num_bytes) array is created.
+    """
+    words1 = _descriptor_words(descriptors1)
+    words2 = _descriptor_words(descriptors2)
+    distances = np.zeros((len(words1), len(words2)), dtype=np.uint16)
+    for word in range(words1.shape[1]):
+        distances += _popcount(words1[:, word, np.newaxis] ^ words2[np.newaxis, :, word])
+    return distances
+
+
+def paired_hamming_distances(descriptors1: np.ndarray, descriptors2: np.ndarray) -> np.ndarray:
+    """
+    (N,) Hamming distances between row i of `descriptors1` and row i of `descriptors2`.
+    """
+    words1 = _descriptor_words(descriptors1)
+    words2 = _descriptor_words(descriptors2)
+    return _popcount(words1 ^ words2).sum(axis=1, dtype=np.int32)
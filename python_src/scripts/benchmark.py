@@ -0,0 +1,104 @@
+from argparse import ArgumentParser
+import sys
+from photogrammetry.utils.benchmark import (
+    BENCHMARKS, DEFAULT_IMAGES, BenchmarkLog, BenchmarkParams, compare_runs, run_benchmarks, run_info
+)
+
+
+def setup_and_parse_args():
+    parser = ArgumentParser(
+        prog='benchmark',
+        description='Times the pipeline stages and keeps an append-only history to compare runs'
+    )
+    parser.add_argument('--log', default='./data/benchmarks/history.jsonl', required=False)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Run the benchmarks and append the results to the log')
+    run_parser.add_argument('--images', default=list(DEFAULT_IMAGES), nargs='+', required=False)
+    run_parser.add_argument('--scales', default=[1.0, 0.5], type=float, nargs='+', required=False)
+    run_parser.add_argument('--benchmarks', default=list(BENCHMARKS), choices=list(BENCHMARKS), nargs='+', required=False)
+    run_parser.add_argument('--repeats', default=3, type=int, required=False)
+    run_parser.add_argument('--detection-threshold', default=50, type=int, required=False)
+    run_parser.add_argument('--nms-radius', default=1, type=int, required=False)
+    run_parser.add_argument('--max-merge-dist', default=25, type=int, required=False)
+    run_parser.add_argument('--comment', default='', required=False)
+
+    compare_parser = subparsers.add_parser('compare', help='Flag regressions between two logged runs')
+    # Run ids, or negative indexes into the logged runs. By default the last run against the one before.
+    compare_parser.add_argument('--baseline', default='-2', required=False)
+    compare_parser.add_argument('--candidate', default='-1', required=False)
+    compare_parser.add_argument('--threshold', default=0.1, type=float, required=False)
+
+    subparsers.add_parser('list', help='List the logged runs')
+    return parser.parse_args()
+
+
+def run(args, log: BenchmarkLog):
+    params = BenchmarkParams(args.detection_threshold, args.nms_radius, args.max_merge_dist)
+    info = run_info(params, args.comment)
+    print(f"Run {info['run_id']} at commit {info['commit']} on {info['hostname']}")
+
+    def print_result(result):
+        items = "" if result.num_items is None else f", {result.num_items} items"
+        print(f"{result.benchmark:>16} {result.image} {result.resolution}: {result.seconds:.4f} seconds{items}")
+
+    results = run_benchmarks(args.images, args.scales, params, args.repeats, tuple(args.benchmarks), print_result)
+    log.append(info, results)
+    print(f"Appended {len(results)} results to {log.log_path}")
+
+
+def find_run(runs: dict, run_ref: str) -> tuple[str, list]:
+    if run_ref in runs:
+        return run_ref, runs[run_ref]
+    run_ids = list(runs)
+    try:
+        run_id = run_ids[int(run_ref)]
+    except (ValueError, IndexError):
+        raise ValueError(f"No run {run_ref} among the {len(run_ids)} logged runs") from None
+    return run_id, runs[run_id]
+
+
+def describe_run(run_id: str, records: list) -> str:
+    first = records[0]
+    return f"{run_id} {first['timestamp']} commit {first['commit']} on {first['hostname']} {first['comment']}".strip()
+
+
+def compare(args, log: BenchmarkLog):
+    runs = log.runs()
+    baseline_id, baseline = find_run(runs, args.baseline)
+    candidate_id, candidate = find_run(runs, args.candidate)
+    print(f"Baseline:  {describe_run(baseline_id, baseline)}")
+    print(f"Candidate: {describe_run(candidate_id, candidate)}")
+    if baseline[0]["params"] != candidate[0]["params"] or baseline[0]["hostname"] != candidate[0]["hostname"]:
+        print("NOTE the runs differ in params or host, differences may not come from the code.")
+
+    comparisons = compare_runs(baseline, candidate, args.threshold)
+    for comparison in comparisons:
+        print(
+            f"{comparison.status:>11} {comparison.benchmark:>16} {comparison.image} {comparison.resolution}: "
+            f"{comparison.baseline_seconds:.4f} -> {comparison.candidate_seconds:.4f} seconds ({comparison.ratio:.2f}x)"
+        )
+    num_regressions = sum(comparison.status == "regression" for comparison in comparisons)
+    print(f"{num_regressions} regressions in {len(comparisons)} benchmarks")
+    return num_regressions
+
+
+def list_runs(log: BenchmarkLog):
+    for run_id, records in log.runs().items():
+        print(f"{describe_run(run_id, records)}, {len(records)} results")
+
+
+def main():
+    args = setup_and_parse_args()
+    log = BenchmarkLog(args.log)
+    if args.command == 'run':
+        run(args, log)
+    elif args.command == 'compare':
+        # A non-zero exit status lets CI fail on regressions.
+        sys.exit(1 if compare(args, log) else 0)
+    else:
+        list_runs(log)
+
+
+if __name__ == '__main__':
+    main()
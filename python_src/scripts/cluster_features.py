@@ -2,7 +2,10 @@ from argparse import ArgumentParser
 from cv2 import circle, imwrite, imread
 from photogrammetry.storage.image_db import ImageDB
 from photogrammetry.image_processing.keypoint_detection import FASTKeypointDetector
-from photogrammetry.clustering.hierarchical import HierarchicalClustering, ChunkedHierarchicalClustering, ChunkedHierarchicalClusteringMultithreaded
+from photogrammetry.clustering.hierarchical import HierarchicalClustering, ChunkedHierarchicalClustering, ChunkedHierarchicalClusteringMultithreaded, AdaptiveChunkedHierarchicalClustering, ChunkedLinkageClustering
+from photogrammetry.clustering.single_linkage import SingleLinkageClustering
+from photogrammetry.clustering.dendrogram import Dendrogram
+from photogrammetry.clustering.linkage import LINKAGE_METHODS, normalize_metric
 from time import time
 from photogrammetry.storage.keypoint_cache import KeypointCache, KeypointCacheInfo
 
@@ -14,15 +17,30 @@ def setup_and_parse_args():
     parser.add_argument('input_file')
     parser.add_argument('--detection-threshold', default=50, type=int, required=False)
     parser.add_argument('--max-merge-dist', default=25, type=int, required=False)
-    return parser.parse_args()
+    parser.add_argument('--nms-radius', default=None, type=int, required=False)
+    parser.add_argument('--skip-clustering', action='store_true', default=False)
+    # single merges everything within --max-merge-dist, without the merge order of centroid linkage.
+    parser.add_argument('--linkage', default='centroid', choices=list(LINKAGE_METHODS), required=False)
+    parser.add_argument('--metric', default='cityblock', choices=['cityblock', 'manhattan', 'euclidean', 'chebyshev'], required=False)
+    # adaptive splits the keypoints into chunks of about equal count instead of a fixed 4x4 grid.
+    parser.add_argument('--partition', default='grid', choices=['grid', 'adaptive'], required=False)
+    # Builds the centroid linkage dendrogram once and cuts it at each distance, writing one image per distance.
+    parser.add_argument('--max-merge-dists', default=None, type=int, nargs='+', required=False)
+    args = parser.parse_args()
+    args.metric = normalize_metric(args.metric)
+    if args.linkage == 'ward' and args.metric != 'euclidean':
+        parser.error(f"--linkage ward needs --metric euclidean, not {args.metric}")
+    if args.max_merge_dists is not None and (args.linkage != 'centroid' or args.metric != 'cityblock'):
+        parser.error("--max-merge-dists cuts the centroid linkage dendrogram, which only takes --metric cityblock")
+    return args
 
 def draw_keypoints(img, keypoints, color):
     for keypoint in keypoints:
         circle(img, keypoint.coord[::-1], 5, color, -1)
 
-def run_fast_detection(image_db: ImageDB, image_id: int, detection_threshold: int):
+def run_fast_detection(image_db: ImageDB, image_id: int, detection_threshold: int, nms_radius=None):
     fast_detector = FASTKeypointDetector(detection_threshold, image_db)
-    keypoints = fast_detector.detect_points(image_id)
+    keypoints = fast_detector.detect_points(image_id, "vectorized", nms_radius=nms_radius)
     return keypoints
 
 def cluster_fast_detection(keypoints, max_merge_dist: int):
@@ -30,13 +48,45 @@ def cluster_fast_detection(keypoints, max_merge_dist: int):
     clustered_keypoints = hc.run_clustering()
     return clustered_keypoints
 
-def chunked_cluster_fast_detection(keypoints, image_dim, max_merge_dist: int):
+def single_linkage_cluster_fast_detection(keypoints, max_merge_dist: int):
+    slc = SingleLinkageClustering(keypoints, max_merge_distance=max_merge_dist)
+    return slc.run_clustering()
+
+def linkage_cluster_fast_detection(keypoints, image_dim, max_merge_dist: int, linkage: str, metric: str):
+    chunked_lc = ChunkedLinkageClustering(image_dim, keypoints, max_merge_dist=max_merge_dist, method=linkage, metric=metric)
+    return chunked_lc.run_clustering()
+
+def chunked_cluster_fast_detection(keypoints, image_dim, max_merge_dist: int, metric: str = 'cityblock'):
     chunked_hc = ChunkedHierarchicalClusteringMultithreaded(
-        image_dim, keypoints, max_merge_dist=max_merge_dist
+        image_dim, keypoints, max_merge_dist=max_merge_dist, metric=metric
     )
     chunked_keypoints = chunked_hc.run_clustering()
     return chunked_keypoints
 
+def adaptive_chunked_cluster_fast_detection(keypoints, image_dim, max_merge_dist: int, metric: str = 'cityblock'):
+    adaptive_hc = AdaptiveChunkedHierarchicalClustering(image_dim, keypoints, max_merge_dist=max_merge_dist, metric=metric)
+    clustered_keypoints = adaptive_hc.run_clustering()
+    counts, bin_edges = adaptive_hc.chunk_size_histogram()
+    print(f"Chunk sizes {bin_edges.astype(int).tolist()}: {counts.tolist()}")
+    slowest = max(adaptive_hc.task_stats, key=lambda stats: stats.seconds, default=None)
+    if slowest is not None:
+        print(f"Slowest chunk: {slowest}")
+    return clustered_keypoints
+
+def cut_dendrogram_at_distances(image, input_filename, keypoints, max_merge_dists: list[int]):
+    start = time()
+    # 5k keypoints ~ 1.2 seconds.
+    dendrogram = Dendrogram(keypoints)
+    print(f"Built the dendrogram of {len(keypoints)} keypoints in {time() - start}")
+    for max_merge_dist in max_merge_dists:
+        start = time()
+        clustered_keypoints = dendrogram.cut(max_merge_dist)
+        print(f"Cut at {max_merge_dist} to {len(clustered_keypoints)} keypoints in {time() - start}")
+        cut_image = image.copy()
+        draw_keypoints(cut_image, keypoints, (0, 0, 255))
+        draw_keypoints(cut_image, clustered_keypoints, (0, 255, 0))
+        imwrite(f"{input_filename[:-4]}_clustered_keypoints_{max_merge_dist}.jpg", cut_image)
+
 def main():
     cache = KeypointCache()
     args = setup_and_parse_args()
@@ -45,7 +95,8 @@ def main():
     raw_keypoint_cache_info = KeypointCacheInfo(
         img_hash=args.input_file,   # TODO this is a hack...    Instead, the image DB shoudl return a UUID or index. Then, we can use that as the hash of the image.
         is_clustered=False,
-        fast_detection_threshold=args.detection_threshold
+        fast_detection_threshold=args.detection_threshold,
+        nms_radius=args.nms_radius
     )
     height, width, _ = image.shape
     image_db = ImageDB(height, width)
@@ -53,17 +104,33 @@ def main():
     
     keypoints = cache.get_keypoints_if_exist(raw_keypoint_cache_info)
     if keypoints is None:
-        keypoints = run_fast_detection(image_db, image_id, args.detection_threshold)
+        keypoints = run_fast_detection(image_db, image_id, args.detection_threshold, args.nms_radius)
         cache.store_keypoints_if_not_exist(keypoints, raw_keypoint_cache_info)
     print(f"Found {len(keypoints)} keypoints")
+    if args.skip_clustering:
+        # With --nms-radius the detector output is already thinned.
+        draw_keypoints(image, keypoints, (0, 255, 0))
+        imwrite(f"{input_filename[:-4]}_clustered_keypoints.jpg", image)
+        return
+
+    if args.max_merge_dists is not None:
+        cut_dendrogram_at_distances(image, input_filename, keypoints, args.max_merge_dists)
+        return
 
     start=time()
     # Taking ~11 seconds for 2175 points.
     # Unplugged, ~12.2s, 2175 -> 279 keypoints.
     # clustered_keypoints = cluster_fast_detection(keypoints, args.max_merge_dist)
 
-    # Unplugged, 4x4, ~3.71s, 2175 -> 280
-    clustered_keypoints = chunked_cluster_fast_detection(keypoints, (height, width), args.max_merge_dist)
+    if args.linkage == 'single' and args.metric == 'cityblock':
+        clustered_keypoints = single_linkage_cluster_fast_detection(keypoints, args.max_merge_dist)
+    elif args.linkage != 'centroid':
+        clustered_keypoints = linkage_cluster_fast_detection(keypoints, (height, width), args.max_merge_dist, args.linkage, args.metric)
+    elif args.partition == 'adaptive':
+        clustered_keypoints = adaptive_chunked_cluster_fast_detection(keypoints, (height, width), args.max_merge_dist, args.metric)
+    else:
+        # Unplugged, 4x4, ~3.71s, 2175 -> 280
+        clustered_keypoints = chunked_cluster_fast_detection(keypoints, (height, width), args.max_merge_dist, args.metric)
     print(f"Clustered to {len(clustered_keypoints)} keypoints in {time() - start}")
     draw_keypoints(image, keypoints, (0, 0, 255))
     draw_keypoints(image, clustered_keypoints, (0, 255, 0))
@@ -1,6 +1,8 @@
 from argparse import ArgumentParser
 from cv2 import imread, imwrite
-from photogrammetry.image_processing.warping import get_distortion_mat, apply_distortion_mat
+from photogrammetry.image_processing.warping import apply_distortion_mat
+from photogrammetry.storage.distortion_map_cache import DistortionMapCache
+import numpy as np
 from os import path
 import time
 from datetime import datetime
@@ -58,11 +60,12 @@ def main():
         'channels': channels,
         'filename': args.input_file
     }
-    distortion_mat = get_distortion_mat((img_height, img_width), distortion_coefficients, refresh_cache=args.refresh_cache)
+    distortion_maps = DistortionMapCache().get_maps((img_height, img_width), distortion_coefficients, refresh_cache=args.refresh_cache)
     run_stats['generate_distortion_mat_seconds'] = (time.time() - start_time)
     run_stats['generate_includes_caching'] = True
+    de_warped = np.empty_like(image)
     start_time = time.time()
-    de_warped = apply_distortion_mat(image, distortion_mat)
+    apply_distortion_mat(image, distortion_maps, dst=de_warped)
     run_stats['apply_distortion_mat_seconds'] = (time.time() - start_time)
     imwrite(outfile_path, de_warped)
     save_stats(stats_file_path, run_stats)
@@ -1,7 +1,9 @@
 from argparse import ArgumentParser
 from cv2 import imread, Mat, imwrite, circle
-from photogrammetry.image_processing.keypoint_detection import FASTKeypointDetector
-from photogrammetry.storage.image_db import ImageDB
+from photogrammetry.image_processing.keypoint_detection import FASTKeypointDetector, DETECTION_ENGINES
+from photogrammetry.storage.image_db import ImageDB, write_bw_image_file
+from os import path
+import numpy as np
 import time
 
 def setup_and_parse_args():
@@ -10,20 +12,33 @@ def setup_and_parse_args():
         description='Detects keypoints'
     )
     parser.add_argument('input_file')
+    parser.add_argument('--engine', default='row', choices=DETECTION_ENGINES, required=False)
+    parser.add_argument('--band-height', default=None, type=int, required=False, help='Detect in horizontal bands of this many rows')
+    # Grayscale .npy the bands are read from, by default written next to the input on the first --band-height run.
+    parser.add_argument('--bw-image-file', default=None, required=False)
     return parser.parse_args()
 
 def draw_keypoint(img, keypoint):
     circle(img, keypoint.coord[::-1], 5, (0, 255, 0), -1)
 
-def run_fast_detection(image_db: ImageDB, image_id: int):
+def run_fast_detection(image_db: ImageDB, image_id: int, engine: str):
     # keypoints = fast_detection(image)
     fast_detector = FASTKeypointDetector(50, image_db)
-    keypoints = fast_detector.detect_points(image_id)
+    keypoints = fast_detector.detect_points(image_id, engine)
     return keypoints
 
-def draw_keypoints(keypoints, image_db, image_id, filename):
-    image = image_db.get_image(image_id)
+def run_tiled_fast_detection(input_filename: str, bw_image_file: str, band_height: int):
+    if not path.exists(bw_image_file):
+        # The only time the whole image is in memory, detection then reads the grayscale file band by band.
+        write_bw_image_file(imread(input_filename), bw_image_file)
+    height, width = np.load(bw_image_file, mmap_mode='r').shape
+    fast_detector = FASTKeypointDetector(50, ImageDB(height, width))
+    keypoints = []
+    for band_keypoints in fast_detector.iter_points_tiled(0, bw_image_file, band_height):
+        keypoints.extend(band_keypoints)
+    return keypoints
 
+def draw_keypoints(keypoints, image, filename):
     for keypoint in keypoints:
         draw_keypoint(image, keypoint)
     # TODO pass as arg
@@ -33,15 +48,19 @@ def draw_keypoints(keypoints, image_db, image_id, filename):
 def main():
     args = setup_and_parse_args()
     input_filename = args.input_file
-    image = imread(input_filename)
-    height, width, _ = image.shape
-    image_db = ImageDB(height, width)
-    image_id = image_db.add_image(image)
     start = time.time()
-    keypoints = run_fast_detection(image_db, image_id)
+    if args.band_height is not None:
+        bw_image_file = args.bw_image_file or f"{input_filename[:-4]}_bw.npy"
+        keypoints = run_tiled_fast_detection(input_filename, bw_image_file, args.band_height)
+    else:
+        image = imread(input_filename)
+        height, width, _ = image.shape
+        image_db = ImageDB(height, width)
+        image_id = image_db.add_image(image)
+        keypoints = run_fast_detection(image_db, image_id, args.engine)
     print(len(keypoints), "keypoints found")
     print(f"Fast detection took {time.time() - start}")
-    draw_keypoints(keypoints, image_db, image_id, input_filename)
+    draw_keypoints(keypoints, imread(input_filename), input_filename)
     
 
 if __name__ == '__main__':
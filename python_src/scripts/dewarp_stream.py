@@ -0,0 +1,46 @@
+from argparse import ArgumentParser
+from os import path
+from photogrammetry.pipeline.dewarp_stream import DewarpStream, directory_frames, video_frames
+from photogrammetry.utils.files import create_dir_if_not_exists
+import time
+
+
+def setup_and_parse_args():
+    parser = ArgumentParser(
+        prog='dewarp_stream',
+        description='Removes fisheye from every frame of a directory of images, a video file or a camera'
+    )
+    # A directory, a video file, or a camera index such as 0.
+    parser.add_argument('source')
+    parser.add_argument('--output-dir', default='./data/dewarp_test/stream', required=False)
+    parser.add_argument('--distortion-coefficients', default=[3e-4, 1e-7, 0, 0, 0], type=float, nargs=5, required=False)
+    parser.add_argument('--threads', default=None, type=int, required=False)
+    parser.add_argument('--jpeg-quality', default=95, type=int, required=False)
+    return parser.parse_args()
+
+
+def open_frames(source: str):
+    if path.isdir(source):
+        return directory_frames(source)
+    if source.isdigit():
+        return video_frames(int(source))
+    return video_frames(source)
+
+
+def main():
+    args = setup_and_parse_args()
+    create_dir_if_not_exists(args.output_dir)
+    stream = DewarpStream(args.distortion_coefficients, threads=args.threads, jpeg_quality=args.jpeg_quality)
+
+    start = time.time()
+    num_frames = 0
+    for frame_idx, encoded_frame in enumerate(stream.run(open_frames(args.source))):
+        with open(path.join(args.output_dir, f'frame_{frame_idx:06d}.jpg'), 'wb') as fp:
+            fp.write(encoded_frame)
+        num_frames += 1
+    seconds = time.time() - start
+    print(f"De-warped {num_frames} frames in {seconds:.2f} seconds, {num_frames / max(seconds, 1e-9):.1f} frames per second on {stream.threads} threads")
+
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,8 @@ from cv2 import FONT_HERSHEY_SIMPLEX, circle, imread, imwrite, line, putText
 
 from photogrammetry.image_processing.keypoint_detection import \
     FASTKeypointDetector
-from photogrammetry.image_processing.keypoint_matching import match_keypoints
+from photogrammetry.image_processing.keypoint_matching import match_keypoints, match_keypoints_spatial
+from photogrammetry.image_processing.descriptors import compute_keypoint_descriptors
 from photogrammetry.clustering.hierarchical import HierarchicalClustering, ChunkedHierarchicalClusteringMultithreaded
 from photogrammetry.storage.image_db import ImageDB
 from photogrammetry.storage.keypoint_cache import KeypointCache, KeypointCacheInfo
@@ -21,14 +22,20 @@ def setup_and_parse_args():
     parser.add_argument('--detection-threshold', default=50, type=int, required=False)
     parser.add_argument('--max-merge-dist', default=25, type=int, required=False)
     parser.add_argument('--match-threshold', default=75, type=int, required=False)
+    parser.add_argument('--nms-radius', default=None, type=int, required=False)
+    parser.add_argument('--skip-clustering', action='store_true', default=False)
+    # Restricts matches to a window around each keypoint's expected position, for bounded motion (video, stereo).
+    parser.add_argument('--search-radius', default=None, type=int, required=False)
+    parser.add_argument('--search-offset', default=None, type=int, nargs=2, metavar=('ROW', 'COL'), required=False)
+    parser.add_argument('--ratio', default=0.8, type=float, required=False)
     return parser.parse_args()
 
 def draw_keypoints(img, keypoints, color):
     for keypoint in keypoints:
         circle(img, keypoint.coord[::-1], 5, color, -1)
 
-def run_fast_detection(fast_detector: FASTKeypointDetector, image_id: int):
-    keypoints = fast_detector.detect_points(image_id)
+def run_fast_detection(fast_detector: FASTKeypointDetector, image_id: int, nms_radius=None):
+    keypoints = fast_detector.detect_points(image_id, "vectorized", nms_radius=nms_radius)
     return keypoints
 
 def chunked_cluster_fast_detection(keypoints, image_dim, max_merge_dist: int):
@@ -38,18 +45,23 @@ def chunked_cluster_fast_detection(keypoints, image_dim, max_merge_dist: int):
     chunked_keypoints = chunked_hc.run_clustering()
     return chunked_keypoints
 
-def cluster_keypoints(image, input_filename, detection_threshold, image_db, cache, image_dim, max_merge_dist, fast_detector):
+def cluster_keypoints(image, input_filename, detection_threshold, image_db, cache, image_dim, max_merge_dist, fast_detector, nms_radius=None, skip_clustering=False):
     keypoint_cache_info = KeypointCacheInfo(
         img_hash=input_filename,
         is_clustered=False,
-        fast_detection_threshold=detection_threshold
+        fast_detection_threshold=detection_threshold,
+        nms_radius=nms_radius,
+        # The cached KeyPoints carry their pattern, so both images must come from the same one.
+        descriptor_pattern_id=fast_detector.pattern_id
     )
     image_id = image_db.add_image(image)
 
     keypoints = cache.get_keypoints_if_exist(keypoint_cache_info)
     if not keypoints:
-        keypoints = run_fast_detection(fast_detector, image_id)
+        keypoints = run_fast_detection(fast_detector, image_id, nms_radius)
         cache.store_keypoints_if_not_exist(keypoints, keypoint_cache_info)
+    if skip_clustering:
+        return keypoints
     # TODO not finding independent dicts for some reason... Maybe cache needs a reload.
     # clustered_keypoint_cache_info = KeypointCacheInfo(
     #     img_hash=input_filename,
@@ -99,17 +111,30 @@ def main():
     img_1_keypoints = cluster_keypoints(
         image_1, input_filename_1,
         args.detection_threshold, image_db, cache, img_dim, args.max_merge_dist,
-        fast_detector
+        fast_detector, args.nms_radius, args.skip_clustering
     )
     img_2_keypoints = cluster_keypoints(
         image_2, input_filename_2,
         args.detection_threshold, image_db, cache, img_dim, args.max_merge_dist,
-        fast_detector
+        fast_detector, args.nms_radius, args.skip_clustering
     )
 
     # print(img_2_keypoints)
-
-    key1_to_key2_dist = match_keypoints(img_1_keypoints, img_2_keypoints, -1)
+    compute_keypoint_descriptors(img_1_keypoints)
+    compute_keypoint_descriptors(img_2_keypoints)
+
+    if args.search_radius is None:
+        key1_to_key2_dist = match_keypoints(img_1_keypoints, img_2_keypoints, k=1)
+        matches = [
+            (key1_idx, *key1_to_key2_dist[key1_idx, 0]) for key1_idx in range(len(img_1_keypoints))
+            if key1_to_key2_dist[key1_idx, 0, 1] <= args.match_threshold
+        ]
+    else:
+        matches = match_keypoints_spatial(
+            img_1_keypoints, img_2_keypoints, args.search_radius, ratio=args.ratio,
+            max_distance=args.match_threshold, offset=args.search_offset
+        )
+    print(f"{len(matches)} matches")
 
     image_combined = np.hstack((image_1, image_2))
 
@@ -118,17 +143,10 @@ def main():
     # for key_idx in range(len(img_2_keypoints)):
     #     draw_keypoint(image_combined, img_2_keypoints[key_idx], True, width)
 
-    for key1_idx in range(len(img_1_keypoints)):
+    for key1_idx, key2_idx, dist in matches:
         keypoint1 = img_1_keypoints[key1_idx]
-        
-        # print(key1_to_key2_dist[key1_idx])
-        # return
-        key2_idx, dist = key1_to_key2_dist[key1_idx, 0]
-        if dist > args.match_threshold:
-            continue
-        # print(dist)
         keypoint2 = img_2_keypoints[key2_idx]
-        
+
         draw_keypoint(image_combined, keypoint1, False, width)
         draw_keypoint(image_combined, keypoint2, True, width)
         draw_keypoint_line(image_combined, keypoint1, keypoint2, (255, 0, 0), width)
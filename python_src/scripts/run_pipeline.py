@@ -0,0 +1,71 @@
+from argparse import ArgumentParser
+from collections import defaultdict
+from os import path
+from photogrammetry.pipeline.scheduler import PipelineScheduler
+from photogrammetry.pipeline.stages import PipelineConfig, build_image_pipeline, CLUSTERING_MODES, MATCH_PAIRS
+from photogrammetry.storage.pattern_registry import DescriptorPatternRegistry
+from photogrammetry.utils.files import create_dir_if_not_exists
+from time import time
+import numpy as np
+
+
+def setup_and_parse_args():
+    parser = ArgumentParser(
+        prog='run_pipeline',
+        description='Detects, clusters, describes and matches keypoints of many images on one shared process pool'
+    )
+    parser.add_argument('input_files', nargs='+')
+    parser.add_argument('--processes', default=None, type=int, required=False)
+    # Bounds how many images are loaded at once, by default 2 per process.
+    parser.add_argument('--max-images-in-flight', default=None, type=int, required=False)
+    parser.add_argument('--detection-threshold', default=50, type=int, required=False)
+    parser.add_argument('--nms-radius', default=None, type=int, required=False)
+    parser.add_argument('--clustering', default='centroid', choices=list(CLUSTERING_MODES), required=False)
+    parser.add_argument('--max-merge-dist', default=25, type=int, required=False)
+    parser.add_argument('--distortion-coefficients', default=None, type=float, nargs=5, required=False)
+    parser.add_argument('--steered', action='store_true', default=False)
+    parser.add_argument('--match-threshold', default=75, type=int, required=False)
+    parser.add_argument('--ratio', default=0.8, type=float, required=False)
+    parser.add_argument('--search-radius', default=None, type=int, required=False)
+    parser.add_argument('--match-pairs', default='consecutive', choices=list(MATCH_PAIRS), required=False)
+    parser.add_argument('--output-dir', default='./data/tmp/pipeline', required=False)
+    return parser.parse_args()
+
+
+def print_task_times(task_stats):
+    task_seconds = defaultdict(float)
+    for stats in task_stats:
+        task_seconds[stats.key[0]] += stats.seconds
+    for task, seconds in task_seconds.items():
+        print(f"{task}: {seconds:.2f} seconds of worker time")
+
+
+def main():
+    args = setup_and_parse_args()
+    config = PipelineConfig(
+        detection_threshold=args.detection_threshold, nms_radius=args.nms_radius,
+        distortion_coefficients=args.distortion_coefficients, clustering=args.clustering,
+        max_merge_dist=args.max_merge_dist, steered=args.steered, match_threshold=args.match_threshold,
+        ratio=args.ratio, search_radius=args.search_radius, match_pairs=args.match_pairs
+    )
+    pattern_id, gaussian_pairs = DescriptorPatternRegistry().get_pattern(50)
+    scheduler = PipelineScheduler(args.processes, args.max_images_in_flight)
+    build_image_pipeline(scheduler, args.input_files, config, gaussian_pairs, pattern_id)
+
+    start = time()
+    results = scheduler.run()
+    print(f"Processed {len(args.input_files)} images in {time() - start:.2f} seconds on {scheduler.processes} processes")
+    print_task_times(scheduler.task_stats)
+
+    create_dir_if_not_exists(args.output_dir)
+    for key, result in results.items():
+        if key[0] == "keypoints":
+            print(f"{args.input_files[key[1]]}: {len(result)} keypoints")
+            result.save(path.join(args.output_dir, f"keypoints_{key[1]}.npz"))
+        else:
+            print(f"{args.input_files[key[1]]} -> {args.input_files[key[2]]}: {len(result)} matches")
+            np.save(path.join(args.output_dir, f"matches_{key[1]}_{key[2]}.npy"), result)
+
+
+if __name__ == '__main__':
+    main()
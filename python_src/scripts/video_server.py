@@ -1,11 +1,23 @@
+from argparse import ArgumentParser
 from flask import Flask, Response
 from picamera import PiCamera
+from photogrammetry.pipeline.dewarp_stream import DewarpStream
 from io import BytesIO
 from threading import Condition
 from time import sleep
 
 app = Flask(__name__)
 
+def setup_and_parse_args():
+    parser = ArgumentParser(
+        prog='video_server',
+        description='Streams the camera as MJPEG, raw at /video-feed and de-warped at /video-feed-dewarped'
+    )
+    parser.add_argument('--distortion-coefficients', default=[3e-4, 1e-7, 0, 0, 0], type=float, nargs=5, required=False)
+    parser.add_argument('--threads', default=None, type=int, required=False)
+    parser.add_argument('--jpeg-quality', default=85, type=int, required=False)
+    return parser.parse_args()
+
 class StreamingOutput(object):
     def __init__(self):
         self.frame = None
@@ -27,20 +39,34 @@ class StreamingOutput(object):
 def hello_world():
     return "<p>Hello World!</p>"
 
-def get_frame():
+def get_camera_frames():
     while True:
         with output.condition:
             output.condition.wait()
             frame = output.frame
+        yield frame
+
+def get_frame(frames):
+    for frame in frames:
         yield (b'--frame\r\n'
                b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
 
 @app.route('/video-feed')
 def video_feed():
-    return Response(get_frame(),
+    return Response(get_frame(get_camera_frames()),
+                    mimetype='multipart/x-mixed-replace; boundary=frame')
+
+@app.route('/video-feed-dewarped')
+def video_feed_dewarped():
+    # Camera frames are queued on the pool as they arrive and sent once de-warped, so while the pool can't keep up
+    # the feed lags by up to max_in_flight frames. Frames are only missed while sending blocks, as get_camera_frames
+    # waits for the next one.
+    stream = DewarpStream(args.distortion_coefficients, threads=args.threads, jpeg_quality=args.jpeg_quality)
+    return Response(get_frame(stream.run(get_camera_frames())),
                     mimetype='multipart/x-mixed-replace; boundary=frame')
 
 if __name__ == '__main__':
+    args = setup_and_parse_args()
     with PiCamera(resolution='1920x1080', framerate=10) as camera:
         sleep(2)
         global output